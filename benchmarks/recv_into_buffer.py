@@ -0,0 +1,91 @@
+"""
+Microbenchmark of the copy of received results into the CyclicBuffer.
+
+Compares the previous receive path (``np.frombuffer`` + ``copy()`` into a
+fresh tensor, then a second copy into the shared slot) with
+:func:`threedb.scheduling.utils.recv_into_buffer`, which copies the frames
+straight into the shared slots.
+
+Usage: PYTHONPATH=. python benchmarks/recv_into_buffer.py [--resolution 512] [--repeats 50]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch as ch
+import zmq
+
+from threedb.scheduling.utils import recv_into_buffer
+from threedb.utils import CyclicBuffer
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--repeats', type=int, default=50)
+parser.add_argument('--batch', type=int, default=4,
+                    help='Number of results per message')
+
+
+def legacy_recv_into_buffer(channels, payloads, cyclic_buffer):
+    """The receive path before zero-copy receiving, for reference"""
+    indices = []
+    for payload in payloads:
+        buf_data = {}
+        for channel, frame in zip(channels, payload):
+            shape, dtype = cyclic_buffer.declared_buffers[channel]
+            arr = np.frombuffer(frame.buffer, dtype=dtype).reshape(shape)
+            buf_data[channel] = ch.from_numpy(arr.copy())
+        indices.append(cyclic_buffer.allocate(buf_data))
+    return indices
+
+
+def make_payloads(declared, batch):
+    """Send a push-like message through an inproc socket pair to get real
+    (non copied) zmq frames"""
+    context = zmq.Context.instance()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    sender.bind('inproc://bench')
+    receiver.connect('inproc://bench')
+    frames = []
+    for _ in range(batch):
+        for shape, dtype in declared.values():
+            arr = np.asarray(np.random.rand(*shape)).astype(dtype)
+            frames.append(arr)
+    sender.send_multipart(frames)
+    received = receiver.recv_multipart(copy=False)
+    per_result = len(declared)
+    return [received[i * per_result:(i + 1) * per_result] for i in range(batch)]
+
+
+def bench(fn, declared, payloads, repeats):
+    buffer = CyclicBuffer(size=2 * len(payloads) + 1, with_tqdm=False)
+    regid = buffer.register()
+    buffer.declare_buffers(declared)
+    keys = list(declared.keys())
+    total_bytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize
+                      for shape, dtype in declared.values()) * len(payloads)
+    elapsed = 0.
+    for _ in range(repeats):
+        start = time.perf_counter()
+        indices = fn(keys, payloads, buffer)
+        elapsed += time.perf_counter() - start
+        for ind in indices:
+            buffer.free(ind, regid)
+    return total_bytes * repeats / elapsed / 2**20
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    res = args.resolution
+    declared = {
+        'rgb': ([3, res, res], 'float32'),
+        'uv': ([4, res, res], 'float32'),
+        'depth': ([4, res, res], 'float32'),
+        'segmentation': ([1, res, res], 'int32'),
+        'is_correct': ([], 'bool'),
+        'loss': ([], 'float32')
+    }
+    payloads = make_payloads(declared, args.batch)
+    for name, fn in [('before (copy + allocate)', legacy_recv_into_buffer),
+                     ('after (recv_into_buffer)', recv_into_buffer)]:
+        print(f'{name:>28}: {bench(fn, declared, payloads, args.repeats):8.0f} MB/s')
@@ -40,6 +40,9 @@ setup(name='threedb-preview',
         'tensorboard',
         'typeguard',
         'pyyaml'],
+      extras_require={
+          'compression': ['lz4', 'zstandard']
+      },
       packages=find_packages(),
       include_package_data=True,
       zip_safe=False)
@@ -0,0 +1,133 @@
+"""
+Tests of :class:`threedb.utils.CyclicBuffer`: reference counting of the
+channels of each result and release of their slots.
+"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch as ch
+
+from threedb.utils import CyclicBuffer
+
+BUFFERS = {
+    'rgb': ([3, 4, 4], 'float32'),
+    'is_correct': ([], 'bool'),
+    'loss': ([], 'float32'),
+}
+
+@pytest.fixture
+def make_buffer():
+    buffers = []
+    def make(**kwargs):
+        buffer = CyclicBuffer(with_tqdm=False, **kwargs)
+        buffers.append(buffer)
+        return buffer
+    yield make
+    for buffer in buffers:
+        buffer.close()
+
+def result(value: float):
+    return {'rgb': ch.full((3, 4, 4), value), 'is_correct': ch.tensor(True),
+            'loss': ch.tensor(value)}
+
+def test_round_trip(make_buffer):
+    buffer = make_buffer(size=4, buffers=BUFFERS)
+    buffer.register()
+    ind = buffer.allocate(result(0.5))
+    np.testing.assert_array_equal(buffer.view(ind, 'rgb'), np.full((3, 4, 4), 0.5))
+    assert buffer[ind]['loss'].item() == 0.5
+
+    buffer.write_array(ind, 'rgb', np.zeros(48, dtype='float32'))
+    assert not buffer[ind]['rgb'].any()
+
+def test_channels_of(make_buffer):
+    buffer = make_buffer(size=4, buffers=BUFFERS)
+    everything = buffer.register()
+    policy = buffer.register(channels=[], scalars=True)
+    logger = buffer.register(channels=['rgb'])
+    assert buffer.channels_of(everything) == list(BUFFERS)
+    assert buffer.channels_of(policy) == ['is_correct', 'loss']
+    assert buffer.channels_of(logger) == ['rgb']
+
+def test_image_slot_released_before_the_scalars(make_buffer):
+    buffer = make_buffer(size=4, buffers=BUFFERS)
+    policy = buffer.register(channels=[], scalars=True)
+    logger = buffer.register(channels=['rgb'])
+    ind = buffer.allocate(result(1.))
+    rgb = buffer.pool_list[buffer.channel_index['rgb']]
+    loss = buffer.pool_list[buffer.channel_index['loss']]
+    assert (rgb.in_use, loss.in_use) == (1, 1)
+
+    buffer.free(ind, logger)
+    buffer.process_events()
+    assert (rgb.in_use, loss.in_use) == (0, 1)
+    assert ind not in buffer._free_idx
+
+    buffer.free(ind, policy)
+    buffer.process_events()
+    assert loss.in_use == 0
+    assert ind in buffer._free_idx
+
+def test_result_freed_once_every_consumer_is_done(make_buffer):
+    buffer = make_buffer(size=2, buffers=BUFFERS)
+    consumers = [buffer.register() for _ in range(3)]
+    ind = buffer.allocate(result(0.))
+    assert buffer.num_free() == 1
+    for reg_id in consumers[:-1]:
+        buffer.free(ind, reg_id)
+    assert buffer.num_free() == 1
+    buffer.free(ind, consumers[-1])
+    assert buffer.num_free() == 2
+    assert not buffer.refcounts[ind].any()
+
+def test_double_free_asserts(make_buffer):
+    buffer = make_buffer(size=2, buffers=BUFFERS)
+    first = buffer.register()
+    ind = buffer.allocate(result(0.))
+    buffer.free(ind, first)
+    with pytest.raises(AssertionError, match='freed twice'):
+        buffer.free(ind, first)
+
+def test_free_by_everyone_at_once(make_buffer):
+    buffer = make_buffer(size=2, buffers=BUFFERS)
+    first = buffer.register()
+    buffer.register()
+    ind = buffer.allocate(result(0.))
+    buffer.free(ind, first)
+    buffer.free(ind, -1)
+    assert buffer.num_free() == 2
+
+def test_many_consumers(make_buffer):
+    # More consumers than bits in the refcounts of the original buffer
+    buffer = make_buffer(size=8, buffers=BUFFERS)
+    consumers = [buffer.register() for _ in range(12)]
+    indices = buffer.reserve(8)
+    assert buffer.num_free() == 0
+    for ind in indices:
+        for reg_id in consumers:
+            buffer.free(ind, reg_id)
+    assert buffer.num_free() == 8
+
+def test_allocate_waits_for_a_free(make_buffer):
+    buffer = make_buffer(size=1, buffers=BUFFERS, stall_warning=5.)
+    reg_id = buffer.register()
+    first = buffer.allocate(result(0.))
+    freer = threading.Timer(0.2, buffer.free, (first, reg_id))
+    freer.start()
+    start = time.time()
+    second = buffer.allocate(result(1.))
+    freer.join()
+    assert second == first
+    assert time.time() - start >= 0.15
+    assert buffer.stall_time > 0
+
+def test_memory_budget_favours_small_channels(make_buffer):
+    buffer = make_buffer(memory_budget=2**14, small_channel_bytes=16,
+                         small_channel_factor=16, max_results=1024)
+    size, capacities = buffer.plan_capacities(BUFFERS)
+    assert capacities['loss'] == capacities['is_correct'] == size
+    assert size == 16 * 60
+    assert capacities['rgb'] == (2**14 - size * 5) // (48 * 4)
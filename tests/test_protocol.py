@@ -0,0 +1,103 @@
+"""
+Tests of :mod:`threedb.scheduling.protocol`: the encoding of the jobs sent
+to the workers and of the result channels they send back.
+"""
+
+import numpy as np
+import pytest
+
+from threedb.scheduling.policy_controller import JobDescriptor
+from threedb.scheduling.protocol import ChannelEncoding, JobCodec
+from threedb.scheduling.search_space import SearchSpace
+
+class FakeControl:
+    def __init__(self) -> None:
+        self.continuous_dims = {'x': (0., 2.), 'y': 0.5}
+        self.discrete_dims = {'c': ['a', 'b', 'c']}
+
+@pytest.fixture
+def codec():
+    search_space = SearchSpace([FakeControl()])
+    # The workers only get the (JSON) schema
+    schema = JobCodec.make_schema(['e0.blend', 'e1.blend'], ['m0', 'm1'], search_space)
+    return search_space, JobCodec(schema)
+
+def test_jobs_round_trip(codec):
+    search_space, job_codec = codec
+    jobs = [JobDescriptor(order=i, id=2**62 + i, environment=f'e{i % 2}.blend',
+                          model=f'm{(i + 1) % 2}', render_args=None, control_order=None,
+                          params=search_space.pack([i / 4], [i % 3]))
+            for i in range(4)]
+    header, frames = job_codec.encode(jobs)
+    decoded = job_codec.decode(header, [bytes(frame) for frame in frames])
+    assert len(decoded) == len(jobs)
+    for job, got in zip(jobs, decoded):
+        assert got.id == job.id
+        assert (got.environment, got.model) == (job.environment, job.model)
+        np.testing.assert_array_equal(got.params, job.params)
+        render_args, control_order = search_space.unpack_vector(job.params)
+        assert got.render_args == render_args
+        assert got.control_order == control_order
+    assert job_codec.decode_cache_keys(header) == {}
+
+def test_empty_batch(codec):
+    _, job_codec = codec
+    header, frames = job_codec.encode([])
+    assert job_codec.decode(header, frames) == []
+
+def test_cache_keys_travel_with_their_jobs(codec):
+    search_space, job_codec = codec
+    jobs = [JobDescriptor(order=i, id=i, environment='e0.blend', model='m0',
+                          render_args=None, control_order=None,
+                          params=search_space.pack([0.], [0]))
+            for i in range(3)]
+    header, _ = job_codec.encode(jobs, {1: 'ab' * 16, 7: 'cd' * 16})
+    assert job_codec.decode_cache_keys(header) == {1: 'ab' * 16}
+
+@pytest.mark.parametrize('spec', [None, 'zlib', {'dtype': 'float16'},
+                                  {'dtype': 'float32', 'compression': 'zlib', 'level': 1}])
+def test_float_channel_round_trip(spec):
+    encoding = ChannelEncoding() if spec is None else ChannelEncoding.from_config(spec)
+    encoding.check('depth', 'float32')
+    array = np.linspace(0, 1, 3 * 8 * 8, dtype='float32').reshape(3, 8, 8)
+    target = np.empty_like(array)
+    encoding.decode_into(bytes(encoding.encode(array)), target)
+    tolerance = 1e-3 if encoding.dtype == 'float16' else 0
+    np.testing.assert_allclose(target, array, atol=tolerance)
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+def test_quantized_channel_round_trip(dtype):
+    encoding = ChannelEncoding.from_config({'dtype': dtype, 'compression': 'zlib'})
+    encoding.check('rgb', 'float32')
+    array = np.random.default_rng(0).random((3, 16, 16), dtype='float32')
+    frame = encoding.encode(array)
+    target = np.empty_like(array)
+    encoding.decode_into(frame, target)
+    assert target.dtype == np.float32
+    step = 1 / {'uint8': 255, 'uint16': 65535}[dtype]
+    np.testing.assert_allclose(target, array, atol=step / 2 + 1e-7)
+
+def test_quantization_clips_to_unit_range():
+    encoding = ChannelEncoding(dtype='uint8')
+    array = np.array([-0.5, 0., 1., 1.5], dtype='float32')
+    target = np.empty_like(array)
+    encoding.decode_into(encoding.encode(array), target)
+    np.testing.assert_array_equal(target, [0., 0., 1., 1.])
+
+def test_integer_channel_round_trip():
+    encoding = ChannelEncoding.from_config('int16')
+    encoding.check('segmentation', 'int32')
+    array = np.arange(-5, 59, dtype='int32').reshape(1, 8, 8)
+    target = np.empty_like(array)
+    encoding.decode_into(encoding.encode(array), target)
+    np.testing.assert_array_equal(target, array)
+
+def test_describe_round_trip():
+    encoding = ChannelEncoding.from_config({'dtype': 'uint8', 'compression': 'zlib', 'level': 3})
+    assert ChannelEncoding(**encoding.describe()).describe() == encoding.describe()
+
+def test_check_rejects_lossy_casts():
+    with pytest.raises(AssertionError):
+        ChannelEncoding(dtype='int16').check('depth', 'float32')
+    with pytest.raises(AssertionError):
+        ChannelEncoding(dtype='bool').check('segmentation', 'int32')
@@ -0,0 +1,110 @@
+"""
+Tests of :class:`threedb.scheduling.work_queue.WorkQueue`: placement of the
+jobs, leases, speculative duplicates and cancellations.
+"""
+
+import pytest
+
+from threedb.scheduling import work_queue
+from threedb.scheduling.policy_controller import JobDescriptor
+from threedb.scheduling.work_queue import WorkQueue
+
+class Clock:
+    """Stands for the ``time`` module of the work queue, so that leases
+    expire when the tests say so
+    """
+    def __init__(self) -> None:
+        self.now = 1000.
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(work_queue, 'time', fake)
+    return fake
+
+def make_job(job_id, env='e0', model='m0'):
+    return JobDescriptor(order=0, id=job_id, environment=env, model=model,
+                         render_args=None, control_order=None, params=None)
+
+def test_serves_the_placed_pair_first(clock):
+    queue = WorkQueue()
+    for i in range(3):
+        queue.add('policy', make_job(i, 'e0', 'm0'))
+        queue.add('policy', make_job(10 + i, 'e1', 'm1'))
+    jobs = queue.pop(3, 'w1', 'e1', 'm1')
+    assert [job.id for job in jobs] == [10, 11, 12]
+    assert queue.num_pending == 3
+    assert queue.pending_counts == {('e0', 'm0'): 3}
+
+def test_batch_stays_on_the_pair_picked_when_placed_one_is_empty(clock):
+    queue = WorkQueue()
+    queue.add('policy', make_job(0, 'e0', 'm0'))
+    queue.add('policy', make_job(1, 'e1', 'm1'))
+    queue.add('policy', make_job(2, 'e0', 'm0'))
+    jobs = queue.pop(2, 'w1', 'e2', 'm2')
+    assert [(job.environment, job.model) for job in jobs] == [('e0', 'm0')] * 2
+
+def test_leased_jobs_are_not_handed_out_again(clock):
+    queue = WorkQueue(waste_budget=1.)
+    queue.add('policy', make_job(0))
+    assert [job.id for job in queue.pop(1, 'w1', 'e0', 'm0')] == [0]
+    assert queue.pop(1, 'w2', 'e0', 'm0') == []
+
+def test_expired_lease_is_duplicated_within_the_waste_budget(clock):
+    queue = WorkQueue(waste_budget=1., initial_lease=10., lease_factor=2.)
+    queue.add('policy', make_job(0))
+    queue.pop(1, 'w1', 'e0', 'm0')
+    clock.now += 19.
+    assert queue.pop(1, 'w2', 'e0', 'm0') == []
+    clock.now += 2.
+    # Not to the worker that let it expire
+    assert queue.pop(1, 'w1', 'e0', 'm0') == []
+    assert [job.id for job in queue.pop(1, 'w2', 'e0', 'm0')] == [0]
+    assert queue.speculative == 1
+
+def test_waste_budget_caps_the_duplicates(clock):
+    queue = WorkQueue(waste_budget=0.25, initial_lease=1.)
+    for i in range(4):
+        queue.add('policy', make_job(i))
+    queue.pop(4, 'w1', 'e0', 'm0')
+    clock.now += 100.
+    # A single duplicate fits in a quarter of the 4 (+1) jobs dispatched
+    assert len(queue.pop(4, 'w2', 'e0', 'm0')) == 1
+    assert queue.speculative == 1
+    assert queue.pop(2, 'w3', 'e0', 'm0') == []
+
+def test_no_duplicates_without_waste_budget(clock):
+    queue = WorkQueue(waste_budget=0., initial_lease=1.)
+    queue.add('policy', make_job(0))
+    queue.pop(1, 'w1', 'e0', 'm0')
+    clock.now += 100.
+    assert queue.pop(1, 'w2', 'e0', 'm0') == []
+
+def test_completion_cancels_the_other_copies(clock):
+    queue = WorkQueue(waste_budget=1., initial_lease=1.)
+    job = make_job(0)
+    queue.add('policy', job)
+    queue.pop(1, 'w1', 'e0', 'm0')
+    clock.now += 100.
+    queue.pop(1, 'w2', 'e0', 'm0')
+
+    assert queue.complete(0, 'w2') == ('policy', job)
+    assert 0 not in queue
+    assert queue.take_cancelled('w1') == [0]
+    assert queue.take_cancelled('w1') == []
+    assert queue.cancellations == 1
+    # The late result of the first worker is ignored
+    assert queue.complete(0, 'w1') is None
+
+def test_jobs_of_a_dead_worker_go_back_to_the_queue(clock):
+    queue = WorkQueue()
+    queue.add('policy', make_job(0))
+    queue.pop(1, 'w1', 'e0', 'm0')
+    assert queue.num_pending == 0
+    queue.release_worker('w1')
+    assert queue.num_pending == 1
+    assert [job.id for job in queue.pop(1, 'w2', 'e0', 'm0')] == [0]
+    assert queue.speculative == 0
@@ -11,10 +11,14 @@ extend 3DB.
 """
 import argparse
 import importlib
+import json
 import sys
 import time
+from collections import deque
+from os import path
+from threading import Condition, Thread
 from types import SimpleNamespace
-from typing import Any, Optional, Type, Dict
+from typing import Any, Callable, Optional, Type, Dict, List, Set, Deque, Tuple
 from uuid import uuid4
 
 import numpy as np
@@ -23,6 +27,9 @@ import zmq
 from tqdm import tqdm
 
 from threedb.rendering.utils import ControlsApplier
+from threedb.scheduling.protocol import ChannelEncoding, JobCodec
+from threedb.scheduling.render_cache import load_entry
+from threedb.scheduling.shared_ring import SharedRing
 from threedb.rendering.base_renderer import BaseRenderer
 from threedb.evaluators.base_evaluator import BaseEvaluator
 from threedb.utils import load_inference_model
@@ -35,22 +42,22 @@ def send_array(sock: zmq.Socket,
                flags: int=0,
                copy: bool=True,
                track: bool=False):
-    """send a numpy array with metadata"""
+    """send the raw content of a numpy array, the master knows its shape and
+    dtype from the declared outputs"""
     if ch.is_tensor(arr):
         arr = arr.data.cpu().numpy()
     arr = np.ascontiguousarray(arr)
     if dtype is not None:
-        arr = arr.astype(dtype)
-    message_dict = dict(
-        dtype=str(arr.dtype),
-        shape=arr.shape,
-    )
-    sock.send_json(message_dict, flags | zmq.SNDMORE)
+        arr = arr.astype(dtype, copy=False)
     return sock.send(arr, flags, copy=copy, track=track)
 
 def query(sock: zmq.Socket, kind: str, worker_id: str, 
-          result_data: Optional[Dict[str, Any]] = None,
+          result_data: Optional[List[Dict[str, Any]]] = None,
           result_dtypes: Optional[Dict[str, str]] = None,
+          channels: Optional[List[str]] = None,
+          encodings: Optional[Dict[str, ChannelEncoding]] = None,
+          exit_on_die: bool = True,
+          timeout: Optional[float] = None,
           **kwargs) -> Dict[str, Any]:
     """Send a request back to the server and receive a response. Additional
     named arguments are forwarded to the server as-is as part of the request.
@@ -60,19 +67,35 @@ def query(sock: zmq.Socket, kind: str, worker_id: str,
     sock : zmq.Socket
         An open socket connected to the same port as the server.
     kind : str
-        What kind of request to send (``'info'``, ``'push'``, ``'pull'``, or
-        ``'decl'``)
+        What kind of request to send (``'info'``, ``'push'``, ``'pull'``,
+        ``'decl'`` or ``'heartbeat'``)
     worker_id : str
         The id of the client sending the request
-    result_data : Optional[Dict[str, Any]], optional
-        If ``kind == 'push'``, this should be a dictionary of results to send
-        back to the server (otherwise ignored), by default None.
+    result_data : Optional[List[Dict[str, Any]]], optional
+        If ``kind == 'push'``, this should be a list of dictionaries of
+        results to send back to the server (otherwise ignored), by default
+        None. The ids of the corresponding jobs are passed in ``jobs``.
+    result_dtypes : Optional[Dict[str, str]], optional
+        The dtype to send each channel of the results as.
+    channels : Optional[List[str]], optional
+        The order in which to send the channels of the results, as given by
+        the master in response to the ``'decl'`` request.
+    encodings : Optional[Dict[str, ChannelEncoding]], optional
+        How to encode some of the channels of the results, also given by the
+        master in response to the ``'decl'`` request.
+    exit_on_die : bool, optional
+        Whether to exit the process if the server tells us to stop, by
+        default True. Otherwise the ``'die'`` response is returned.
+    timeout : Optional[float], optional
+        How long (in seconds) to wait for the response before giving up on
+        the server and raising a ``TimeoutError``, by default forever.
 
     Returns
     -------
     Dict[str, Any]
         The response from the server for to the sent message; see `here <extending.html#the-3db-workflow>`_ for
-        documentation of the communication protocol,
+        documentation of the communication protocol. Raw frames following
+        the response (e.g. the encoded jobs) are in ``response['frames']``.
     """            
     to_send = {
         'kind': kind,
@@ -81,35 +104,324 @@ def query(sock: zmq.Socket, kind: str, worker_id: str,
     }
 
     if result_data is not None:
-        result_keys = list(result_data.keys())
-        to_send['result_keys'] = result_keys
-
+        # The results are sent one after the other in the same message, with
+        # one frame per channel in the order given by the master
         sock.send_json(to_send, flags=zmq.SNDMORE)
-        for channel_name in result_keys:
-            send_array(sock,
-                       result_data[channel_name],
-                       result_dtypes.get(channel_name, None),
-                       flags=zmq.SNDMORE)
+        for result in result_data:
+            for channel_name in channels:
+                if encodings is not None and channel_name in encodings:
+                    value = result[channel_name]
+                    if ch.is_tensor(value):
+                        value = value.data.cpu().numpy()
+                    sock.send(encodings[channel_name].encode(np.asarray(value)),
+                              flags=zmq.SNDMORE)
+                else:
+                    send_array(sock,
+                               result[channel_name],
+                               result_dtypes.get(channel_name, None),
+                               flags=zmq.SNDMORE)
         sock.send_string('done')
     else:
         sock.send_json(to_send, flags=0)
 
-    response = sock.recv_pyobj()
-    if kind == 'decl':
-        assert response['kind'] == 'ack', 'Received a non-ack message from the server, abort.'
-        
-    if response['kind'] == 'die':
+    if timeout is not None and not sock.poll(timeout * 1000):
+        raise TimeoutError(f'No response from the server after {timeout}s')
+    frames = sock.recv_multipart()
+    response = json.loads(frames[0])
+    if len(frames) > 1:
+        response['frames'] = frames[1:]
+    if response['kind'] == 'die' and exit_on_die:
         print("==> [Received closed request from master]")
         sys.exit()
     return response
 
+class JobPrefetcher(Thread):
+    """Talks to the master on behalf of the rendering loop, with its own
+    socket, so that the renderer never waits on the network:
+
+    - it keeps at least ``prefetch`` jobs ready locally, pulling more in the
+      background;
+    - results handed to :meth:`push` are sent while the next job renders,
+      up to ``batch_size`` of them in a single message;
+    - when there is nothing else to send, it sends a heartbeat every
+      ``heartbeat_interval`` seconds.
+
+    When the master has no job for us, we only ask again once the rendering
+    loop is idle; the master then holds the request (for up to ``long_poll``
+    seconds) until it has jobs to give.
+
+    When the worker runs on the same machine as the master, the results can
+    be written in a shared ring (see
+    :class:`threedb.scheduling.shared_ring.SharedRing`) instead of being sent;
+    only their slot goes through the socket. Results are sent normally when
+    all the slots are in use.
+
+    The jobs the master found in the render cache come with their key in the
+    cache, kept until the rendering loop asks for it (:meth:`take_cache_key`).
+    The master is told which results were read from the cache.
+
+    The jobs the master reports as already completed by another worker are
+    collected in ``cancelled`` so the rendering loop can skip them. The time
+    the rendering loop spends waiting for a job is accumulated in
+    ``idle_time`` and reported to the master.
+
+    When the result buffer of the master is full, it holds our pushes, for
+    a while, and then tells us to hold our results (``hold`` in its replies):
+    they are kept here, while we still ask for jobs and send heartbeats,
+    until a reply comes without ``hold``. The master never holds a request
+    for more than its own long poll timeout, so this does not trip
+    ``master_timeout``.
+
+    If the master does not answer a request within ``master_timeout``
+    seconds (on top of the time it may hold it), it is considered gone:
+    ``lost`` is set and the rendering loop is told to stop, as if the master
+    had sent ``die``.
+
+    When the master runs several experiments, every request names the
+    ``experiment`` we serve. The master can send us to another one, in which
+    case ``switch_to`` is set and the rendering loop is told to stop.
+    """
+    def __init__(self, context: zmq.Context, address: str, worker_id: str,
+                 batch_size: int, prefetch: int, heartbeat_interval: float,
+                 result_dtypes: Dict[str, str], channels: List[str],
+                 encodings: Dict[str, ChannelEncoding], codec: JobCodec,
+                 ring: Optional[SharedRing] = None, long_poll: float = 10.,
+                 master_timeout: Optional[float] = None,
+                 experiment: Optional[str] = None) -> None:
+        super().__init__(daemon=True)
+        self.context = context
+        self.address = address
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.prefetch = max(1, prefetch)
+        self.heartbeat_interval = heartbeat_interval
+        self.result_dtypes = result_dtypes
+        self.channels = channels
+        self.encodings = encodings
+        self.codec = codec
+        self.ring = ring
+        self.long_poll = long_poll
+        self.master_timeout = master_timeout
+        self.experiment = {} if experiment is None else {'experiment': experiment}
+
+        self.condition = Condition()
+        self.jobs: Deque[Any] = deque()
+        self.results: Deque[Tuple[Any, Dict[str, Any]]] = deque()
+        self.cancelled: Set[int] = set()
+        # The keys in the render cache sent along with some of the jobs, by
+        # job id, and the jobs whose renders we read from the cache
+        self.cache_keys: Dict[int, str] = {}
+        self.from_cache: Set[int] = set()
+        self.dead = False
+        self.lost = False
+        self.switch_to: Optional[str] = None
+        # Whether the master told us to hold our results
+        self.held = False
+        # Whether the rendering loop is waiting for a job
+        self.waiting = False
+        # Slots of the ring the master is done with
+        self.free_slots: Deque[int] = deque(range(ring.num_slots) if ring is not None else ())
+
+        # The environment/model the rendering loop has loaded
+        self.last_env: Optional[str] = None
+        self.last_model: Optional[str] = None
+
+        self.start_time = time.time()
+        self.idle_time = 0.
+
+    def next_job(self) -> Optional[Any]:
+        """Returns the next job to render (waiting if none is ready), or
+        ``None`` if the master told us to stop.
+        """
+        waiting_since = time.time()
+        with self.condition:
+            while True:
+                while self.jobs and self.jobs[0].id in self.cancelled:
+                    # Someone else already rendered it
+                    skipped = self.jobs.popleft().id
+                    self.cancelled.discard(skipped)
+                    self.cache_keys.pop(skipped, None)
+                if self.jobs or self.dead:
+                    break
+                self.waiting = True
+                self.condition.notify_all()
+                self.condition.wait()
+            self.waiting = False
+            job = self.jobs.popleft() if self.jobs else None
+            self.condition.notify_all()
+        self.idle_time += time.time() - waiting_since
+        return job
+
+    def take_cache_key(self, job_id: int) -> Optional[str]:
+        """The key in the render cache the master sent along with a job, if
+        it found the job there.
+        """
+        with self.condition:
+            return self.cache_keys.pop(job_id, None)
+
+    def push(self, job: Any, data: Dict[str, Any], from_cache: bool = False) -> None:
+        """Queues the result of a job to be sent to the master, telling it
+        whether its renders were read from the render cache.
+        """
+        with self.condition:
+            if from_cache:
+                self.from_cache.add(job.id)
+            slot = self.free_slots.popleft() if self.free_slots else None
+        if slot is not None:
+            self.ring.write(slot, data)
+            data = slot
+        with self.condition:
+            self.results.append((job, data))
+            self.condition.notify_all()
+
+    def take_jobs(self) -> List[Any]:
+        """Returns all the jobs ready without waiting, for a relay handing
+        them to its own workers (see :mod:`threedb.relay`) instead of
+        rendering them one by one with :meth:`next_job`.
+        """
+        with self.condition:
+            jobs = [job for job in self.jobs if job.id not in self.cancelled]
+            self.jobs.clear()
+            self.cancelled.clear()
+            self.condition.notify_all()
+        return jobs
+
+    def want(self, num_jobs: int, wait: float) -> None:
+        """Changes how many jobs to keep ready (possibly none), and how long
+        the master can hold our requests for jobs when it has none (0 to be
+        answered right away).
+        """
+        with self.condition:
+            self.prefetch = num_jobs
+            self.waiting = wait > 0
+            self.long_poll = wait
+            self.condition.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'idle_time': self.idle_time,
+            'uptime': time.time() - self.start_time
+        }
+
+    def run(self) -> None:
+        sock = self.context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.address)
+        try:
+            self.talk(sock)
+        except TimeoutError:
+            with self.condition:
+                self.lost = True
+                self.dead = True
+                self.condition.notify_all()
+        sock.close()
+
+    def talk(self, sock: zmq.Socket) -> None:
+        """Exchanges messages with the master until it tells us to stop"""
+        timeout = None
+        if self.master_timeout is not None:
+            timeout = self.master_timeout + self.long_poll
+        last_message = time.time()
+        # Whether the master had nothing for us the last time we asked
+        starved = False
+
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    # Nothing can happen on our side until the master sends
+                    # us something, we can let it hold our request
+                    long_poll = self.waiting and not self.jobs and not self.results
+                    need_jobs = len(self.jobs) < self.prefetch and (not starved or long_poll)
+                    heartbeat_due = now - last_message >= self.heartbeat_interval
+                    # Group results together unless nothing else is coming
+                    push_due = not self.held and (len(self.results) >= self.batch_size or
+                                                  (self.results and (not self.jobs or heartbeat_due)))
+                    if push_due or need_jobs or heartbeat_due:
+                        break
+                    self.condition.wait(self.heartbeat_interval - (now - last_message))
+                to_push = []
+                cache_args = {}
+                if push_due:
+                    while self.results and len(to_push) < self.batch_size:
+                        to_push.append(self.results.popleft())
+                    from_cache = [job.id for (job, _) in to_push if job.id in self.from_cache]
+                    if from_cache:
+                        cache_args['from_cache'] = from_cache
+                        self.from_cache.difference_update(from_cache)
+                if self.jobs:
+                    last_job = self.jobs[-1]
+                    last_env, last_model = last_job.environment, last_job.model
+                else:
+                    last_env, last_model = self.last_env, self.last_model
+
+            if to_push:
+                # Our results may let the policies post new jobs
+                starved = False
+                ring_args = {}
+                if self.ring is not None:
+                    ring_args['ring'] = self.ring.describe()
+                    ring_args['slots'] = [data if isinstance(data, int) else None
+                                          for (_, data) in to_push]
+                response = query(sock, 'push', self.worker_id,
+                                 result_data=[data for (_, data) in to_push
+                                              if not isinstance(data, int)],
+                                 result_dtypes=self.result_dtypes,
+                                 channels=self.channels,
+                                 encodings=self.encodings,
+                                 jobs=[job.id for (job, _) in to_push],
+                                 exit_on_die=False, timeout=timeout, **self.experiment, **ring_args,
+                                 **cache_args, **self.stats())
+            elif need_jobs:
+                response = query(sock, 'pull', self.worker_id,
+                                 batch_size=self.batch_size,
+                                 last_environment=last_env,
+                                 last_model=last_model,
+                                 wait=self.long_poll if long_poll else 0,
+                                 exit_on_die=False, timeout=timeout, **self.experiment, **self.stats())
+            else:
+                response = query(sock, 'heartbeat', self.worker_id,
+                                 exit_on_die=False, timeout=timeout, **self.experiment, **self.stats())
+            last_message = time.time()
+
+            with self.condition:
+                if response['kind'] == 'switch':
+                    self.switch_to = response['experiment']
+                if response['kind'] in ('die', 'switch'):
+                    self.dead = True
+                    self.condition.notify_all()
+                    return
+                self.held = response.get('hold', False)
+                self.cancelled.update(response.get('cancelled', ()))
+                self.free_slots.extend(response.get('released', ()))
+                if response['kind'] == 'work':
+                    parameters = self.codec.decode(response, response['frames'])
+                    self.cache_keys.update(self.codec.decode_cache_keys(response))
+                    starved = len(parameters) == 0
+                    self.jobs.extend(parameters)
+                self.condition.notify_all()
+
+def reuse_or_build(state: Dict[str, Tuple[Any, Any]], name: str, args: Any,
+                   build: Callable[[], Any]) -> Any:
+    """Returns the object stored under ``name`` in ``state`` if it was built
+    from the same ``args``, otherwise builds (and stores) a new one. This is
+    how a worker in daemon mode keeps its renderer and inference model
+    between experiments.
+    """
+    if name in state and state[name][0] == args:
+        return state[name][1]
+    value = build()
+    state[name] = (args, value)
+    return value
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Render worker for the robustness threedb')
     parser.add_argument('root_folder', type=str,
                         help='folder containing all data (models, environments, etc)')
     parser.add_argument('--master-address', '-a', type=str,
-                        help='How to contact the master node',
+                        help='How to contact the master node (host:port, or a full address '
+                             'such as ipc:///tmp/threedb.ipc for a master on the same machine)',
                         default='localhost:5555')
     parser.add_argument('--gpu-id', help='The GPU to use to render (-1 for cpu)',
                         default=-1, type=int,)
@@ -119,6 +431,23 @@ if __name__ == '__main__':
                         default=32, type=int)
     parser.add_argument('--batch-size', help='How many task to ask for in a batch',
                         default=1, type=int)
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='How many jobs to keep ready while rendering')
+    parser.add_argument('--heartbeat-interval', type=float, default=10,
+                        help='Seconds between two heartbeats sent to the master')
+    parser.add_argument('--long-poll', type=float, default=10,
+                        help='How long (in seconds) the master can hold a request for jobs when idle')
+    parser.add_argument('--ring-slots', type=int, default=8,
+                        help='Size of the shared memory ring results are handed over in '
+                             'when connected over ipc:// (0 to always send them)')
+    parser.add_argument('--master-timeout', type=float, default=300,
+                        help='Seconds without an answer from the master before considering it gone '
+                             '(a master with a full result buffer answers, telling us to hold our results)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running once the master is done, and serve the next master '
+                             'started on the same address (keeping the loaded models when possible)')
+    parser.add_argument('--reattach-interval', type=float, default=5,
+                        help='In daemon mode, seconds between two attempts to join the next master')
     parser.add_argument('--fake-results', action='store_true',
                         help='Always return the same result regardless of the parameters'
                              '\n useful to debug and produce large amount of data quickly')
@@ -133,90 +462,180 @@ if __name__ == '__main__':
     print(args)
 
     context = zmq.Context()
-    print(f"Connecting to server ({args.master_address})...")
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://" + args.master_address)
+    master_address = args.master_address
+    if '://' not in master_address:
+        master_address = "tcp://" + master_address
 
     WORKER_ID = str(uuid4())
-    LAST_RESULT = []  # This is used to store the first render when --fake-result is set
-    # while True:
-    infos = query(socket, 'info', WORKER_ID)
-    render_args = infos['render_args']
-
-    rendering_class: Type[BaseRenderer] = getattr(importlib.import_module(render_args['engine']), 'Renderer')
-    rendering_engine: BaseRenderer = rendering_class(args.root_folder, {**render_args, **vars(args)})
-
-    evaluation_args = infos['evaluation_args']
-    evaluator_class = getattr(importlib.import_module(evaluation_args['module']), 'Evaluator')
-    evaluator: BaseEvaluator = evaluator_class(**infos['evaluation_args']['args'])
-
-    # Gather all experiment-wide parameters
-    inference_args = infos['inference']
-    controls_args = infos['controls_args']
-    inference_model = load_inference_model(inference_args)
-
+    # What we built for the previous experiments (daemon mode), reused when
+    # the next one has the same settings
+    state: Dict[str, Tuple[Any, Any]] = {}
+    rendering_engine: Optional[BaseRenderer] = None
     last_env = None
     last_model = None
+    # The uid of every model we loaded, so that the jobs found in the render
+    # cache can be evaluated without loading their scene
+    model_uids: Dict[str, str] = {}
+    # The experiment we serve, when the master runs several of them
+    experiment = None
 
     pbar = tqdm(smoothing=0)
 
-    image_shapes = rendering_engine.declare_outputs()
-    assert set(image_shapes.keys()).issubset(rendering_class.KEYS), \
-        'Return value of declare_outputs() should match the declared KEYS var'
-    eval_shapes = evaluator.declare_outputs()
-    assert set(eval_shapes.keys()).issubset(evaluator_class.KEYS), \
-        'Return value of declare_outputs() should match the declared KEYS var'
-    declared_outputs = {
-        **image_shapes,
-        **eval_shapes,
-    }
-    query(socket, 'decl', WORKER_ID, declared_outputs=declared_outputs)
-
-    # These will be assigned in the if statement below
-    model_uid = ''
     while True:
-        job_description = query(socket, 'pull', WORKER_ID,
-                                batch_size=args.batch_size,
-                                last_environment=last_env,
-                                last_model=last_model)
-        parameters = job_description['params_to_render']
-
-        if len(parameters) == 0:
-            print("Nothing to do!", 'sleeping')
-            time.sleep(1)
+        print(f"Connecting to server ({master_address})...")
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(master_address)
+
+        LAST_RESULT = []  # This is used to store the first render when --fake-result is set
+        experiment_args = {} if experiment is None else {'experiment': experiment}
+        infos = query(socket, 'info', WORKER_ID, exit_on_die=not args.daemon, **experiment_args)
+        if infos['kind'] == 'die':
+            # The previous master is still shutting down
+            socket.close()
+            time.sleep(args.reattach_interval)
             continue
-
-        for job in parameters:
+        render_args = infos['render_args']
+        experiment = infos.get('experiment')
+        experiment_args = {} if experiment is None else {'experiment': experiment}
+
+        rendering_class: Type[BaseRenderer] = getattr(importlib.import_module(render_args['engine']), 'Renderer')
+        previous_engine = rendering_engine
+        rendering_engine = reuse_or_build(state, 'renderer', render_args,
+                                          lambda: rendering_class(args.root_folder, {**render_args, **vars(args)}))
+        if rendering_engine is not previous_engine:
+            last_env, last_model = None, None
+            model_uids = {}
+        # The master sends the key of the jobs found in its render cache if
+        # we can read it
+        cache_dir = infos.get('render_cache')
+        reads_cache = cache_dir is not None and path.isdir(cache_dir)
+
+        evaluation_args = infos['evaluation_args']
+        evaluator_class = getattr(importlib.import_module(evaluation_args['module']), 'Evaluator')
+        evaluator: BaseEvaluator = reuse_or_build(state, 'evaluator', evaluation_args,
+                                                  lambda: evaluator_class(**evaluation_args['args']))
+
+        # Gather all experiment-wide parameters
+        inference_args = infos['inference']
+        controls_args = infos['controls_args']
+        inference_model = reuse_or_build(state, 'inference', inference_args,
+                                         lambda: load_inference_model(inference_args))
+
+        image_shapes = rendering_engine.declare_outputs()
+        assert set(image_shapes.keys()).issubset(rendering_class.KEYS), \
+            'Return value of declare_outputs() should match the declared KEYS var'
+        eval_shapes = evaluator.declare_outputs()
+        assert set(eval_shapes.keys()).issubset(evaluator_class.KEYS), \
+            'Return value of declare_outputs() should match the declared KEYS var'
+        declared_outputs = {
+            **image_shapes,
+            **eval_shapes,
+        }
+        session = query(socket, 'decl', WORKER_ID, declared_outputs=declared_outputs,
+                        render_cache=reads_cache, exit_on_die=not args.daemon,
+                        **experiment_args)
+        socket.close()
+        # Our experiment may be over (or we were moved to another one) since
+        # we asked for its settings, in which case we start over
+        if session['kind'] == 'switch':
+            print(f"==> [Switching to experiment {session['experiment']}]")
+            experiment = session['experiment']
+            continue
+        if session['kind'] == 'die':
+            # The master is shutting down, we wait for the next one
+            experiment = None
+            print("==> [Waiting for the next experiment]")
+            time.sleep(args.reattach_interval)
+            continue
+        assert session['kind'] == 'ack', 'Received a non-ack message from the server, abort.'
+        result_dtypes = {k: v[1] for (k, v) in declared_outputs.items()}
+        # The master sends the jobs in a compact form; everything needed to
+        # decode them comes once, now.
+        codec = JobCodec(session['jobs'])
+        encodings = {channel: ChannelEncoding(**description)
+                     for (channel, description) in session['encodings'].items()}
+        # Only a master on the same machine can read our shared memory
+        ring = None
+        if master_address.startswith('ipc://') and args.ring_slots > 0:
+            ring = SharedRing(session['channels'], declared_outputs, args.ring_slots)
+
+        # From now on all the communication with the master happens in the
+        # background
+        prefetcher = JobPrefetcher(context, master_address, WORKER_ID,
+                                   args.batch_size, args.prefetch,
+                                   args.heartbeat_interval, result_dtypes,
+                                   session['channels'], encodings, codec, ring,
+                                   args.long_poll, args.master_timeout, experiment)
+        # The master prefers giving us jobs for the scene we still have loaded
+        prefetcher.last_env, prefetcher.last_model = last_env, last_model
+        prefetcher.start()
+        # Jobs we hold that another worker completed first
+        cancelled = prefetcher.cancelled
+
+        while True:
+            job = prefetcher.next_job()
+            if job is None:
+                if prefetcher.switch_to is not None:
+                    print(f"==> [Switching to experiment {prefetcher.switch_to}]")
+                elif prefetcher.lost:
+                    print("==> [Lost the connection to the master]")
+                else:
+                    print("==> [Received closed request from master]")
+                if ring is not None:
+                    ring.close()
+                break
+
+            # Rendered by an earlier experiment (see
+            # threedb.scheduling.render_cache): only inference and evaluation
+            # are left to do, without loading the scene if we already know
+            # the uid of the model
+            cached_render = None
+            cache_key = prefetcher.take_cache_key(job.id)
             if LAST_RESULT:
                 data = LAST_RESULT[0]
             else:
                 current_env = job.environment
                 current_model = job.model
 
+                if cache_key is not None:
+                    cached_render = load_entry(cache_dir, cache_key, image_shapes)
+
                 # We reload model and env if we got assigned to something
                 # different this time
-                if current_env != last_env or current_model != last_model:
+                needs_scene = cached_render is None or current_model not in model_uids
+                if needs_scene and (current_env != last_env or current_model != last_model):
                     print("==> [Loading new environment/model pair]")
                     loaded_env = rendering_engine.load_env(current_env)
                     loaded_model = rendering_engine.load_model(current_model)
-                    model_uid = rendering_engine.get_model_uid(loaded_model)
+                    model_uids[current_model] = rendering_engine.get_model_uid(loaded_model)
                     rendering_engine.setup_render(loaded_model, loaded_env)
                     last_env = current_env
                     last_model = current_model
-
-                controls_applier = ControlsApplier(job.control_order,
-                                                job.render_args,
-                                                controls_args,
-                                                args.root_folder)
-
-                scalar_label = evaluator.get_segmentation_label(model_uid)
-                render_context = rendering_engine.get_context_dict(model_uid, scalar_label)
-                controls_applier.apply_pre_controls(render_context)
-                result = rendering_engine.render(model_uid,
-                                                 loaded_model,
-                                                 loaded_env)
-                result['rgb'] = controls_applier.apply_post_controls(result['rgb'])
-                controls_applier.unapply(render_context)
+                    prefetcher.last_env, prefetcher.last_model = last_env, last_model
+                model_uid = model_uids[current_model]
+
+                if cached_render is not None:
+                    result = {channel: ch.from_numpy(np.array(arr))
+                              for (channel, arr) in cached_render.items()}
+                else:
+                    controls_applier = ControlsApplier(job.control_order,
+                                                    job.render_args,
+                                                    controls_args,
+                                                    args.root_folder)
+
+                    scalar_label = evaluator.get_segmentation_label(model_uid)
+                    render_context = rendering_engine.get_context_dict(model_uid, scalar_label)
+                    controls_applier.apply_pre_controls(render_context)
+                    result = rendering_engine.render(model_uid,
+                                                     loaded_model,
+                                                     loaded_env)
+                    result['rgb'] = controls_applier.apply_post_controls(result['rgb'])
+                    controls_applier.unapply(render_context)
+
+                if job.id in cancelled:
+                    cancelled.discard(job.id)
+                    continue  # No need to run inference either
 
                 with ch.no_grad():
                     result['rgb'] = result['rgb'][:3]
@@ -236,7 +655,16 @@ if __name__ == '__main__':
                 if args.fake_results:
                     LAST_RESULT.append(data)
 
-            result_dtypes = {k: v[1] for (k, v) in declared_outputs.items()}
-            query(socket, 'push', WORKER_ID, result_data=data,
-                  result_dtypes=result_dtypes, job=job.id)
+            prefetcher.push(job, data, from_cache=cached_render is not None)
+            stats = prefetcher.stats()
+            pbar.set_postfix({'idle%': 100 * stats['idle_time'] / max(1e-10, stats['uptime'])},
+                             refresh=False)
             pbar.update(1)
+
+        prefetcher.join()
+        experiment = prefetcher.switch_to
+        if experiment is not None:
+            continue
+        if not args.daemon:
+            break
+        print("==> [Waiting for the next experiment]")
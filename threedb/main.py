@@ -18,23 +18,28 @@ os.environ["NUMEXPR_NUM_THREADS"] = "1"
 
 import argparse
 import importlib
+import inspect
 import json
 from pathlib import Path
 from collections import defaultdict
-from itertools import product
 from os import makedirs, path
 
 import torch as ch
 import yaml
-from tqdm import tqdm
 
+from threedb.result_logging.cache_logger import CacheLogger
 from threedb.result_logging.logger_manager import LoggerManager
 from threedb.scheduling.base_scheduler import Scheduler
+from threedb.scheduling.fair_share import FairShareScheduler
 from threedb.rendering.base_renderer import BaseRenderer
-from threedb.scheduling.policy_controller import PolicyController
+from threedb.scheduling.journal import load_results
+from threedb.scheduling.policy_controller import (POLICY_REGID, PolicyController, PolicyPool,
+                                                   register_policies)
+from threedb.scheduling.render_cache import RenderCache
 from threedb.scheduling.search_space import SearchSpace
+from threedb.scheduling.utils import bind_socket
 from threedb.utils import CyclicBuffer, init_control
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, List, Any, Optional, Tuple
 
 parser = argparse.ArgumentParser(
     description='Run a 3DB experiment')
@@ -50,6 +55,33 @@ parser.add_argument('--single-model', action='store_true',
                     help='If given, only do one model and one environment (for debugging)')
 parser.add_argument('--max-concurrent-policies', '-m', type=int, default=10,
                     help='Maximum number of concurrent policies, can keep memory under control')
+parser.add_argument('--policy-processes', type=int, default=0,
+                    help='Run the policies as threads in this many processes (0 for one process per policy)')
+parser.add_argument('--policy-memory', type=float, default=None,
+                    help='Memory (in GB) the results held by the running policies can take (default: unlimited)')
+parser.add_argument('--buffer-memory', type=float, default=4.,
+                    help='Memory (or disk space with --buffer-dir, in GB) the results waiting for the policies and loggers can take')
+parser.add_argument('--buffer-dir', type=str, default=None,
+                    help='Keep the result buffer in this directory (e.g. on a local SSD) instead of memory, '
+                         'its results are then recovered with --resume if the master dies')
+parser.add_argument('--waste-budget', type=float, default=0.05,
+                    help='Maximum fraction of renders that can be speculative duplicates of slow jobs')
+parser.add_argument('--lease-factor', type=float, default=3.,
+                    help='How many times the expected render time a worker has to return a job')
+parser.add_argument('--initial-lease', type=float, default=120.,
+                    help='Expected render time (in seconds) before any job of a model/environment pair completed')
+parser.add_argument('--worker-timeout', type=float, default=60.,
+                    help='Seconds without hearing from a worker before its jobs are handed to others')
+parser.add_argument('--ipc-path', type=str, default=None,
+                    help='Also listen on this unix socket (ipc://<path>) for workers on the same machine')
+parser.add_argument('--render-cache', type=str, default=None,
+                    help='Directory of a render cache shared between experiments: the workers that can read it '
+                         '(at the same path) only run inference and evaluation on the renders stored there')
+parser.add_argument('--render-cache-size', type=float, default=100.,
+                    help='Size (in GB) above which the least recently used renders are evicted from the render cache')
+parser.add_argument('--resume', action='store_true',
+                    help='Resume an experiment from the results in output_dir (the policy has to be deterministic: '
+                         'the seed drawn for a policy left unseeded is kept in output_dir)')
 
 DEFAULT_RENDER_ARGS = {
     'engine': 'threedb.rendering.render_blender',
@@ -80,10 +112,64 @@ def load_config(fpath: str) -> Dict[str, Any]:
         else:
             return config
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    config = load_config(args.config_file)
+def seed_policy(policy_class: Any, policy_config: Dict[str, Any], logging_root: str,
+                resume: bool) -> None:
+    """Draws a seed for a policy that takes one but has none in the config,
+    and records it in the output directory: resuming reads it back, so that
+    the policy issues the same jobs again.
+
+    Parameters
+    ----------
+    policy_class : Any
+        The ``Policy`` of the policy module.
+    policy_config : Dict[str, Any]
+        The ``policy`` section of the config, the seed is added to it.
+    logging_root : str
+        The output directory of the experiment.
+    resume : bool
+        Whether the experiment is resumed (``--resume``).
+    """
+    if policy_config.get('seed') is not None or \
+            'seed' not in inspect.signature(policy_class).parameters:
+        return
+    seed_path = path.join(logging_root, 'policy_seed.json')
+    if resume:
+        assert path.exists(seed_path), \
+            f'Cannot resume an unseeded policy without the seed it drew ({seed_path})'
+        with open(seed_path) as handle:
+            policy_config['seed'] = json.load(handle)['seed']
+    else:
+        policy_config['seed'] = int.from_bytes(os.urandom(8), 'little')
+        makedirs(logging_root, exist_ok=True)
+        with open(seed_path, 'w') as handle:
+            json.dump({'seed': policy_config['seed']}, handle)
+    print(f"==> [Policy seed: {policy_config['seed']}]")
+
+def setup_experiment(args: argparse.Namespace, config: Dict[str, Any], logging_root: str,
+                     socket: Optional[Any] = None,
+                     name: Optional[str] = None) -> Tuple[Scheduler, Callable[[], None]]:
+    """Sets up everything needed to run an experiment: its policies, result
+    buffer and loggers, and the scheduler handing its jobs to the workers.
 
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments of the master.
+    config : Dict[str, Any]
+        The config of the experiment (see :func:`load_config`).
+    logging_root : str
+        Where to store the output of its loggers.
+    socket : Optional[Any]
+        The socket to talk to the workers on, when several experiments share
+        it (by default the scheduler opens its own).
+    name : Optional[str]
+        The name of the experiment, when there are several.
+
+    Returns
+    -------
+    Tuple[Scheduler, Callable[[], None]]
+        The scheduler, and a function to call once it is done.
+    """
     print(config)
     assert 'policy' in config, 'Missing policy in config file'
     assert 'controls' in config, 'Missing control list in config file'
@@ -105,51 +191,143 @@ if __name__ == '__main__':
     controls_args = defaultdict(dict)
     for i, control in enumerate(controls):
         tpe = type(control)
-        name = f"{tpe.__name__}"
+        control_name = f"{tpe.__name__}"
         control_config = config['controls'][i]
         if 'args' not in control_config:
-            controls_args[name] = {} 
+            controls_args[control_name] = {} 
         else:
-            controls_args[name] = control_config['args']
+            controls_args[control_name] = control_config['args']
     config['controls'] = controls_args
 
     search_space = SearchSpace(controls)
     continuous_dim, discrete_sizes = search_space.generate_description()
 
     # Initialize the results buffer and register a single process
-    result_buffer: CyclicBuffer = CyclicBuffer()
-    policy_regid = result_buffer.register()  # Register a single policy for each output
-    assert policy_regid == 1
+    buffer_dir = None
+    if args.buffer_dir is not None:
+        buffer_dir = args.buffer_dir if name is None else path.join(args.buffer_dir, name)
+    result_buffer: CyclicBuffer = CyclicBuffer(memory_budget=args.buffer_memory * 2**30,
+                                               directory=buffer_dir)
+    # Register a single policy for each output, holding only what the
+    # policies read
+    policy_class = importlib.import_module(config['policy']['module']).Policy
+    policy_regid = register_policies(result_buffer, policy_class)
+    assert policy_regid == POLICY_REGID
+
+    # Resuming needs the policy to issue the same jobs again
+    seed_policy(policy_class, config['policy'], logging_root, args.resume)
 
     logger_manager = LoggerManager()
-    logging_root = args.output_dir
     for module_path in config['logging']['logger_modules']:
         logger_module = importlib.import_module(module_path).Logger
         logger_manager.append(logger_module(logging_root, result_buffer, config))
 
-    # Set up the policy controllers
-    policy_controllers = set()
-    for env, model in tqdm(list(product(all_envs, all_models)), desc="Init policies"):
-        env = env.split('/')[-1]
-        model = model.split('/')[-1]
-        policy_args = {
-            'continuous_dim': continuous_dim,
-            'discrete_sizes': discrete_sizes,
-            **config['policy']
-        }
-        controller = PolicyController(search_space, env, model, 
-                            policy_args, logger_manager, result_buffer)
-        policy_controllers.add(controller)
-        if args.single_model: 
-            break
-
-    print("==> [Starting the scheduler]")
-    s = Scheduler(args.port,
-                    args.max_concurrent_policies, 
-                    all_envs, 
-                    all_models,
-                    config,
-                    policy_controllers,
-                    result_buffer,
-                    logger_manager)
-    s.schedule_work()
+    if args.single_model:
+        all_envs, all_models = all_envs[:1], all_models[:1]
+
+    render_cache = None
+    if args.render_cache is not None:
+        render_cache = RenderCache(args.render_cache, args.render_cache_size * 2**30,
+                                   rendering_module.KEYS, config,
+                                   {env: rendering_module.get_env_path(args.root_folder, env)
+                                    for env in all_envs},
+                                   {model: rendering_module.get_model_path(args.root_folder, model)
+                                    for model in all_models})
+        logger_manager.append(CacheLogger(result_buffer, config, render_cache))
+
+    # When resuming, the results of the completed jobs are recovered from the
+    # JSON log, and from the result buffer if it was kept on disk. The
+    # (deterministic) policies issue the other jobs again
+    completed = {}
+    in_buffer = {}
+    if args.resume:
+        log_path = path.join(logging_root, 'details.log')
+        assert path.exists(log_path), \
+            f'Cannot resume without the JSON log {log_path} (threedb.result_logging.json_logger)'
+        completed = load_results(log_path)
+        recovered = set().union(*(results.keys() for results in completed.values()))
+        print(f"==> [Resuming with {len(recovered)} completed jobs]")
+        if buffer_dir is not None:
+            in_buffer = result_buffer.recover()
+            # The ones already in the JSON log are not logged again
+            for job_id in recovered.intersection(in_buffer):
+                result_buffer.free(in_buffer.pop(job_id), -1)
+            print(f"==> [{len(in_buffer)} more completed jobs found in the result buffer]")
+
+    # Set up the policy controllers, they are only created when the
+    # scheduler starts them
+    policy_args = {
+        'continuous_dim': continuous_dim,
+        'discrete_sizes': discrete_sizes,
+        **config['policy']
+    }
+    policy_pool = None
+    if args.policy_processes > 0:
+        policy_pool = PolicyPool(args.policy_processes, search_space,
+                                 policy_args, logger_manager, result_buffer,
+                                 completed)
+        policy_factory = policy_pool.create
+    else:
+        def policy_factory(env: str, model: str) -> PolicyController:
+            return PolicyController(search_space, env, model,
+                                    policy_args, logger_manager, result_buffer,
+                                    completed.get((env, model)))
+
+    scheduler = Scheduler(args.port,
+                          args.max_concurrent_policies,
+                          all_envs,
+                          all_models,
+                          config,
+                          policy_factory,
+                          result_buffer,
+                          logger_manager,
+                          search_space,
+                          waste_budget=args.waste_budget,
+                          lease_factor=args.lease_factor,
+                          initial_lease=args.initial_lease,
+                          worker_timeout=args.worker_timeout,
+                          ipc_path=args.ipc_path,
+                          memory_budget=None if args.policy_memory is None else args.policy_memory * 2**30,
+                          render_cache=render_cache,
+                          recovered=in_buffer,
+                          socket=socket,
+                          name=name)
+
+    def teardown() -> None:
+        if render_cache is not None:
+            print(f"==> [Render cache: {render_cache.hits} hits, {render_cache.misses} misses]")
+        if policy_pool is not None:
+            policy_pool.close()
+
+    return scheduler, teardown
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    config = load_config(args.config_file)
+
+    if 'experiments' not in config:
+        print("==> [Starting the scheduler]")
+        scheduler, teardown = setup_experiment(args, config, args.output_dir)
+        scheduler.schedule_work()
+        teardown()
+    else:
+        # Several experiments sharing the same workers, each with its own
+        # config and output directory
+        socket = bind_socket(args.port, args.ipc_path)
+        config_dir = Path(args.config_file).parent
+        schedulers, teardowns, weights, priorities = {}, [], {}, {}
+        for exp_name, description in config['experiments'].items():
+            output_dir = path.join(args.output_dir, description.get('output_dir', exp_name))
+            makedirs(output_dir, exist_ok=True)
+            exp_config = load_config(config_dir / description['config'])
+            schedulers[exp_name], teardown = setup_experiment(args, exp_config, output_dir,
+                                                              socket, exp_name)
+            teardowns.append(teardown)
+            weights[exp_name] = description.get('weight', 1.)
+            priorities[exp_name] = description.get('priority', 0)
+
+        print(f"==> [Starting the scheduler for {len(schedulers)} experiments]")
+        FairShareScheduler(socket, schedulers, weights, priorities,
+                           worker_timeout=args.worker_timeout).schedule_work()
+        for teardown in teardowns:
+            teardown()
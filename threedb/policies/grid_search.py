@@ -15,6 +15,9 @@ def chunks(lst, n):
 
 
 class GridSearchPolicy:
+    # The results of the renders are not used
+    RESULT_KEYS = []
+
     def __init__(self, continuous_dim, discrete_sizes, samples_per_dim):
         self.continuous_dim = continuous_dim
         self.discrete_sizes = discrete_sizes
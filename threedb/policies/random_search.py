@@ -10,6 +10,9 @@ import numpy as np
 from itertools import product
 
 class RandomSearchPolicy:
+    # The results of the renders are not used
+    RESULT_KEYS = []
+
     def __init__(self, continuous_dim, discrete_sizes, samples, seed=None):
         """
             Pick a total number of samples randomly
@@ -0,0 +1,302 @@
+"""
+threedb.relay
+=============
+
+A relay (or sub-master) sits between the master and a rack of workers, so
+that a single master socket can serve many more workers. To the master, the
+relay is one worker pulling large batches of jobs; to its workers, it is the
+master.
+
+The relay keeps the full results of its workers (images, depth, ...) in its
+own result buffer and logs them with its own loggers, in its own output
+directory. Only the compact results the policies need (by default the
+channels of the evaluator, e.g. ``is_correct`` and ``loss``) are sent
+upstream, which is what the master logs.
+
+Run it with ``python -m threedb.relay <output_dir> <port> --master-address
+<host:port>`` and point the workers of the rack at ``<port>``.
+"""
+import argparse
+import importlib
+import sys
+import time
+from os import makedirs
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import zmq
+
+from threedb.client import JobPrefetcher, query
+from threedb.result_logging.logger_manager import LoggerManager
+from threedb.scheduling.base_scheduler import Scheduler
+from threedb.scheduling.protocol import ChannelEncoding, JobCodec
+from threedb.scheduling.utils import bind_socket, recv_request, send_reply
+from threedb.utils import CyclicBuffer
+
+# Fields of the master's info reply that only concern the relay itself
+UPSTREAM_FIELDS = ['kind', 'experiment', 'frames']
+
+class UpstreamLink:
+    """
+    The jobs the relay got from the master, and the way back for their
+    results. The local scheduler uses it as the policy of every job it hands
+    out: when a result comes in (:meth:`push_result`), it is logged by the
+    loggers of the relay and its upstream channels are queued to be sent to
+    the master.
+    """
+
+    def __init__(self, prefetcher: JobPrefetcher, codec: JobCodec, channels: List[str],
+                 buffer: CyclicBuffer, regid: int, logger_manager: LoggerManager) -> None:
+        """
+        Parameters
+        ----------
+        prefetcher : JobPrefetcher
+            Talks to the master in the background.
+        codec : JobCodec
+            Decodes the jobs of the master, the workers of the relay get the
+            same schema.
+        channels : List[str]
+            The channels to send to the master.
+        buffer : CyclicBuffer
+            The result buffer of the relay.
+        regid : int
+            Our registration in ``buffer``.
+        logger_manager : LoggerManager
+            The loggers of the relay.
+        """
+        self.prefetcher = prefetcher
+        self.codec = codec
+        self.channels = channels
+        self.buffer = buffer
+        self.regid = regid
+        self.logger_manager = logger_manager
+        # The jobs handed to the local scheduler, by id
+        self.jobs: Dict[int, Any] = {}
+
+    def start(self) -> None:
+        self.prefetcher.start()
+
+    def take_jobs(self) -> List[Any]:
+        """The jobs received from the master since the last call"""
+        jobs = self.prefetcher.take_jobs()
+        self.jobs.update((job.id, job) for job in jobs)
+        return jobs
+
+    def want(self, num_jobs: int, wait: float) -> None:
+        """See :meth:`threedb.client.JobPrefetcher.want`"""
+        self.prefetcher.want(max(0, num_jobs), wait)
+
+    def push_result(self, job_id: int, result_ix: int) -> None:
+        job = self.jobs.pop(job_id)
+        data = {channel: self.buffer.view(result_ix, channel).copy() for channel in self.channels}
+        self.logger_manager.log({
+            **job._asdict(),
+            'result_ix': result_ix
+        })
+        self.buffer.free(result_ix, self.regid)
+        self.prefetcher.push(job, data)
+
+    def is_alive(self) -> bool:
+        """Whether the master still has work for us"""
+        return not self.prefetcher.dead
+
+
+class RelayScheduler(Scheduler):
+    """
+    A :class:`threedb.scheduling.base_scheduler.Scheduler` whose jobs come
+    from the master (through an :class:`UpstreamLink`) instead of policies.
+    It asks the master for enough jobs to keep ``backlog`` of them pending per
+    local worker, and is done once the master is. When the master has no job
+    for us and some of our workers are still rendering, the master holds our
+    requests for at most ``busy_poll`` seconds so that their results are not
+    held back.
+    """
+
+    def __init__(self, upstream: UpstreamLink, info: Dict[str, Any], config: Dict[str, Any],
+                 buffer: CyclicBuffer, logger_manager: LoggerManager, socket: zmq.Socket,
+                 backlog: int = 2, busy_poll: float = 0.05, **kwargs: Any) -> None:
+        super().__init__(None, 1, info['environments'], info['models'], config, None,
+                         buffer, logger_manager, upstream.codec.search_space,
+                         socket=socket, **kwargs)
+        # The workers decode the jobs exactly as we got them
+        self.job_codec = upstream.codec
+        self.upstream = upstream
+        self.backlog = backlog
+        self.busy_poll = busy_poll
+        # The master is our only policy
+        self.num_policies = 1
+        self.policies_pb.reset(total=1)
+
+    def start(self, identity: bytes, declared_outputs):
+        first = not self.running
+        super().start(identity, declared_outputs)
+        if first:
+            self.upstream.start()
+            self.started_policies = 1
+            self.running_policies.add(self.upstream)
+
+    def refill_work_queue(self) -> None:
+        if self.upstream not in self.running_policies:
+            return
+        for job in self.upstream.take_jobs():
+            self.work_queue.add(self.upstream, job)
+        self.admission.measure(self.work_queue.dispatched)
+        wanted = self.backlog * max(1, len(self.linked_workers))
+        # While the master holds a request we cannot send results: it can
+        # only hold it for long if none can come in, otherwise we poll
+        wait = 0.
+        if self.parked_pulls:
+            wait = self.busy_poll if len(self.work_queue) else self.long_poll_timeout
+        self.upstream.want(wanted - self.work_queue.num_pending, wait)
+
+    def finish(self):
+        if self.upstream.prefetcher.switch_to is not None:
+            print(f"==> [The master moved us to experiment {self.upstream.prefetcher.switch_to}, "
+                  "a relay only serves one experiment]")
+        elif self.upstream.prefetcher.lost:
+            print("==> [Lost the connection to the master]")
+        super().finish()
+
+
+def upstream_outputs(declared_outputs: Dict[str, Tuple[List[int], str]],
+                     info: Dict[str, Any],
+                     channels: Optional[List[str]] = None) -> Dict[str, Tuple[List[int], str]]:
+    """The outputs the relay declares to the master: the given channels, by
+    default the ones the evaluator produces.
+    """
+    if channels is None:
+        evaluator = importlib.import_module(info['evaluation_args']['module']).Evaluator
+        channels = [channel for channel in declared_outputs if channel in evaluator.KEYS]
+    for channel in channels:
+        assert channel in declared_outputs, f'The workers do not produce the channel {channel}'
+    return {channel: declared_outputs[channel] for channel in channels}
+
+def wait_for_decl(socket: zmq.Socket, info: Dict[str, Any]) -> Tuple[bytes, Dict[str, Any], List[zmq.Frame]]:
+    """Answers the local workers with the info of the master until one of
+    them declares its outputs, and returns that request.
+    """
+    local_info = {k: v for (k, v) in info.items() if k not in UPSTREAM_FIELDS}
+    while True:
+        identity, message, payload = recv_request(socket)
+        if message['kind'] == 'decl':
+            return identity, message, payload
+        if message['kind'] == 'info':
+            send_reply(socket, identity, {'kind': 'info', **local_info})
+        elif message['kind'] == 'heartbeat':
+            send_reply(socket, identity, {'kind': 'ack'})
+        else:
+            send_reply(socket, identity, {'kind': 'bad_query'})
+
+parser = argparse.ArgumentParser(
+    description='Relay between a 3DB master and the workers of a machine or rack')
+
+parser.add_argument('output_dir', help='Where to store the output of the loggers of the relay')
+parser.add_argument('port', type=int,
+                    help='The port used to listen for rendering workers')
+parser.add_argument('--master-address', '-a', type=str, default='localhost:5555',
+                    help='How to contact the master node (host:port or a full address)')
+parser.add_argument('--ipc-path', type=str, default=None,
+                    help='Also listen on this unix socket (ipc://<path>) for workers on the same machine')
+parser.add_argument('--upstream-channels', type=str, nargs='+', default=None,
+                    help='The result channels sent to the master (default: the ones of the evaluator)')
+parser.add_argument('--logger-modules', type=str, nargs='+', default=None,
+                    help='The loggers of the relay (default: the ones of the experiment)')
+parser.add_argument('--buffer-memory', type=float, default=4.,
+                    help='Memory (or disk space with --buffer-dir, in GB) the results waiting for the loggers of the relay can take')
+parser.add_argument('--buffer-dir', type=str, default=None,
+                    help='Keep the result buffer in this directory (e.g. on a local SSD) instead of memory')
+parser.add_argument('--batch-size', type=int, default=16,
+                    help='How many jobs to ask the master for at once')
+parser.add_argument('--backlog', type=int, default=2,
+                    help='How many jobs to keep pending for each local worker')
+parser.add_argument('--busy-poll', type=float, default=0.05,
+                    help='How long (in seconds) the master can hold a request for jobs while workers are rendering')
+parser.add_argument('--heartbeat-interval', type=float, default=10,
+                    help='Seconds between two heartbeats sent to the master')
+parser.add_argument('--long-poll', type=float, default=10,
+                    help='How long (in seconds) the master can hold a request for jobs when idle')
+parser.add_argument('--master-timeout', type=float, default=300,
+                    help='Seconds without an answer from the master before considering it gone')
+parser.add_argument('--waste-budget', type=float, default=0.05,
+                    help='Maximum fraction of renders that can be speculative duplicates of slow jobs')
+parser.add_argument('--lease-factor', type=float, default=3.,
+                    help='How many times the expected render time a worker has to return a job')
+parser.add_argument('--initial-lease', type=float, default=120.,
+                    help='Expected render time (in seconds) before any job of a model/environment pair completed')
+parser.add_argument('--worker-timeout', type=float, default=60.,
+                    help='Seconds without hearing from a worker before its jobs are handed to others')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    makedirs(args.output_dir, exist_ok=True)
+
+    context = zmq.Context()
+    master_address = args.master_address
+    if '://' not in master_address:
+        master_address = "tcp://" + master_address
+    relay_id = f'relay-{uuid4()}'
+
+    upstream_socket = context.socket(zmq.REQ)
+    upstream_socket.setsockopt(zmq.LINGER, 0)
+    upstream_socket.connect(master_address)
+    print(f"==> [Connecting to the master ({master_address})]")
+    info = query(upstream_socket, 'info', relay_id)
+    experiment = {} if info.get('experiment') is None else {'experiment': info['experiment']}
+
+    config = {
+        'render_args': info['render_args'],
+        'inference': info['inference'],
+        'controls': info['controls_args'],
+        'evaluation': info['evaluation_args'],
+        'logging': info.get('logging') or {'logger_modules': []}
+    }
+    if args.logger_modules is not None:
+        config['logging'] = {**config['logging'], 'logger_modules': args.logger_modules}
+
+    # The outputs of the workers are only known once the first one declares
+    # them, and we need them to declare ours to the master
+    socket = bind_socket(args.port, args.ipc_path)
+    print(f"==> [Waiting for a worker on port {args.port}]")
+    identity, decl, payload = wait_for_decl(socket, info)
+    outputs = upstream_outputs(decl['declared_outputs'], info, args.upstream_channels)
+    print(f"==> [Sending {list(outputs.keys())} to the master]")
+    session = query(upstream_socket, 'decl', relay_id, declared_outputs=outputs, **experiment)
+    upstream_socket.close()
+    if session['kind'] == 'switch':
+        print(f"==> [The master moved us to experiment {session['experiment']}, "
+              "a relay only serves one experiment]")
+        sys.exit()
+    assert session['kind'] == 'ack', 'Received a non-ack message from the master, abort.'
+
+    result_buffer = CyclicBuffer(memory_budget=args.buffer_memory * 2**30,
+                                 directory=args.buffer_dir)
+    relay_regid = result_buffer.register(outputs.keys())
+    logger_manager = LoggerManager()
+    for module_path in config['logging']['logger_modules']:
+        logger_module = importlib.import_module(module_path).Logger
+        logger_manager.append(logger_module(args.output_dir, result_buffer, config))
+
+    codec = JobCodec(session['jobs'])
+    prefetcher = JobPrefetcher(context, master_address, relay_id, args.batch_size, 0,
+                               args.heartbeat_interval, {k: v[1] for (k, v) in outputs.items()},
+                               session['channels'],
+                               {channel: ChannelEncoding(**description)
+                                for (channel, description) in session['encodings'].items()},
+                               codec, long_poll=args.long_poll,
+                               master_timeout=args.master_timeout,
+                               experiment=info.get('experiment'))
+    prefetcher.want(0, 0.)
+    upstream = UpstreamLink(prefetcher, codec, session['channels'], result_buffer,
+                            relay_regid, logger_manager)
+    scheduler = RelayScheduler(upstream, info, config, result_buffer, logger_manager, socket,
+                               backlog=args.backlog,
+                               busy_poll=args.busy_poll,
+                               long_poll_timeout=args.long_poll,
+                               waste_budget=args.waste_budget,
+                               lease_factor=args.lease_factor,
+                               initial_lease=args.initial_lease,
+                               worker_timeout=args.worker_timeout)
+    scheduler.handle_request(identity, decl, payload)
+    start = time.time()
+    scheduler.schedule_work()
+    print(f"==> [Relayed {scheduler.valid_renders} results in {time.time() - start:.0f}s]")
@@ -45,6 +45,21 @@ class BaseRenderer(ABC):
         """
         raise NotImplementedError
 
+    @staticmethod
+    def get_model_path(search_dir: str, model: str) -> Optional[str]:
+        """
+        The file a model (as returned by :meth:`enumerate_models`) is loaded
+        from, if any. Used to recognize the model across experiments.
+        """
+        return None
+
+    @staticmethod
+    def get_env_path(search_dir: str, env: str) -> Optional[str]:
+        """
+        Same as :meth:`get_model_path` for an environment.
+        """
+        return None
+
     @abstractmethod
     def declare_outputs(self) -> Dict[str, Tuple[List[int], str]]:
         """
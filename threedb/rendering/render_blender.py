@@ -61,6 +61,14 @@ class Blender(BaseRenderer):
         all_files = map(lambda x: path.basename(x), glob(_get_env_path(search_dir, '*.*')))
         return list(filter(lambda x: x.split('.')[-1] in ENV_EXTENSIONS, all_files))
 
+    @staticmethod
+    def get_model_path(search_dir: str, model: str) -> str:
+        return _get_model_path(search_dir, model)
+
+    @staticmethod
+    def get_env_path(search_dir: str, env: str) -> str:
+        return _get_env_path(search_dir, env)
+
     def declare_outputs(self) -> Dict[str, Tuple[List[int], str]]:
         imsize = [self.args['resolution'], self.args['resolution']]
         output_channels: Dict[str, Tuple[List[int], str]] = {'rgb': ([3, *imsize], 'float32')}
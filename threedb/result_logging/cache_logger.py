@@ -0,0 +1,60 @@
+"""
+threedb.result_logging.cache_logger
+===================================
+
+Subclass of :mod:`threedb.result_logging.base_logger.BaseLogger`.
+"""
+
+from typing import Any, Dict
+
+from threedb.result_logging.base_logger import BaseLogger
+from threedb.scheduling.render_cache import RenderCache
+from threedb.utils import CyclicBuffer
+
+class CacheLogger(BaseLogger):
+    """
+    This logger stores the render channels of every result in a
+    :class:`threedb.scheduling.render_cache.RenderCache`, so that later
+    experiments can reuse them. It is not listed in the config file, the
+    master adds it when it is given a cache directory.
+    """
+
+    def __init__(self,
+                 result_buffer: CyclicBuffer,
+                 config: Dict[str, Any],
+                 cache: RenderCache) -> None:
+        """Initializes a CacheLogger
+
+        Parameters
+        ----------
+        result_buffer : CyclicBuffer
+            The buffer that is being written to by the policy controller
+            containing all the results
+        config : Dict[str, Any]
+            Config that the experiment was run with
+        cache : RenderCache
+            The cache to write to.
+        """
+        super().__init__(cache.root_dir, result_buffer, config)
+        self.cache = cache
+        self.regid = self.buffer.register(cache.channels)
+        print(f'==> [Caching results in {cache.root_dir} with regid {self.regid}]')
+
+    def log(self, item: Dict[str, Any]) -> None:
+        """Implementation of ``log()`` for CacheLogger
+
+        Parameters
+        ----------
+        item : Dict[str, Any]
+            The item to be logged, its renders are stored under the key of
+            its job.
+        """
+        rix = item['result_ix']
+        key = self.cache.key(item['environment'], item['model'],
+                             item['render_args'], item['control_order'])
+        self.cache.put(key, {k: v.numpy() for (k, v) in self.buffer[rix].items()
+                             if k in self.cache.channels})
+        self.buffer.free(rix, self.regid)
+
+    def end(self) -> None:
+        pass
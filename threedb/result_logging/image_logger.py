@@ -23,7 +23,9 @@ class ImageLogger(BaseLogger):
     :attr:`threedb.rendering.render_blender.Blender.KEYS`) that contains the
     dictionary keys that correspond to renderered images. For each key, images
     of that type are saved to an ``images/ID_<KEY>`` subdirectory of the given
-    logging directory.
+    logging directory. Job ids are deterministic (see
+    :func:`threedb.scheduling.policy_controller.job_id`), so running the same
+    experiment again writes the same files.
     """
 
     def __init__(self,
@@ -50,7 +52,7 @@ class ImageLogger(BaseLogger):
         rendering_module: Type[BaseRenderer] = getattr(engine, 'Renderer')
         self.save_keys = rendering_module.KEYS
         self.result_buffer = result_buffer
-        self.regid = self.result_buffer.register()
+        self.regid = self.result_buffer.register(self.save_keys)
 
         self.folder = path.join(save_dir, 'images/')
         if not path.exists(self.folder):
@@ -75,11 +77,11 @@ class ImageLogger(BaseLogger):
 
             image = buf_data[channel_name]
             if channel_name == 'segmentation':
-                img_name = item['id'] + '_' + channel_name + '.npy'
+                img_name = f"{item['id']}_{channel_name}.npy"
                 img_path = path.join(self.folder, img_name)
                 np.save(img_path, image.numpy()[0])
             else:
-                img_name = item['id'] + '_' + channel_name + '.png'
+                img_name = f"{item['id']}_{channel_name}.png"
                 img_path = path.join(self.folder, img_name)
                 img_arr = image.permute(1, 2, 0).numpy() * 255.0
                 img_to_write = cv2.cvtColor(img_arr, cv2.COLOR_RGB2BGR)
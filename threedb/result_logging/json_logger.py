@@ -67,8 +67,8 @@ class JSONLogger(BaseLogger):
         super().__init__(root_dir, result_buffer, config)
         fname = path.join(root_dir, 'details.log')
         self.handle = open(fname, 'ab+')
-        self.regid = self.buffer.register()
         self.evaluator = importlib.import_module(self.config['evaluation']['module']).Evaluator
+        self.regid = self.buffer.register(self.evaluator.KEYS)
         if 'label_map' in config['inference']:
             classmap_fname = path.join(root_dir, 'class_maps.json')
             print(f"==> [Saving class maps to {classmap_fname}]")
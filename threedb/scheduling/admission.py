@@ -0,0 +1,130 @@
+"""
+threedb.scheduling.admission
+============================
+
+Decides when to start new policies, based on how fast the workers consume
+jobs and how many jobs the policies produce.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+class AdmissionController:
+    """
+    Keeps enough jobs pending for the workers, without starting more
+    policies than needed.
+
+    The number of jobs the workers will ask for before a newly started policy
+    posts its first jobs is estimated from the measured rate at which jobs
+    are handed out and the measured time a policy takes to post its first
+    block. Policies are started until the pending jobs, plus the jobs
+    expected from the policies that did not post anything yet, cover that
+    demand (and at least two jobs per worker).
+
+    Each running policy keeps a copy of the results of its current step, so
+    the number of running policies is also bounded by ``memory_budget``.
+    """
+
+    def __init__(self, max_running: int,
+                       memory_budget: Optional[float] = None,
+                       smoothing: float = 0.2,
+                       rate_window: float = 1.0) -> None:
+        """
+        Parameters
+        ----------
+        max_running : int
+            Maximum number of policies running at the same time.
+        memory_budget : Optional[float]
+            Maximum number of bytes the results held by running policies
+            can take, by default unlimited.
+        smoothing : float
+            Weight of a new observation in the moving averages.
+        rate_window : float
+            How often (in seconds) the rate of dispatched jobs is measured.
+        """
+        self.max_running = max_running
+        self.memory_budget = memory_budget
+        self.smoothing = smoothing
+        self.rate_window = rate_window
+
+        # Size in bytes of a single result
+        self.result_size = 0
+        # Moving averages of the number of jobs in a block, of the time it
+        # takes a policy to post its first block and of the jobs handed out
+        # per second
+        self.jobs_per_block: Optional[float] = None
+        self.startup_time = 0.
+        self.job_rate = 0.
+
+        # Policies that did not post any job yet -> time they were started
+        self.starting: Dict[Any, float] = {}
+        self.last_dispatched = 0
+        self.last_measure = time.time()
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return (1 - self.smoothing) * current + self.smoothing * value
+
+    def policy_started(self, policy: Any) -> None:
+        self.starting[policy] = time.time()
+
+    def block_posted(self, policy: Any, num_jobs: int) -> None:
+        started = self.starting.pop(policy, None)
+        if started is not None:
+            self.startup_time = self._average(self.startup_time, time.time() - started)
+        self.jobs_per_block = self._average(self.jobs_per_block, num_jobs)
+
+    def policy_done(self, policy: Any) -> None:
+        self.starting.pop(policy, None)
+
+    def measure(self, dispatched: int) -> None:
+        """Updates the rate at which jobs are handed out, given the total
+        number of jobs dispatched so far
+        """
+        now = time.time()
+        elapsed = now - self.last_measure
+        if elapsed >= self.rate_window:
+            rate = (dispatched - self.last_dispatched) / elapsed
+            self.job_rate = self._average(self.job_rate, rate)
+            self.last_dispatched, self.last_measure = dispatched, now
+
+    def demand(self, num_workers: int) -> float:
+        """The number of pending jobs we want to have"""
+        return max(2 * num_workers, self.job_rate * self.startup_time)
+
+    def to_admit(self, num_pending: int, num_workers: int, num_running: int) -> int:
+        """How many new policies to start now
+
+        Parameters
+        ----------
+        num_pending : int
+            The number of jobs waiting to be handed out.
+        num_workers : int
+            The number of workers connected.
+        num_running : int
+            The number of policies currently running.
+        """
+        if self.jobs_per_block is None:
+            # We have no idea how many jobs a policy posts, start one and
+            # wait to find out
+            return 0 if self.starting else int(num_running < self.max_running)
+
+        max_running = self.max_running
+        if self.memory_budget is not None and self.result_size > 0:
+            per_policy = self.jobs_per_block * self.result_size
+            max_running = min(max_running, max(1, int(self.memory_budget // per_policy)))
+
+        expected = num_pending + len(self.starting) * self.jobs_per_block
+        missing = self.demand(num_workers) - expected
+        if missing <= 0:
+            return 0
+        wanted = -int(-missing // max(1., self.jobs_per_block))
+        return max(0, min(wanted, max_running - num_running))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'job_rate': self.job_rate,
+            'startup_time': self.startup_time,
+            'jobs_per_block': self.jobs_per_block or 0.
+        }
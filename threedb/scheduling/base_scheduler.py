@@ -6,15 +6,25 @@ The task schedular of 3DB.
 """
 
 from tqdm import tqdm
-from typing import Any, Dict, Set, List
-from threedb.scheduling.policy_controller import PolicyController
-from threedb.scheduling.utils import recv_into_buffer
+from itertools import product
+from typing import Any, Callable, Dict, Optional, Sequence, Set, List, Tuple, Union
+from threedb.scheduling.admission import AdmissionController
+from threedb.scheduling.policy_controller import POLICY_REGID, PolicyController, expand_block
+from threedb.scheduling.placement import PlacementEngine
+from threedb.scheduling.work_queue import WorkQueue
+from threedb.scheduling.protocol import ChannelEncoding, JobCodec
+from threedb.scheduling.render_cache import RenderCache
+from threedb.scheduling.search_space import SearchSpace
+from threedb.scheduling.shared_ring import SharedRing
+from threedb.scheduling.utils import (bind_socket, recv_from_ring, recv_request, recv_into_buffer,
+                                      send_reply, split_results)
 from threedb.result_logging.logger_manager import LoggerManager
 from threedb.utils import CyclicBuffer
 
 import time
 import os
 import json
+import numpy as np
 import zmq
 
 class Scheduler:
@@ -23,11 +33,28 @@ class Scheduler:
                        envs: List[str],
                        models: List[str],
                        config: Dict[str, Dict[str, Any]],
-                       policy_controllers: Set[PolicyController],
+                       policy_factory: Callable[[str, str], PolicyController],
                        buffer: CyclicBuffer,
                        logger_manager: LoggerManager,
+                       search_space: SearchSpace,
+                       max_requests_per_round: int = 256,
+                       waste_budget: float = 0.05,
+                       lease_factor: float = 3.0,
+                       initial_lease: float = 120.0,
+                       worker_timeout: float = 60.0,
+                       ipc_path: Optional[str] = None,
+                       refill_interval: int = 50,
+                       long_poll_timeout: float = 10.0,
+                       memory_budget: Optional[float] = None,
+                       render_cache: Optional[RenderCache] = None,
+                       recovered: Optional[Dict[int, int]] = None,
+                       socket: Optional[zmq.Socket] = None,
+                       name: Optional[str] = None,
                        with_tqdm: bool = True) -> None:
         self.running = False
+        # Set when several experiments share the workers, see
+        # threedb.scheduling.fair_share
+        self.name = name
 
         self.envs = envs
         self.models = models
@@ -35,32 +62,107 @@ class Scheduler:
         self.config = config
         self.logger_manager = logger_manager
 
-        # Open a socket for communicating with the clients
-        context = zmq.Context(io_threads=1)
-        self.socket = context.socket(zmq.REP)
-        self.socket.bind("tcp://*:%s" % port)
-
-        # Keep track of the workers
+        # Jobs are sent in a compact binary form, the tables needed to decode
+        # them are sent once to each worker when it declares its outputs
+        self.job_codec = JobCodec(JobCodec.make_schema([env.split('/')[-1] for env in envs],
+                                                       [model.split('/')[-1] for model in models],
+                                                       search_space))
+        # Order of the result channels in push messages
+        self.channels: List[str] = []
+        # How some of the channels are encoded on the wire (see
+        # ChannelEncoding), only the ones the workers actually produce
+        self.wire_encoding = {channel: ChannelEncoding.from_config(spec) for (channel, spec)
+                              in config['render_args'].get('wire_encoding', {}).items()}
+        self.encodings: Dict[str, ChannelEncoding] = {}
+
+        # The socket we talk to the workers on, unless it is shared with other
+        # experiments
+        if socket is None:
+            socket = bind_socket(port, ipc_path)
+        self.socket = socket
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.max_requests_per_round = max_requests_per_round
+
+        # Results that were acknowledged but not yet copied into the buffer,
+        # with the id of the worker that sent them. Each result is either
+        # its frames or its slot in the shared ring of the worker
+        self.pending_results: List[Tuple[str, List[Tuple[PolicyController, Any, Union[List[zmq.Frame], int]]]]] = []
+        # The shared rings of the workers running on this machine, and the
+        # slots of each ring we are done reading
+        self.rings: Dict[str, SharedRing] = {}
+        self.released_slots: Dict[str, List[int]] = {}
+
+        # Keep track of the workers, and when we last heard from them
         self.linked_workers: Set[str] = set()
-        self.policy_controllers = policy_controllers
-        self.num_policies = len(policy_controllers)
-        self.done_policies = set()
+        self.last_seen: Dict[str, float] = {}
+        # worker id -> (time spent waiting for jobs, uptime) as reported
+        self.worker_stats: Dict[str, Tuple[float, float]] = {}
+        self.worker_timeout = worker_timeout
+        # The policy of each (environment, model) pair is only created once
+        # it is admitted, see refill_work_queue
+        self.policy_factory = policy_factory
+        self.pending_pairs = product([env.split('/')[-1] for env in envs],
+                                     [model.split('/')[-1] for model in models])
+        self.num_policies = len(envs) * len(models)
+        self.started_policies = 0
+        self.done_policies = 0
         self.running_policies = set()
         self.max_running_policies = max_running_policies
-        self.work_queue = {}
+        self.admission = AdmissionController(max_running_policies, memory_budget)
+        self.work_queue = WorkQueue(waste_budget=waste_budget,
+                                    lease_factor=lease_factor,
+                                    initial_lease=initial_lease)
+        self.placement = PlacementEngine()
+        # Renders of earlier experiments, looked up before handing out jobs
+        self.render_cache = render_cache
+        # Jobs whose renders were found in the cache: job id -> key. The
+        # workers that can read the cache get the key along with the job,
+        # and only run inference and evaluation on the stored renders
+        self.cache_hits: Dict[int, str] = {}
+        self.cache_readers: Set[str] = set()
+        # The render channels stored in the cache, and their shape and dtype
+        self.render_outputs: Dict[str, Tuple[List[int], str]] = {}
+        # Results found in the buffer when resuming (see
+        # CyclicBuffer.recover), by job id. They are handed to the policies
+        # that issue these jobs again
+        self.recovered = recovered or {}
+        self.search_space = search_space
+        # Maximum time (in ms) between two refills of the work queue
+        self.refill_interval = refill_interval
+
+        # Pulls we could not serve yet: (identity, message, deadline). They
+        # are answered as soon as jobs are available, or empty at the
+        # deadline. We never hold them long enough for the worker to be
+        # considered dead.
+        self.parked_pulls: List[Tuple[bytes, Dict[str, Any], float]] = []
+        self.long_poll_timeout = min(long_poll_timeout, worker_timeout / 2)
+
+        # Pushes we did not acknowledge yet because the result buffer is full:
+        # (identity, message, deferred since). Their workers hold on to their
+        # next results until we do
+        self.deferred_acks: List[Tuple[bytes, Dict[str, Any], float]] = []
+        # Time spent with the buffer full
+        self.push_stall_time = 0.
+        self.last_stall_check = time.time()
 
         # TQDM bars
         self.valid_renders, self.total_renders = 0, 0
         if with_tqdm:
-            self.render_pb = tqdm(unit='images', desc='Renderings', smoothing=0.1)
-            self.policies_pb = tqdm(unit='steps', desc='Policies', total=self.num_policies)
+            suffix = '' if name is None else f' ({name})'
+            self.render_pb = tqdm(unit='images', desc='Renderings' + suffix, smoothing=0.1)
+            self.policies_pb = tqdm(unit='steps', desc='Policies' + suffix, total=self.num_policies)
 
-    def start(self, declared_outputs):
+    def start(self, identity: bytes, declared_outputs):
         """
         Parameters
         ----------
+        - identity: the identity of the worker that declared the outputs
         - declared_outputs: map of key -> shape for what outputs the client will
           relay back to the server.
+
+        The reply gives the worker the order in which to send the result
+        channels, how to encode them and the schema needed to decode the jobs.
         
         Note
         ----
@@ -68,85 +170,418 @@ class Scheduler:
         the policy controllers, and also the loggers.
         """
         assert self.buffer.declare_buffers(declared_outputs)
-        self.socket.send_pyobj({'kind': 'ack'})
+        self.channels = list(self.buffer.declared_buffers.keys())
+        if self.render_cache is not None:
+            self.render_outputs = {channel: declared_outputs[channel]
+                                   for channel in self.render_cache.channels
+                                   if channel in declared_outputs}
+        # The policies only keep the channels they read
+        policy_keys = list(declared_outputs.keys())
+        if 'policy' in self.config:
+            policy_keys = self.buffer.channels_of(POLICY_REGID)
+        self.admission.result_size = sum(int(np.prod(declared_outputs[key][0]))
+                                         * np.dtype(declared_outputs[key][1]).itemsize
+                                         for key in policy_keys)
+        self.encodings = {}
+        for channel, encoding in self.wire_encoding.items():
+            if channel in self.buffer.declared_buffers:
+                encoding.check(channel, self.buffer.declared_buffers[channel][1])
+                self.encodings[channel] = encoding
+        send_reply(self.socket, identity, {
+            'kind': 'ack',
+            'channels': self.channels,
+            'encodings': {channel: encoding.describe()
+                          for (channel, encoding) in self.encodings.items()},
+            'jobs': self.job_codec.schema
+        })
         if not self.running:
             self.logger_manager.start()
             self.running = True
 
-    def send_info(self):
-        self.socket.send_pyobj({
+    def send_info(self, identity: bytes):
+        experiment = {} if self.name is None else {'experiment': self.name}
+        send_reply(self.socket, identity, {
             'kind': 'info',
+            **experiment,
             'environments': self.envs,
             'models': self.models,
             'render_args': self.config['render_args'],
             'inference': self.config['inference'],
             'controls_args': self.config['controls'],
-            'evaluation_args': self.config['evaluation']
+            'evaluation_args': self.config['evaluation'],
+            'logging': self.config.get('logging'),
+            'render_cache': None if self.render_cache is None else os.path.abspath(self.render_cache.root_dir)
         })
 
-    def handle_pull(self, message: Dict[str, Any]) -> None:
+    def reply(self, identity: bytes, worker_id: str, reply: Dict[str, Any],
+              frames: Sequence[Any] = ()) -> None:
+        """
+        Sends a reply to a worker, telling it about the jobs it holds that
+        were completed by other workers in the meantime so it can skip them,
+        about the slots of its shared ring it can reuse, and to hold its
+        results while the buffer is full (see :meth:`serve_deferred_acks`).
+        """
+        cancelled = self.work_queue.take_cancelled(worker_id)
+        if cancelled:
+            reply['cancelled'] = cancelled
+        released = self.released_slots.pop(worker_id, None)
+        if released:
+            reply['released'] = released
+        if self.deferred_acks or not self.has_room():
+            reply['hold'] = True
+        send_reply(self.socket, identity, reply, frames)
+
+    def handle_pull(self, identity: bytes, message: Dict[str, Any]) -> None:
         """
         Handles a "pull" request from the client, asking for work. Should send a
         new list of jobs to work on
         """
-        bs = message['batch_size']
-        last_env = message['last_environment']
-        last_model = message['last_model']
+        if self.work_queue.num_pending < message['batch_size']:
+            # Do not send the worker away empty-handed if jobs were posted
+            # since the last refill
+            self.refill_work_queue()
+        # An idle worker can ask us to hold its request until there is
+        # something to do (long polling)
+        wait = min(message.get('wait', 0), self.long_poll_timeout)
+        if not self.send_work(identity, message, allow_empty=wait <= 0):
+            self.parked_pulls.append((identity, message, time.time() + wait))
+
+    def send_work(self, identity: bytes, message: Dict[str, Any],
+                  allow_empty: bool = True) -> bool:
+        """
+        Sends jobs to the worker that sent the given pull request. Returns
+        whether a reply was sent (there is none if no job is available and
+        ``allow_empty`` is False).
+        """
+        wid = message['worker_id']
+        loaded = None
+        if message['last_environment'] is not None:
+            loaded = (message['last_environment'], message['last_model'])
+        pair = self.placement.place(wid, loaded, self.work_queue.pending_counts,
+                                    len(self.linked_workers))
+        env, model = pair if pair is not None else (None, None)
+        to_send = self.work_queue.pop(message['batch_size'], wid, env, model)
+        if not to_send and not allow_empty:
+            return False
+        self.placement.record(wid, to_send)
 
-        to_work_on = []
-        to_send = []
+        # Send the job information to the worker node
+        cache_keys = None
+        if wid in self.cache_readers:
+            cache_keys = {job.id: self.cache_hits[job.id] for job in to_send
+                          if job.id in self.cache_hits}
+        header, frames = self.job_codec.encode(to_send, cache_keys)
+        self.reply(identity, message['worker_id'], {
+            'kind': 'work',
+            **header
+        }, frames)
+        return True
 
-        def custom_order(arg):
-            _, job, num_scheduled, time_scheduled = arg
-            return (num_scheduled,
-                    int(job.environment != last_env) + int(job.model != last_model),
-                    time_scheduled, job.id)
+    def serve_parked_pulls(self) -> None:
+        """
+        Answers the pulls that were waiting for jobs, if there are jobs now or
+        if they waited long enough.
+        """
+        now = time.time()
+        still_parked = []
+        for identity, message, deadline in self.parked_pulls:
+            if message['worker_id'] not in self.linked_workers:
+                continue  # The worker was declared dead in the meantime
+            if not self.send_work(identity, message, allow_empty=now >= deadline):
+                still_parked.append((identity, message, deadline))
+        self.parked_pulls = still_parked
+
+    def handle_push(self, identity: bytes, message: Dict[str, Any],
+                    payload: List[zmq.Frame]) -> None:
+        """
+        Handles a "push" request from the client, carrying the results of one
+        or more jobs. The worker is acknowledged right away so it can go back
+        to rendering, the results themselves are copied into the buffer later
+        by :meth:`ingest_results`.
+
+        If the buffer does not have room for all the results waiting to be
+        copied, the acknowledgement is deferred until it does (see
+        :meth:`serve_deferred_acks`): the worker keeps its next results
+        until then, instead of us piling them up.
+        """
+        worker_id = message['worker_id']
+        if 'ring' in message:
+            self.attach_ring(worker_id, message['ring'])
+
+        # Extract the results from the message
+        from_cache = set(message.get('from_cache', ()))
+        valid = []
+        for jobid, result in zip(message['jobs'], split_results(message, payload, self.channels)):
+            self.total_renders += 1
+            # Recover the policy associated to this job entry, this also
+            # removes it from the queue so we do not give it to anyone else
+            completed = self.work_queue.complete(jobid, worker_id)
+            if completed is not None:
+                if self.cache_hits.pop(jobid, None) is not None:
+                    self.render_cache.served(jobid in from_cache)
+                selected_policy, job = completed
+                valid.append((selected_policy, job, result))
+            elif isinstance(result, int):
+                # Otherwise this task has been completed earlier by another
+                # worker, we don't even have to copy it in the buffer
+                self.released_slots.setdefault(worker_id, []).append(result)
+        if valid:
+            self.pending_results.append((worker_id, valid))
+
+        if self.deferred_acks or not self.has_room():
+            self.deferred_acks.append((identity, message, time.time()))
+        else:
+            self.reply(identity, worker_id, {'kind': 'ack'})
 
-        to_work_on = sorted(self.work_queue.values(), key=custom_order)[:bs]
+    def has_room(self) -> bool:
+        """Whether the buffer can take all the results waiting to be copied
+        without blocking
+        """
+        if not self.pending_results:
+            return True
+        waiting = sum(len(valid) for (_, valid) in self.pending_results)
+        return waiting <= self.buffer.num_free()
 
-        for _, job,  __, ___ in to_work_on:
-            policy, job, num_scheduled, time_scheduled = self.work_queue[job.id]
-            to_send.append(job)
-            # Remember that we sent this job to one extra worker
-            self.work_queue[job.id] = (policy, job, num_scheduled + 1, time_scheduled)
+    def serve_deferred_acks(self) -> None:
+        """
+        Acknowledges the deferred pushes, in order, once the buffer has room
+        for all the results waiting to be copied. The workers waiting on them
+        are alive, even if we do not hear from them.
+
+        A worker gives up on us if we do not answer it within its
+        ``--master-timeout`` (plus its long poll), so a push is never held
+        for more than ``long_poll_timeout`` seconds: it is then acknowledged
+        with ``hold`` set, and the worker keeps its next results (but still
+        asks for jobs and sends heartbeats) until one of our replies comes
+        without it. All our replies carry ``hold`` while the buffer is full.
+        """
+        now = time.time()
+        stalled = not self.has_room()
+        if self.deferred_acks or stalled:
+            self.push_stall_time += now - self.last_stall_check
+        self.last_stall_check = now
+        if not self.deferred_acks:
+            return
+        if not stalled:
+            deferred, self.deferred_acks = self.deferred_acks, []
+            for identity, message, _ in deferred:
+                self.reply(identity, message['worker_id'], {'kind': 'ack'})
+            return
+        still_deferred = []
+        for identity, message, since in self.deferred_acks:
+            if now - since >= self.long_poll_timeout:
+                self.reply(identity, message['worker_id'], {'kind': 'ack'})
+            else:
+                self.last_seen[message['worker_id']] = now
+                still_deferred.append((identity, message, since))
+        self.deferred_acks = still_deferred
 
-        # Send the job information to the worker node
-        self.socket.send_pyobj({
-            'kind': 'work',
-            'params_to_render': to_send,
-        })
+    def attach_ring(self, worker_id: str, description: Dict[str, Any]) -> None:
+        """
+        Attaches to the shared ring a worker running on this machine writes
+        its results to (see :class:`threedb.scheduling.shared_ring.SharedRing`).
+        """
+        ring = self.rings.get(worker_id)
+        if ring is not None and ring.name == description['name']:
+            return
+        if ring is not None:
+            ring.close()
+        self.rings[worker_id] = SharedRing(self.channels, self.buffer.declared_buffers,
+                                           description['num_slots'], description['name'])
+
+    def detach_ring(self, worker_id: str) -> None:
+        ring = self.rings.pop(worker_id, None)
+        if ring is not None:
+            ring.close()
+        self.released_slots.pop(worker_id, None)
+
+    def ingest_results(self) -> None:
+        """
+        Copies the results received since the last call into the buffer and
+        hands them to the policies that requested them. The results that do
+        not fit in the buffer yet are left for the next call.
+        """
+        if not self.pending_results:
+            return
+        free = self.buffer.num_free()
+        while self.pending_results and len(self.pending_results[0][1]) <= free:
+            worker_id, valid = self.pending_results.pop(0)
+            free -= len(valid)
+            sent = [item for item in valid if not isinstance(item[2], int)]
+            shared = [item for item in valid if isinstance(item[2], int)]
+            indices = recv_into_buffer(self.channels,
+                                       [frames for (_, _, frames) in sent],
+                                       self.buffer, self.encodings)
+            if shared:
+                slots = [slot for (_, _, slot) in shared]
+                indices += recv_from_ring(self.channels, self.rings[worker_id],
+                                          slots, self.buffer)
+                self.released_slots.setdefault(worker_id, []).extend(slots)
+            self.buffer.record_jobs(indices, (job.id for (_, job, _) in sent + shared))
+            for (selected_policy, job, _), result in zip(sent + shared, indices):
+                selected_policy.push_result(job.id, result)
+            self.render_pb.update(len(valid))
+            self.valid_renders += len(valid)
+
+    def lookup_cache(self, job: Any) -> Optional[str]:
+        """The key of a job in the render cache, if its renders are there"""
+        if self.render_cache is None or not self.render_outputs:
+            return None
+        render_args, control_order = self.search_space.unpack_vector(job.params)
+        key = self.render_cache.key(job.environment, job.model, render_args, control_order)
+        return key if self.render_cache.has(key) else None
+
+    def serve_recovered(self, policy: PolicyController, jobs: List[Any]) -> None:
+        """Hands results recovered from the buffer to the policy that
+        requested them again, as if a worker had sent them.
+        """
+        for job in jobs:
+            policy.push_result(job.id, self.recovered.pop(job.id))
+        self.render_pb.update(len(jobs))
 
-    def handle_push(self, message: Dict[str, Any]) -> None:
-        # Extract the result from the message
-        jobid, result = message['job'], message['result']
+    def refill_work_queue(self) -> None:
+        """
+        Pulls all the blocks of jobs posted by the running policies and starts
+        a new policy if there is not enough work for the workers.
+        """
+        for policy in self.running_policies:
+            while True:
+                block = policy.pull_work()
+                if block is None:
+                    break
+                self.admission.block_posted(policy, len(block.ids))
+                recovered = []
+                for job in expand_block(block):
+                    if job.id in self.recovered:
+                        recovered.append(job)
+                        continue
+                    key = self.lookup_cache(job)
+                    if key is not None:
+                        self.cache_hits[job.id] = key
+                    self.work_queue.add(policy, job)
+                if recovered:
+                    self.serve_recovered(policy, recovered)
+
+        # Start as many policies as needed to keep the workers busy
+        self.admission.measure(self.work_queue.dispatched)
+        to_admit = self.admission.to_admit(self.work_queue.num_pending,
+                                           len(self.linked_workers),
+                                           len(self.running_policies))
+        to_admit = min(to_admit, self.num_policies - self.started_policies)
+        for _ in range(to_admit):
+            selected_policy = self.policy_factory(*next(self.pending_pairs))
+            self.started_policies += 1
+            selected_policy.start()
+            self.running_policies.add(selected_policy)
+            self.admission.policy_started(selected_policy)
+
+    def handle_request(self, identity: bytes, message: Dict[str, Any],
+                       payload: List[zmq.Frame]) -> None:
+        """
+        Dispatches a single request from a worker to the right handler.
+        """
+        wid = message['worker_id']
+        self.linked_workers.add(wid)
+        self.last_seen[wid] = time.time()
+        if 'idle_time' in message:
+            self.worker_stats[wid] = (message['idle_time'], message['uptime'])
 
-        self.total_renders += 1
+        if message['kind'] == 'heartbeat':
+            self.reply(identity, wid, {'kind': 'ack'})
+            return
 
-        if jobid in self.work_queue:
-            # Recover the policy associated to this job entry
-            selected_policy, job, _, _ = self.work_queue[jobid]
-            del self.work_queue[job.id]  # This is done do not give it to anyone else 
-            selected_policy.push_result(job.id, result)
-            self.render_pb.update(1)
-            self.valid_renders += 1
+        if not self.running:
+            assert message['kind'] in {'info', 'decl'}, \
+                'message #1 was not "kind" == "info" or "decl", maybe race condition?'
+
+        if message['kind'] == 'info':
+            self.send_info(identity)
+        elif message['kind'] == 'decl':
+            if message.get('render_cache'):
+                self.cache_readers.add(wid)
+            self.start(identity, message['declared_outputs'])
+        elif message['kind'] == 'pull':
+            self.handle_pull(identity, message)
+        elif message['kind'] == 'push':
+            self.handle_push(identity, message, payload)
         else:
-            # This task has been completed earlier by another worker
-            self.buffer.free(result, -1) # We have to free the result
+            send_reply(self.socket, identity, {'kind': 'bad_query'})
 
-        self.socket.send_pyobj({'kind': 'ack'})
+    def check_workers(self) -> None:
+        """
+        Declares dead the workers we have not heard from (not even a
+        heartbeat) for ``worker_timeout`` seconds, their jobs are handed to
+        other workers.
+        """
+        now = time.time()
+        for wid, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.worker_timeout:
+                print(f"==> [Worker {wid} timed out, releasing its jobs]")
+                self.remove_worker(wid)
 
-    def shutdown(self):
-        for _ in tqdm(range(len(self.linked_workers)), desc='Shutting down', unit=' workers'):
-            message = recv_into_buffer(self.socket, self.buffer)
-            self.socket.send_pyobj({
-                'kind': 'die'
-            })
+    def remove_worker(self, wid: str) -> None:
+        """
+        Forgets about a worker (dead or moved to another experiment), its
+        jobs are handed to other workers.
+        """
+        self.last_seen.pop(wid, None)
+        self.worker_stats.pop(wid, None)
+        self.linked_workers.discard(wid)
+        self.cache_readers.discard(wid)
+        self.work_queue.release_worker(wid)
+        self.placement.remove_worker(wid)
+        self.detach_ring(wid)
+
+    def holds_jobs(self, wid: str) -> bool:
+        """Whether a worker has jobs it did not send the results of"""
+        return bool(self.work_queue.worker_jobs.get(wid))
+
+    def receive_requests(self, timeout: int = 1000) -> List[Tuple[bytes, Dict[str, Any], List[zmq.Frame]]]:
+        """
+        Waits (at most ``timeout`` ms) for requests and returns all of those
+        that have already arrived, up to ``max_requests_per_round``.
+        """
+        requests = []
+        if not self.poller.poll(timeout):
+            return requests
+        while len(requests) < self.max_requests_per_round:
             try:
-                self.linked_workers.remove(message['worker_id'])
-            except:  # This worker didn't do work yet, we still shut it down
-                pass
+                requests.append(recv_request(self.socket, zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return requests
+
+    def shutdown(self):
+        shutdown_pb = tqdm(total=len(self.linked_workers), desc='Shutting down', unit=' workers')
+        # The workers waiting on a long poll or on their push are told right
+        # away
+        requests = [(identity, message, []) for (identity, message, _) in self.parked_pulls]
+        requests += [(identity, message, []) for (identity, message, _) in self.deferred_acks]
+        self.parked_pulls, self.deferred_acks = [], []
+        while self.linked_workers:
+            requests += self.receive_requests()
+            for identity, message, _ in requests:
+                send_reply(self.socket, identity, {
+                    'kind': 'die'
+                })
+                if message['worker_id'] in self.linked_workers:
+                    self.linked_workers.remove(message['worker_id'])
+                    del self.last_seen[message['worker_id']]
+                    shutdown_pb.update(1)
+            requests = []
+            # No need to wait for dead workers
+            self.check_workers()
+        shutdown_pb.close()
+        self.finish()
+
+    def finish(self):
+        """
+        Releases the resources of the experiment once all the results are in
+        and waits for the loggers to be done.
+        """
+        for wid in list(self.rings.keys()):
+            self.detach_ring(wid)
 
-        self.buffer.close()
         self.render_pb.close()
         self.policies_pb.close()
 
@@ -156,66 +591,60 @@ class Scheduler:
 
         # We have to wait until it has processed everything left in the queue
         self.logger_manager.join()
+        self.buffer.close()
         print("==> [Have a nice day!]")
 
-    def schedule_work(self):
-        wait_before_start_new = False
-
-        while True:
-            if len(self.done_policies) == self.num_policies:
-                break  # We finished all the policies
-
-            message = recv_into_buffer(self.socket, self.buffer)
-            wid = message['worker_id']
-            self.linked_workers.add(wid)
+    def is_done(self) -> bool:
+        """Whether all the policies completed"""
+        return self.done_policies == self.num_policies
 
+    def schedule_work(self):
+        while not self.is_done():
+            # The work queue is refilled at a steady pace, whether workers
+            # are sending requests or not
             if self.running:
-                pulled_count = 0
-                for policy in self.running_policies:
-                    pulled = policy.pull_work()
-                    if pulled is None: continue
-                    pulled_count += 1
-                    if pulled_count > 10:  break
-                    wait_before_start_new = False
-                    self.work_queue[pulled.id] = (policy, pulled, 0, time.time())
-
-                # If there is not enough work we start a new policy
-                little_work = len(self.work_queue) < 2 * len(self.linked_workers)
-                policies_left = len(self.policy_controllers) > 0
-                running_max_policies = len(self.running_policies) >= self.max_running_policies
-                if little_work and (not wait_before_start_new) and policies_left and (not running_max_policies):
-                    selected_policy = self.policy_controllers.pop()
-                    selected_policy.start()
-                    self.running_policies.add(selected_policy)
-                    wait_before_start_new = True
-            else:
-                assert message['kind'] in {'info', 'decl'}, \
-                    'message #1 was not "kind" == "info" or "decl", maybe race condition?'
-
-            if message['kind'] == 'info':
-                self.send_info()
-            elif message['kind'] == 'decl':
-                self.start(message['declared_outputs'])
-            elif message['kind'] == 'pull':
-                self.handle_pull(message)
-            elif message['kind'] == 'push':
-                self.handle_push(message)
-            else:
-                self.socket.send_pyobj({'kind': 'bad_query'})
-
-            for policy in list(self.running_policies):
-                if not policy.is_alive():
-                    self.policies_pb.update(1)
-                    self.running_policies.remove(policy)
-                    self.done_policies.add(policy)
+                self.refill_work_queue()
 
-            self.render_pb.set_postfix({
-                'workers': len(self.linked_workers),
-                'pending': len(self.work_queue),
-                'waste%': (1 - self.valid_renders / max(1e-10, self.total_renders)) * 100
-            })
-            self.policies_pb.set_postfix({'running': len(self.running_policies)})
+            # Answer every request that arrived first, the results are only
+            # copied into the buffer once the workers got their replies
+            for identity, message, payload in self.receive_requests(self.refill_interval):
+                self.handle_request(identity, message, payload)
+            self.step()
 
         print("==> [Received all the results]")
         print("==> [Shutting down workers]")
         self.shutdown()
+
+    def step(self):
+        """
+        Everything that happens after answering a round of requests: the
+        results are handed to the policies, the parked pulls answered and
+        the workers and policies checked on.
+        """
+        self.ingest_results()
+        self.serve_deferred_acks()
+        self.serve_parked_pulls()
+        self.check_workers()
+
+        for policy in list(self.running_policies):
+            if not policy.is_alive():
+                self.policies_pb.update(1)
+                self.running_policies.remove(policy)
+                self.admission.policy_done(policy)
+                self.done_policies += 1
+
+        idle_time = sum(idle for (idle, _) in self.worker_stats.values())
+        uptime = sum(up for (_, up) in self.worker_stats.values())
+        self.render_pb.set_postfix({
+            'workers': len(self.linked_workers),
+            'pending': len(self.work_queue),
+            'waste%': (1 - self.valid_renders / max(1e-10, self.total_renders)) * 100,
+            'speculative': self.work_queue.speculative,
+            'cancelled': self.work_queue.cancellations,
+            'switches': self.placement.total_switches,
+            'cached': 0 if self.render_cache is None else self.render_cache.hits,
+            'stalled': f'{self.push_stall_time + self.buffer.stall_time:.0f}s',
+            'idle%': 100 * idle_time / max(1e-10, uptime)
+        })
+        self.policies_pb.set_postfix({'running': len(self.running_policies),
+                                      'jobs/s': self.admission.job_rate})
@@ -0,0 +1,287 @@
+"""
+threedb.scheduling.fair_share
+=============================
+
+Runs several experiments at once on a single pool of workers.
+"""
+
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import zmq
+
+from threedb.scheduling.base_scheduler import Scheduler
+from threedb.scheduling.utils import recv_request, send_reply
+
+class FairShare:
+    """
+    Decides which experiment each worker serves.
+
+    The workers are shared between the experiments with work left by
+    priority first: the experiments with the highest priority get as many
+    workers as they can use, the remaining ones go to the next priority and
+    so on. Within a priority level, workers are shared in proportion to the
+    weights of the experiments. An experiment can use as many workers as it
+    has jobs not completed yet (and at least one, to get its policies
+    started).
+
+    A worker only moves to another experiment when its current one has more
+    workers than its share and the other one fewer.
+    """
+
+    def __init__(self, weights: Dict[str, float], priorities: Dict[str, int]) -> None:
+        """
+        Parameters
+        ----------
+        weights : Dict[str, float]
+            The weight of each experiment.
+        priorities : Dict[str, int]
+            The priority of each experiment, higher is served first.
+        """
+        self.weights = weights
+        self.priorities = priorities
+
+    def targets(self, demand: Dict[str, int], num_workers: int) -> Dict[str, int]:
+        """The number of workers each experiment should get
+
+        Parameters
+        ----------
+        demand : Dict[str, int]
+            The number of workers each experiment with work left can use.
+        num_workers : int
+            The number of workers to share.
+        """
+        targets = {name: 0 for name in demand}
+        remaining = num_workers
+        for priority in sorted({self.priorities[name] for name in demand}, reverse=True):
+            group = [name for name in demand if self.priorities[name] == priority]
+            while remaining > 0 and group:
+                total_weight = sum(self.weights[name] for name in group)
+                shares = {name: remaining * self.weights[name] / total_weight for name in group}
+                # The experiments that cannot use their share get what they
+                # can use, and the others share the rest
+                capped = [name for name in group if demand[name] - targets[name] <= shares[name]]
+                if capped:
+                    for name in capped:
+                        remaining -= demand[name] - targets[name]
+                        targets[name] = demand[name]
+                        group.remove(name)
+                    continue
+                given = {name: int(share) for (name, share) in shares.items()}
+                # The workers left by the rounding go to the largest remainders
+                leftover = remaining - sum(given.values())
+                by_remainder = sorted(group, key=lambda name: (shares[name] - given[name],
+                                                               self.weights[name]),
+                                      reverse=True)
+                for name in by_remainder[:leftover]:
+                    given[name] += 1
+                for name in group:
+                    targets[name] += given[name]
+                remaining = 0
+        return targets
+
+    def choose(self, current: Optional[str], counts: Dict[str, int],
+               demand: Dict[str, int], num_workers: int) -> Optional[str]:
+        """The experiment a worker should serve
+
+        Parameters
+        ----------
+        current : Optional[str]
+            The experiment the worker currently serves (if any).
+        counts : Dict[str, int]
+            The number of workers serving each experiment, this worker
+            included.
+        demand : Dict[str, int]
+            The number of workers each experiment with work left can use.
+        num_workers : int
+            The total number of workers.
+        """
+        if not demand:
+            return None
+        targets = self.targets(demand, num_workers)
+
+        def deficit(name: str) -> int:
+            others = counts.get(name, 0) - (name == current)
+            return targets[name] - others
+
+        if current in demand and counts.get(current, 0) <= targets[current]:
+            return current
+        best = max(demand, key=lambda name: (deficit(name), self.priorities[name],
+                                             self.weights[name]))
+        if current in demand and deficit(best) <= 0:
+            return current  # Nowhere else needs us more
+        return best
+
+
+class FairShareScheduler:
+    """
+    Serves several experiments (each with its own
+    :class:`threedb.scheduling.base_scheduler.Scheduler`, output directory,
+    loggers and policies) with the same workers, over a single socket.
+
+    A worker is attached to one experiment at a time: the ``info`` reply
+    tells it which one, and every later request names it. When a worker
+    holding no job asks for more and :class:`FairShare` wants it elsewhere,
+    it is answered with ``{'kind': 'switch', 'experiment': ...}`` and goes
+    through ``info`` and ``decl`` again for its new experiment. The workers
+    only get ``die`` once all the experiments are done.
+    """
+
+    def __init__(self, socket: zmq.Socket,
+                       schedulers: Dict[str, Scheduler],
+                       weights: Optional[Dict[str, float]] = None,
+                       priorities: Optional[Dict[str, int]] = None,
+                       worker_timeout: float = 60.0,
+                       refill_interval: int = 50,
+                       max_requests_per_round: int = 256) -> None:
+        """
+        Parameters
+        ----------
+        socket : zmq.Socket
+            The socket shared by all the schedulers.
+        schedulers : Dict[str, Scheduler]
+            The scheduler of each experiment, by name.
+        weights : Optional[Dict[str, float]]
+            The weight of each experiment (1 by default).
+        priorities : Optional[Dict[str, int]]
+            The priority of each experiment (0 by default).
+        worker_timeout : float
+            Seconds without hearing from a worker before forgetting about it.
+        refill_interval : int
+            Maximum time (in ms) between two refills of the work queues.
+        max_requests_per_round : int
+            Maximum number of requests answered between two refills.
+        """
+        self.socket = socket
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.schedulers = schedulers
+        self.active = dict(schedulers)
+        weights = weights or {}
+        priorities = priorities or {}
+        self.fair_share = FairShare({name: weights.get(name, 1.) for name in schedulers},
+                                    {name: priorities.get(name, 0) for name in schedulers})
+        self.worker_timeout = worker_timeout
+        self.refill_interval = refill_interval
+        self.max_requests_per_round = max_requests_per_round
+        # All the workers we know of, whatever experiment they serve
+        self.last_seen: Dict[str, float] = {}
+        self.switches = 0
+
+    def receive_requests(self, timeout: int) -> List[Tuple[bytes, Dict[str, Any], List[zmq.Frame]]]:
+        requests = []
+        if not self.poller.poll(timeout):
+            return requests
+        while len(requests) < self.max_requests_per_round:
+            try:
+                requests.append(recv_request(self.socket, zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return requests
+
+    def choose(self, wid: str, current: Optional[str]) -> Optional[str]:
+        """The experiment a worker should serve, ``None`` if all are done"""
+        counts = {name: len(scheduler.linked_workers) for (name, scheduler) in self.active.items()}
+        demand = {name: max(1, len(scheduler.work_queue)) for (name, scheduler) in self.active.items()}
+        return self.fair_share.choose(current, counts, demand, len(self.last_seen))
+
+    def route(self, identity: bytes, message: Dict[str, Any], payload: List[zmq.Frame]) -> None:
+        """Hands a request to the scheduler of the experiment the worker
+        serves, or sends the worker to another experiment.
+        """
+        wid = message['worker_id']
+        self.last_seen[wid] = time.time()
+        current = message.get('experiment')
+        if current not in self.active:
+            current = None
+
+        if message['kind'] == 'info':
+            # A new worker, or one that was just sent to another experiment
+            current = current or self.choose(wid, None)
+        elif current is None:
+            # Its experiment is done
+            self.redirect(identity, wid, self.choose(wid, None))
+            return
+        elif message['kind'] == 'pull' and not self.active[current].holds_jobs(wid):
+            target = self.choose(wid, current)
+            if target != current:
+                self.active[current].remove_worker(wid)
+                self.redirect(identity, wid, target)
+                return
+
+        if current is None:
+            send_reply(self.socket, identity, {'kind': 'die'})
+        else:
+            self.active[current].handle_request(identity, message, payload)
+
+    def redirect(self, identity: bytes, wid: str, target: Optional[str]) -> None:
+        if target is None:
+            send_reply(self.socket, identity, {'kind': 'die'})
+        else:
+            self.switches += 1
+            send_reply(self.socket, identity, {'kind': 'switch', 'experiment': target})
+
+    def rebalance_parked(self) -> None:
+        """Moves the workers waiting for jobs (long poll) to the experiments
+        that need them more
+        """
+        for name, scheduler in list(self.active.items()):
+            still_parked = []
+            for identity, message, deadline in scheduler.parked_pulls:
+                wid = message['worker_id']
+                target = name
+                if wid in scheduler.linked_workers and not scheduler.holds_jobs(wid):
+                    target = self.choose(wid, name)
+                if target == name:
+                    still_parked.append((identity, message, deadline))
+                else:
+                    scheduler.remove_worker(wid)
+                    self.redirect(identity, wid, target)
+            scheduler.parked_pulls = still_parked
+
+    def finish(self, name: str) -> None:
+        """Sends the workers of a finished experiment elsewhere and waits for
+        its loggers
+        """
+        scheduler = self.active.pop(name)
+        print(f"==> [Experiment {name} is done]")
+        waiting = [(identity, message) for (identity, message, _)
+                   in scheduler.parked_pulls + scheduler.deferred_acks]
+        for identity, message in waiting:
+            self.redirect(identity, message['worker_id'], self.choose(message['worker_id'], None))
+        scheduler.parked_pulls, scheduler.deferred_acks = [], []
+        scheduler.finish()
+
+    def schedule_work(self) -> None:
+        while self.active:
+            for scheduler in self.active.values():
+                if scheduler.running:
+                    scheduler.refill_work_queue()
+
+            for identity, message, payload in self.receive_requests(self.refill_interval):
+                self.route(identity, message, payload)
+
+            for name, scheduler in list(self.active.items()):
+                scheduler.step()
+                if scheduler.is_done():
+                    self.finish(name)
+            self.rebalance_parked()
+
+            now = time.time()
+            for wid, last_seen in list(self.last_seen.items()):
+                if now - last_seen > self.worker_timeout:
+                    del self.last_seen[wid]
+
+        print("==> [All the experiments are done, shutting down workers]")
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        while self.last_seen:
+            for identity, message, _ in self.receive_requests(1000):
+                send_reply(self.socket, identity, {'kind': 'die'})
+                self.last_seen.pop(message['worker_id'], None)
+            now = time.time()
+            for wid, last_seen in list(self.last_seen.items()):
+                if now - last_seen > self.worker_timeout:
+                    del self.last_seen[wid]
+        print("==> [Have a nice day!]")
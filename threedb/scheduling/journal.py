@@ -0,0 +1,54 @@
+"""
+threedb.scheduling.journal
+==========================
+
+Resuming an experiment after the master died, without rendering again what
+was already done. The results of the completed jobs are read back from the
+JSON log: job ids are deterministic (see
+:func:`threedb.scheduling.policy_controller.job_id`), so a deterministic
+policy issues the same ids when the experiment is run again and gets these
+results instead of rendering them, while the other jobs are issued again.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterator, Tuple
+
+import numpy as np
+import orjson
+
+# Fields of the JSON log that are not results of the job
+LOG_FIELDS = ['id', 'environment', 'model', 'render_args', 'output_type']
+
+def _read_lines(fpath: str, loads: Any) -> Iterator[Dict[str, Any]]:
+    """The records of a JSON lines file. The last line is skipped if it was
+    only partially written (the master died while writing it).
+    """
+    with open(fpath, 'rb') as handle:
+        for line in handle:
+            try:
+                yield loads(line)
+            except ValueError:
+                continue
+
+def load_results(fpath: str) -> Dict[Tuple[str, str], Dict[int, Dict[str, Any]]]:
+    """Reads the results of completed jobs from the log written by
+    :class:`threedb.result_logging.json_logger.JSONLogger`, to hand them back
+    to the policies when resuming an experiment. Only the channels the JSON
+    logger keeps (the keys of the evaluator) are available.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to ``details.log``.
+
+    Returns
+    -------
+    Dict[Tuple[str, str], Dict[int, Dict[str, Any]]]
+        For each (environment, model) pair, the results of each job id.
+    """
+    results: Dict[Tuple[str, str], Dict[int, Dict[str, Any]]] = defaultdict(dict)
+    for record in _read_lines(fpath, orjson.loads):
+        pair = (record['environment'], record['model'])
+        results[pair][record['id']] = {k: np.asarray(v) for (k, v) in record.items()
+                                       if k not in LOG_FIELDS}
+    return dict(results)
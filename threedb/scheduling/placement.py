@@ -0,0 +1,107 @@
+"""
+threedb.scheduling.placement
+============================
+
+Decides which (environment, model) pair each worker should render, to
+avoid loading a different scene on every batch.
+"""
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+Pair = Tuple[str, str]
+
+class PlacementEngine:
+    """
+    Assigns each worker to one (environment, model) pair, so that every pair
+    with pending jobs is rendered by a stable subset of the workers. The size
+    of each subset is proportional to the number of jobs pending for the
+    pair.
+
+    A worker stays on its pair as long as the pair has pending jobs and is
+    not over its share of workers. Otherwise it moves to the pair missing
+    the most workers, preferring the one it has loaded. The assignments are
+    revisited every time a worker asks for jobs, so workers move as policies
+    finish or start.
+
+    The number of scene switches (consecutive jobs of a worker on different
+    pairs) is counted for every worker.
+    """
+
+    def __init__(self) -> None:
+        self.assignment: Dict[str, Pair] = {}
+        self.members: Dict[Pair, Set[str]] = {}
+        # Pair of the last job handed to each worker
+        self.tail: Dict[str, Pair] = {}
+        self.switches: Dict[str, int] = {}
+        self.total_switches = 0
+
+    def _assign(self, worker_id: str, pair: Optional[Pair]) -> None:
+        current = self.assignment.pop(worker_id, None)
+        if current is not None:
+            self.members[current].discard(worker_id)
+            if not self.members[current]:
+                del self.members[current]
+        if pair is not None:
+            self.assignment[worker_id] = pair
+            self.members.setdefault(pair, set()).add(worker_id)
+
+    @staticmethod
+    def targets(remaining: Dict[Pair, int], num_workers: int) -> Dict[Pair, int]:
+        """The number of workers each pair should get (at least one)"""
+        total = sum(remaining.values())
+        return {pair: max(1, round(num_workers * count / total))
+                for (pair, count) in remaining.items()}
+
+    def place(self, worker_id: str, loaded: Optional[Pair],
+              remaining: Dict[Pair, int], num_workers: int) -> Optional[Pair]:
+        """Returns the pair a worker should render next
+
+        Parameters
+        ----------
+        worker_id : str
+            The worker asking for jobs.
+        loaded : Optional[Pair]
+            The pair the worker has currently loaded (if any).
+        remaining : Dict[Pair, int]
+            The number of pending jobs of each pair.
+        num_workers : int
+            The number of workers connected.
+        """
+        remaining = {pair: count for (pair, count) in remaining.items() if count > 0}
+        if not remaining:
+            self._assign(worker_id, None)
+            return loaded
+
+        targets = self.targets(remaining, num_workers)
+        current = self.assignment.get(worker_id)
+        if current in remaining and len(self.members[current]) <= targets[current]:
+            return current
+
+        def deficit(pair: Pair) -> int:
+            members = self.members.get(pair, set())
+            return targets[pair] - len(members - {worker_id})
+
+        best = max(remaining, key=lambda pair: (deficit(pair), pair == loaded, remaining[pair]))
+        if current in remaining and deficit(best) <= 0:
+            return current  # Nowhere else needs us more
+        if loaded in remaining and deficit(loaded) >= deficit(best):
+            best = loaded
+        self._assign(worker_id, best)
+        return best
+
+    def record(self, worker_id: str, jobs: List[Any]) -> None:
+        """Counts the scene switches caused by handing ``jobs`` to a worker"""
+        tail = self.tail.get(worker_id)
+        for job in jobs:
+            pair = (job.environment, job.model)
+            if tail is not None and pair != tail:
+                self.switches[worker_id] = self.switches.get(worker_id, 0) + 1
+                self.total_switches += 1
+            tail = pair
+        if tail is not None:
+            self.tail[worker_id] = tail
+
+    def remove_worker(self, worker_id: str) -> None:
+        self._assign(worker_id, None)
+        self.tail.pop(worker_id, None)
+        self.switches.pop(worker_id, None)
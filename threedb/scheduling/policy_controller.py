@@ -4,11 +4,13 @@ threedb.scheduling.policy_controller
 """
 
 from multiprocessing import Process, Queue
-from queue import Empty
-from collections import namedtuple
-from uuid import uuid4
+from queue import Empty, Queue as ThreadQueue
+from collections import deque, namedtuple
+from threading import Thread
+import hashlib
+import traceback
 import numpy as np
-from typing import List, Dict, Optional, Any
+from typing import Callable, Deque, List, Dict, Optional, Any, Tuple
 from threedb.scheduling.search_space import SearchSpace
 from threedb.result_logging.logger_manager import LoggerManager
 from threedb.utils import init_policy, CyclicBuffer
@@ -16,7 +18,128 @@ from threedb.utils import init_policy, CyclicBuffer
 
 JobDescriptor = namedtuple("JobDescriptor", ['order', 'id', 'environment',
                                              'model', 'render_args',
-                                             'control_order'])
+                                             'control_order', 'params'])
+
+# A batch of jobs posted at once by a policy: the ids of the jobs (int64
+# array) and their parameter vectors (one row per job, see SearchSpace.pack)
+JobBlock = namedtuple("JobBlock", ['environment', 'model', 'ids', 'params'])
+
+def expand_block(block: JobBlock) -> List[JobDescriptor]:
+    """The descriptors of the jobs in a block, as needed by the scheduler.
+    The arguments of the controls are left out, the workers recover them
+    from the parameter vectors.
+    """
+    return [JobDescriptor(order=i, id=job_id, environment=block.environment,
+                          model=block.model, render_args=None,
+                          control_order=None, params=block.params[i])
+            for (i, job_id) in enumerate(np.asarray(block.ids).tolist())]
+
+def job_id(env_file: str, model_name: str, index: int, params: np.ndarray) -> int:
+    """A deterministic id for the ``index``-th job issued by the policy of an
+    (environment, model) pair, so that a deterministic policy issues the same
+    ids every time the experiment is run. Ids are 63-bit hashes: they fit in
+    an ``int64`` and are never negative (they name the files of the image
+    logger).
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f'{env_file}\0{model_name}\0{index}\0'.encode())
+    digest.update(np.ascontiguousarray(params, dtype='float64').tobytes())
+    return int.from_bytes(digest.digest(), 'little') >> 1
+
+# The registration of the policies in the result buffer
+POLICY_REGID = 1
+
+def register_policies(result_buffer: CyclicBuffer, policy_class: Any) -> int:
+    """Registers the policies as a consumer of the results, reading the
+    channels named by the ``RESULT_KEYS`` attribute of their class. Without
+    it, the policies get the channels holding a single value per result
+    (``is_correct``, ``loss``, ...). Once the outputs are declared, the
+    channels they read are given by :meth:`threedb.utils.CyclicBuffer.channels_of`.
+    """
+    keys = getattr(policy_class, 'RESULT_KEYS', None)
+    return result_buffer.register(keys or [], scalars=keys is None)
+
+def run_policy(search_space: SearchSpace,
+               env_file: str,
+               model_name: str,
+               policy_args: Dict[str, Any],
+               logger_manager: LoggerManager,
+               result_buffer: CyclicBuffer,
+               post_block: Callable[[JobBlock], None],
+               get_result: Callable[[], Tuple[int, int]],
+               completed: Optional[Dict[int, Dict[str, Any]]] = None) -> None:
+    """Runs a policy on an (environment, model) pair until it completes. The
+    jobs of each step of the policy are posted at once with ``post_block``
+    and ``get_result`` blocks until the next (job id, buffer index) result is
+    available.
+
+    The jobs whose id is in ``completed`` (when resuming an experiment) are
+    not posted, the policy gets the results recorded for them instead.
+
+    Only the channels the policy reads (see :func:`register_policies`) are
+    copied out of the buffer, and the results are not gathered at all for
+    the policies that read none.
+    """
+    if completed is None:
+        completed = {}
+    num_issued = 0
+    policy = init_policy(policy_args)
+    keys = result_buffer.channels_of(POLICY_REGID)
+
+    def render(args):
+        nonlocal num_issued
+        # Posting the jobs to the queue, in a single block
+
+        all_descriptors = {}
+        client_results: List[Optional[dict]] = [None] * len(args)
+        for i, (continuous_args, discrete_args) in enumerate(args):
+
+            params = search_space.pack(continuous_args, discrete_args)
+            current_id = job_id(env_file, model_name, num_issued, params)
+            num_issued += 1
+            if current_id in completed:
+                client_results[i] = {k: v for (k, v) in completed[current_id].items()
+                                     if k in keys}
+                continue
+            argument_dict, ctrl_list = search_space.unpack(continuous_args,
+                                                           discrete_args)
+            descriptor = JobDescriptor(order=i, id=current_id,
+                                       render_args=argument_dict,
+                                       control_order=ctrl_list,
+                                       environment=env_file,
+                                       model=model_name,
+                                       params=params)
+            all_descriptors[current_id] = descriptor
+
+        if all_descriptors:
+            post_block(JobBlock(environment=env_file, model=model_name,
+                                ids=np.fromiter(all_descriptors.keys(), dtype='int64',
+                                                count=len(all_descriptors)),
+                                params=np.stack([d.params for d in all_descriptors.values()])))
+
+        # Waiting and reordering the results
+        for _ in range(len(all_descriptors)):
+            done_id, result_ix = get_result()
+            descriptor = all_descriptors[done_id]
+            if keys:
+                client_results[descriptor.order] = {k: result_buffer.view(result_ix, k).copy()
+                                                    for k in keys}
+
+            logger_manager.log({
+                **descriptor._asdict(),
+                'result_ix': result_ix
+            })
+            result_buffer.free(result_ix, POLICY_REGID)
+
+        if not keys:
+            return None
+        # Replayed results only have some of the channels
+        result_keys = set.intersection(*(set(res.keys()) for res in client_results))
+        stacked_results = {k: np.stack([res[k] for res in client_results]) for k in result_keys}
+        return stacked_results
+
+    policy.run(render)
+
 
 class PolicyController(Process):
 
@@ -25,7 +148,8 @@ class PolicyController(Process):
                        model_name: str,
                        policy_args: Dict[str, Any],
                        logger_manager: LoggerManager,
-                       result_buffer: CyclicBuffer):
+                       result_buffer: CyclicBuffer,
+                       completed: Optional[Dict[int, Dict[str, Any]]] = None):
         super().__init__()
         self.work_queue = Queue()
         self.result_queue = Queue()
@@ -35,6 +159,7 @@ class PolicyController(Process):
         self.search_space = search_space
         self.logger_manager = logger_manager
         self.result_buffer = result_buffer
+        self.completed = completed
 
     def pull_work(self):
         try:
@@ -46,41 +171,176 @@ class PolicyController(Process):
         self.result_queue.put((descriptor, result))
 
     def run(self):
-        def render(args):
-            # Posting the jobs to the queue
-
-            all_descriptors = {}
-            for i, (continuous_args, discrete_args) in enumerate(args):
-
-                argument_dict, ctrl_list = self.search_space.unpack(continuous_args,
-                                                                    discrete_args)
-                current_id = str(uuid4())
-                descriptor = JobDescriptor(order=i, id=current_id,
-                                           render_args=argument_dict,
-                                           control_order=ctrl_list,
-                                           environment=self.env_file,
-                                           model=self.model_name)
-                all_descriptors[current_id] = descriptor
-                self.work_queue.put(descriptor, block=True)
-
-            client_results: List[Optional[dict]] = [None] * len(args)
-
-            # Waiting and reordering the results
-            for _ in range(len(args)):
-                job_id, result_ix = self.result_queue.get(block=True)
-                c_result = self.result_buffer[result_ix]
-                descriptor = all_descriptors[job_id]
-
-                self.logger_manager.log({
-                    **descriptor._asdict(),
-                    'result_ix': result_ix
-                })
-                client_results[descriptor.order] = {k: v.clone() for (k, v) in c_result.items()}
-                self.result_buffer.free(result_ix, 1)
-
-            result_keys = client_results[0].keys()
-            stacked_results = {k: np.stack([res[k] for res in client_results]) for k in result_keys}
-            return stacked_results
-
-        policy = init_policy(self.policy_args)
-        policy.run(render)
+        run_policy(self.search_space, self.env_file, self.model_name,
+                   self.policy_args, self.logger_manager, self.result_buffer,
+                   lambda block: self.work_queue.put(block, block=True),
+                   lambda: self.result_queue.get(block=True),
+                   self.completed)
+
+
+class PolicyHost(Process):
+    """
+    A process running many policies, each in its own thread. It receives
+    commands from the scheduler on ``commands``:
+
+    - ``(key, env_file, model_name)`` starts a new policy;
+    - ``(key, job_id, result_ix)`` hands a result to a running policy;
+    - ``None`` stops the host.
+
+    The jobs the policies post are sent on ``outbox`` as ``(key,
+    block)``, and ``(key, None)`` once a policy is done.
+
+    ``completed`` holds the results of the jobs already done (when resuming
+    an experiment) for each (environment, model) pair.
+    """
+
+    def __init__(self, search_space: SearchSpace,
+                       policy_args: Dict[str, Any],
+                       logger_manager: LoggerManager,
+                       result_buffer: CyclicBuffer,
+                       completed: Optional[Dict[Tuple[str, str], Dict[int, Dict[str, Any]]]] = None):
+        super().__init__(daemon=True)
+        self.commands = Queue()
+        self.outbox = Queue()
+        self.search_space = search_space
+        self.policy_args = policy_args
+        self.logger_manager = logger_manager
+        self.result_buffer = result_buffer
+        self.completed = completed or {}
+
+    def run_one(self, key: int, env_file: str, model_name: str,
+                results: 'ThreadQueue[Tuple[int, int]]') -> None:
+        try:
+            run_policy(self.search_space, env_file, model_name,
+                       self.policy_args, self.logger_manager, self.result_buffer,
+                       lambda block: self.outbox.put((key, block)),
+                       results.get,
+                       self.completed.get((env_file, model_name)))
+        except Exception:
+            # Like a PolicyController process dying, the pair is over
+            print(f"==> [The policy of {env_file} / {model_name} failed]")
+            traceback.print_exc()
+        finally:
+            self.outbox.put((key, None))
+
+    def run(self):
+        results: Dict[int, ThreadQueue] = {}
+        threads: List[Thread] = []
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            key, first, second = command
+            if key in results:
+                results[key].put((first, second))
+            else:
+                results[key] = ThreadQueue()
+                thread = Thread(target=self.run_one, daemon=True,
+                                args=(key, first, second, results[key]))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+class PooledPolicy:
+    """
+    The scheduler side of a policy running in a
+    :class:`PolicyPool`, it offers the same interface as
+    :class:`PolicyController`.
+    """
+
+    def __init__(self, pool: 'PolicyPool', key: int, env_file: str, model_name: str):
+        self.pool = pool
+        self.key = key
+        self.env_file = env_file
+        self.model_name = model_name
+        self.host: Optional[PolicyHost] = None
+        self.blocks: Deque[JobBlock] = deque()
+        self.done = False
+
+    def start(self):
+        self.pool.start_policy(self)
+
+    def pull_work(self):
+        if not self.blocks:
+            self.pool.poll()
+        return self.blocks.popleft() if self.blocks else None
+
+    def push_result(self, descriptor, result):
+        self.host.commands.put((self.key, descriptor, result))
+
+    def is_alive(self):
+        if not self.done:
+            self.pool.poll()
+        return not self.done or len(self.blocks) > 0
+
+
+class PolicyPool:
+    """
+    Runs the policies as threads inside a fixed number of processes, instead
+    of one process per (environment, model) pair. The processes are only
+    started when the first policy is, once the result buffer has been
+    declared.
+    """
+
+    def __init__(self, num_processes: int,
+                       search_space: SearchSpace,
+                       policy_args: Dict[str, Any],
+                       logger_manager: LoggerManager,
+                       result_buffer: CyclicBuffer,
+                       completed: Optional[Dict[Tuple[str, str], Dict[int, Dict[str, Any]]]] = None):
+        self.num_processes = num_processes
+        self.search_space = search_space
+        self.policy_args = policy_args
+        self.logger_manager = logger_manager
+        self.result_buffer = result_buffer
+        self.completed = completed
+        self.hosts: List[PolicyHost] = []
+        # Number of running policies on each host
+        self.load: Dict[PolicyHost, int] = {}
+        self.policies: Dict[int, PooledPolicy] = {}
+        self.next_key = 0
+
+    def create(self, env_file: str, model_name: str) -> PooledPolicy:
+        """Creates (but does not start) the policy of an (environment, model) pair"""
+        self.next_key += 1
+        return PooledPolicy(self, self.next_key, env_file, model_name)
+
+    def start_policy(self, policy: PooledPolicy) -> None:
+        if not self.hosts:
+            for _ in range(self.num_processes):
+                host = PolicyHost(self.search_space, self.policy_args,
+                                  self.logger_manager, self.result_buffer,
+                                  self.completed)
+                host.start()
+                self.hosts.append(host)
+                self.load[host] = 0
+        policy.host = min(self.hosts, key=self.load.__getitem__)
+        self.load[policy.host] += 1
+        self.policies[policy.key] = policy
+        policy.host.commands.put((policy.key, policy.env_file, policy.model_name))
+
+    def poll(self) -> None:
+        """Hands the blocks of jobs posted by the policies to their
+        :class:`PooledPolicy`
+        """
+        for host in self.hosts:
+            while True:
+                try:
+                    key, block = host.outbox.get(block=False)
+                except Empty:
+                    break
+                policy = self.policies[key]
+                if block is None:
+                    policy.done = True
+                    self.load[host] -= 1
+                    del self.policies[key]
+                else:
+                    policy.blocks.append(block)
+
+    def close(self) -> None:
+        for host in self.hosts:
+            host.commands.put(None)
+        for host in self.hosts:
+            host.join()
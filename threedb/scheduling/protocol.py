@@ -0,0 +1,227 @@
+"""
+threedb.scheduling.protocol
+===========================
+
+Compact binary encoding of the jobs sent to the workers, and of the results
+they send back.
+"""
+
+import importlib
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from threedb.scheduling.policy_controller import JobDescriptor
+from threedb.scheduling.search_space import SearchSpace
+
+class JobCodec:
+    """
+    Encodes batches of jobs as three arrays: the (``int64``) ids of the jobs,
+    the (environment, model) index of each job and its parameter vector (see
+    :meth:`threedb.scheduling.search_space.SearchSpace.pack`).
+
+    Everything needed to turn them back into
+    :class:`threedb.scheduling.policy_controller.JobDescriptor` (names of
+    the environments and models, description of the search space and order
+    of the controls) is the *schema*, sent once per session when the worker
+    declares its outputs.
+
+    The jobs found in the render cache (see
+    :class:`threedb.scheduling.render_cache.RenderCache`) come with their
+    key in the cache, in the header.
+    """
+
+    def __init__(self, schema: Dict[str, Any]) -> None:
+        self.schema = schema
+        self.environments: List[str] = schema['environments']
+        self.models: List[str] = schema['models']
+        self.env_index = {name: i for (i, name) in enumerate(self.environments)}
+        self.model_index = {name: i for (i, name) in enumerate(self.models)}
+        self.search_space = SearchSpace.from_description(schema['search_space'])
+        self.num_params = len(self.search_space.continuous_args) + \
+            len(self.search_space.discrete_args)
+
+    @staticmethod
+    def make_schema(environments: List[str], models: List[str],
+                    search_space: SearchSpace) -> Dict[str, Any]:
+        """Builds the (JSON-serializable) schema of a session"""
+        return {
+            'environments': list(environments),
+            'models': list(models),
+            'search_space': search_space.describe()
+        }
+
+    def encode(self, jobs: List[JobDescriptor],
+               cache_keys: Optional[Dict[int, str]] = None
+               ) -> Tuple[Dict[str, Any], List[np.ndarray]]:
+        """Encodes a list of jobs, and the keys in the render cache of those
+        found there (by job id)
+
+        Returns
+        -------
+        Tuple[Dict[str, Any], List[np.ndarray]]
+            The entries to add to the (JSON) header of the message, and the
+            arrays to send as raw frames after it.
+        """
+        header: Dict[str, Any] = {'num_jobs': len(jobs)}
+        ids = np.array([job.id for job in jobs], dtype='int64')
+        pairs = np.array([(self.env_index[job.environment], self.model_index[job.model])
+                          for job in jobs], dtype='int32').reshape(-1, 2)
+        params = np.zeros((len(jobs), self.num_params), dtype='float64')
+        for i, job in enumerate(jobs):
+            params[i] = job.params
+        if cache_keys:
+            header['cached'] = [[job.id, cache_keys[job.id]] for job in jobs
+                                if job.id in cache_keys]
+        return header, [ids, pairs, params]
+
+    def decode(self, header: Dict[str, Any], frames: List[Any]) -> List[JobDescriptor]:
+        """Inverse of :meth:`encode`, ``frames`` can be anything exposing the
+        buffer protocol (e.g. ``bytes`` or ``zmq.Frame``). The keys in the
+        render cache are decoded by :meth:`decode_cache_keys`.
+        """
+        num_jobs = header['num_jobs']
+        ids = np.frombuffer(frames[0], dtype='int64').tolist()
+        pairs = np.frombuffer(frames[1], dtype='int32').reshape(num_jobs, 2)
+        params = np.frombuffer(frames[2], dtype='float64').reshape(num_jobs, self.num_params)
+        jobs = []
+        for i, job_id in enumerate(ids):
+            render_args, control_order = self.search_space.unpack_vector(params[i])
+            jobs.append(JobDescriptor(order=i, id=job_id,
+                                      environment=self.environments[pairs[i, 0]],
+                                      model=self.models[pairs[i, 1]],
+                                      render_args=render_args,
+                                      control_order=control_order,
+                                      params=params[i]))
+        return jobs
+
+    @staticmethod
+    def decode_cache_keys(header: Dict[str, Any]) -> Dict[int, str]:
+        """The keys in the render cache sent along with the jobs (see
+        :meth:`encode`), by job id
+        """
+        return {job_id: key for (job_id, key) in header.get('cached', ())}
+
+
+# Quantized types and the value 1.0 maps to; values are expected in [0, 1]
+QUANTIZED_DTYPES: Dict[str, int] = {
+    'uint8': 255,
+    'uint16': 65535
+}
+
+COMPRESSIONS: List[str] = ['lz4', 'zstd', 'zlib']
+
+def _load_compression(name: str, level: Optional[int]) -> Tuple[Callable, Callable]:
+    """Returns the (compress, decompress) functions of a compression scheme,
+    importing the optional package it needs on demand
+    """
+    assert name in COMPRESSIONS, f'Unknown compression {name}, expected one of {COMPRESSIONS}'
+    if name == 'zlib':
+        level = -1 if level is None else level
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+
+    package = {'lz4': 'lz4.frame', 'zstd': 'zstandard'}[name]
+    try:
+        module = importlib.import_module(package)
+    except ImportError as error:
+        raise ImportError(f'The {name} compression requires the `{package.split(".")[0]}` package') from error
+
+    if name == 'lz4':
+        kwargs = {} if level is None else {'compression_level': level}
+        return (lambda data: module.compress(data, **kwargs)), module.decompress
+    compressor = module.ZstdCompressor(**({} if level is None else {'level': level}))
+    decompressor = module.ZstdDecompressor()
+    return compressor.compress, decompressor.decompress
+
+
+class ChannelEncoding:
+    """
+    How a result channel travels from the workers to the master: optionally
+    cast to a smaller type, then optionally compressed (``lz4``, ``zstd`` or
+    ``zlib``). Floating point channels sent as ``uint8`` or ``uint16`` are
+    quantized, their values (colors, normalized depth, uv coordinates) are
+    expected to be in [0, 1].
+
+    The master decodes the channel back to the dtype that was declared by the
+    worker before storing it in the buffer, so the declared outputs describe
+    what the loggers get, not what was sent.
+    """
+
+    def __init__(self, dtype: Optional[str] = None,
+                       compression: Optional[str] = None,
+                       level: Optional[int] = None) -> None:
+        """
+        Parameters
+        ----------
+        dtype : Optional[str]
+            The type to send the channel as, by default the declared type.
+        compression : Optional[str]
+            The compression applied to the frame, by default none.
+        level : Optional[int]
+            The compression level, by default the default of the scheme.
+        """
+        if dtype is not None:
+            dtype = np.dtype(dtype).name
+        self.dtype = dtype
+        self.compression = compression
+        self.level = level
+        self._compress: Optional[Callable] = None
+        self._decompress: Optional[Callable] = None
+        if compression is not None:
+            self._compress, self._decompress = _load_compression(compression, level)
+
+    @classmethod
+    def from_config(cls, spec: Any) -> 'ChannelEncoding':
+        """Parses the encoding of a channel from the configuration. It is
+        either the name of a type or of a compression scheme (e.g. ``uint8``
+        or ``lz4``), or a dictionary with the ``dtype``, ``compression`` and
+        ``level`` keys.
+        """
+        if isinstance(spec, str):
+            if spec in COMPRESSIONS:
+                return cls(compression=spec)
+            return cls(dtype=spec)
+        return cls(**spec)
+
+    def describe(self) -> Dict[str, Any]:
+        """A JSON-serializable description, see :meth:`from_config`"""
+        return {'dtype': self.dtype, 'compression': self.compression, 'level': self.level}
+
+    def check(self, channel: str, declared_dtype: str) -> None:
+        """Makes sure the encoding makes sense for a channel declared with the
+        given dtype
+        """
+        if self.dtype is None:
+            return
+        if np.dtype(declared_dtype).kind == 'f':
+            assert self.dtype in QUANTIZED_DTYPES or np.dtype(self.dtype).kind == 'f', \
+                f'Channel {channel} ({declared_dtype}) can not be sent as {self.dtype}'
+        else:
+            assert np.can_cast(declared_dtype, self.dtype, 'same_kind'), \
+                f'Channel {channel} ({declared_dtype}) can not be sent as {self.dtype}'
+
+    def encode(self, array: np.ndarray) -> Any:
+        """Returns the content of the frame to send for an array"""
+        if self.dtype in QUANTIZED_DTYPES and array.dtype.kind == 'f':
+            scale = QUANTIZED_DTYPES[self.dtype]
+            array = np.rint(np.clip(array, 0, 1) * scale).astype(self.dtype)
+        elif self.dtype is not None:
+            array = array.astype(self.dtype, copy=False)
+        array = np.ascontiguousarray(array)
+        if self._compress is not None:
+            return self._compress(array)
+        return array
+
+    def decode_into(self, frame: Any, target: np.ndarray) -> None:
+        """Decodes a frame (anything exposing the buffer protocol) and writes
+        the result in ``target``, converting it to the dtype of ``target``.
+        """
+        if self._decompress is not None:
+            frame = self._decompress(frame)
+        wire_dtype = target.dtype if self.dtype is None else self.dtype
+        array = np.frombuffer(frame, dtype=wire_dtype).reshape(target.shape)
+        if self.dtype in QUANTIZED_DTYPES and target.dtype.kind == 'f':
+            np.multiply(array, 1 / QUANTIZED_DTYPES[self.dtype], out=target)
+        else:
+            np.copyto(target, array)
@@ -0,0 +1,227 @@
+"""
+threedb.scheduling.render_cache
+===============================
+
+A persistent on-disk cache of renders, shared across experiments.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+import time
+from os import path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Sections of the config that change what the renderer produces
+SETTINGS_KEYS = ['render_args', 'controls']
+# Settings in these sections that do not, such as how the results are sent
+# to the master
+TRANSPORT_KEYS = ['wire_encoding']
+
+def file_digest(fpath: str, chunk_size: int = 1 << 20) -> str:
+    """The digest of the content of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fpath, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+def entry_path(root_dir: str, key: str) -> str:
+    """The file holding the renders of the job with the given key"""
+    return path.join(root_dir, key[:2], key + '.npz')
+
+def load_entry(root_dir: str, key: str,
+               declared_outputs: Dict[str, Tuple[List[int], str]]) -> Optional[Dict[str, np.ndarray]]:
+    """The stored renders of a job, if any and if they have all the given
+    outputs (with the right shape and dtype). This is how the workers read
+    the renders of the jobs the master found in the cache.
+    """
+    fpath = entry_path(root_dir, key)
+    try:
+        with np.load(fpath) as stored:
+            result = {channel: stored[channel] for channel in declared_outputs}
+        os.utime(fpath)
+    except (OSError, KeyError, ValueError):
+        # Missing, being evicted or written by an experiment with
+        # different outputs
+        return None
+    for channel, (shape, dtype) in declared_outputs.items():
+        if result[channel].shape != tuple(shape) or result[channel].dtype != np.dtype(dtype):
+            return None
+    return result
+
+class RenderCache:
+    """
+    Stores the render channels of each job (the outputs of the renderer, see
+    :attr:`threedb.rendering.base_renderer.BaseRenderer.KEYS`) in its own
+    file, named after a hash of everything that determines them: the content
+    of the environment and model files, the settings of the renderer and of
+    the controls, the order of the controls and their arguments. Any
+    experiment using the same cache directory gets the stored renders back
+    instead of rendering them again.
+
+    The inference model and the evaluator are not part of the key, nor is
+    the encoding of the results on the wire. The jobs found in the cache are
+    still sent to the workers that can read the cache directory, with their
+    key instead of their parameters to render: these workers read the
+    renders themselves (:func:`load_entry`) and only run inference and
+    evaluation on them. An experiment with another inference model thus
+    reuses all the renders of the previous one. The other workers render
+    the jobs as usual.
+
+    The scheduler looks jobs up (:meth:`has`) when the policies post them,
+    and counts a hit (:meth:`served`) once a worker sends the result of a
+    job it read from the cache. The renders are stored (:meth:`put`) by
+    :class:`threedb.result_logging.cache_logger.CacheLogger`, which also
+    evicts the least recently used entries once the cache is over
+    ``max_bytes``. Entries are marked as used by updating their modification
+    time.
+    """
+
+    def __init__(self, root_dir: str,
+                       max_bytes: float,
+                       channels: List[str],
+                       config: Dict[str, Any],
+                       env_files: Dict[str, Optional[str]],
+                       model_files: Dict[str, Optional[str]]) -> None:
+        """
+        Parameters
+        ----------
+        root_dir : str
+            The directory holding the cache, created if needed.
+        max_bytes : float
+            Size of the cache above which entries are evicted.
+        channels : List[str]
+            The channels the renderer can produce (its ``KEYS``), the only
+            ones stored.
+        config : Dict[str, Any]
+            The config of the experiment.
+        env_files : Dict[str, Optional[str]]
+            The file of each environment, if the renderer knows it. The
+            environments without a file are only identified by their name.
+        model_files : Dict[str, Optional[str]]
+            Same for the models.
+        """
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.channels = list(channels)
+        os.makedirs(root_dir, exist_ok=True)
+
+        settings = {k: config.get(k) for k in SETTINGS_KEYS}
+        if isinstance(settings['render_args'], dict):
+            settings['render_args'] = {k: v for (k, v) in settings['render_args'].items()
+                                       if k not in TRANSPORT_KEYS}
+        self.settings_digest = hashlib.blake2b(
+            json.dumps(settings, sort_keys=True, default=_json_default).encode(),
+            digest_size=16).hexdigest()
+        self.env_digests = {env: file_digest(fpath) if fpath is not None else env
+                            for (env, fpath) in env_files.items()}
+        self.model_digests = {model: file_digest(fpath) if fpath is not None else model
+                              for (model, fpath) in model_files.items()}
+
+        self.hits, self.misses = 0, 0
+        # Only maintained by the process writing to the cache:
+        # (last use, key, size) of every entry, and their total size
+        self.entries: Optional[List[Tuple[float, str, int]]] = None
+        self.total_bytes = 0
+
+    def key(self, env: str, model: str, render_args: Dict[Any, Any],
+            control_order: List[Any]) -> str:
+        """The key of a job in the cache"""
+        args = sorted([list(name) if isinstance(name, tuple) else name, value]
+                      for (name, value) in render_args.items())
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(json.dumps([self.settings_digest, self.env_digests[env],
+                                  self.model_digests[model], [list(x) for x in control_order],
+                                  args], default=_json_default).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return entry_path(self.root_dir, key)
+
+    def has(self, key: str) -> bool:
+        """Whether the renders of a job are stored, counted as a miss if not"""
+        if path.exists(self.entry_path(key)):
+            return True
+        self.misses += 1
+        return False
+
+    def served(self, from_cache: bool) -> None:
+        """Counts a job found by :meth:`has` as a hit if the worker did read
+        its renders from the cache, and as a miss if it had to render it
+        (e.g. the entry was evicted in the meantime).
+        """
+        if from_cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key: str, result: Dict[str, np.ndarray]) -> None:
+        """Stores the renders of a job, then evicts entries if needed"""
+        if self.entries is None:
+            self._scan()
+        fpath = self.entry_path(key)
+        if path.exists(fpath):
+            os.utime(fpath)
+            return
+        os.makedirs(path.dirname(fpath), exist_ok=True)
+        # Written under a temporary name so that readers never see a
+        # partial entry
+        handle, tmp_path = tempfile.mkstemp(dir=path.dirname(fpath), suffix='.tmp')
+        with os.fdopen(handle, 'wb') as tmp_file:
+            np.savez(tmp_file, **result)
+        os.replace(tmp_path, fpath)
+        size = path.getsize(fpath)
+        heapq.heappush(self.entries, (time.time(), key, size))
+        self.total_bytes += size
+        self.evict()
+
+    def _scan(self) -> None:
+        self.entries = []
+        self.total_bytes = 0
+        for subdir in os.listdir(self.root_dir):
+            if len(subdir) != 2 or not path.isdir(path.join(self.root_dir, subdir)):
+                continue
+            for fname in os.listdir(path.join(self.root_dir, subdir)):
+                if not fname.endswith('.npz'):
+                    continue
+                stat = os.stat(path.join(self.root_dir, subdir, fname))
+                self.entries.append((stat.st_mtime, fname[:-4], stat.st_size))
+                self.total_bytes += stat.st_size
+        heapq.heapify(self.entries)
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits in
+        ``max_bytes``
+        """
+        while self.total_bytes > self.max_bytes and self.entries:
+            last_use, key, size = heapq.heappop(self.entries)
+            try:
+                mtime = os.stat(self.entry_path(key)).st_mtime
+            except FileNotFoundError:
+                self.total_bytes -= size
+                continue
+            if mtime > last_use:
+                # It was read since
+                heapq.heappush(self.entries, (mtime, key, size))
+                continue
+            os.remove(self.entry_path(key))
+            self.total_bytes -= size
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(1, self.hits + self.misses)
+        }
@@ -46,8 +46,37 @@ class SearchSpace:
         self.continuous_args = continuous_args
         self.discrete_args = discrete_args
         self.set_args = set_args
+        self.order_controls = [(type(x).__module__, type(x).__name__) for x in self.controls]
         print(discrete_args)
 
+    def describe(self):
+        """A JSON-serializable description of the search space, enough to
+        unpack parameters on the workers (see :meth:`from_description`).
+        """
+        return {
+            'continuous': [[name, attr, list(value_range)]
+                           for (name, attr, value_range) in self.continuous_args],
+            'discrete': [[name, attr, list(values)]
+                         for ((name, attr), values) in self.discrete_args.items()],
+            'set': [[name, attr, value] for (name, attr, value) in self.set_args],
+            'control_order': [list(x) for x in self.order_controls]
+        }
+
+    @classmethod
+    def from_description(cls, description):
+        """Rebuild a search space from the output of :meth:`describe`, without
+        the controls themselves; it can only be used to unpack parameters.
+        """
+        search_space = cls.__new__(cls)
+        search_space.controls = None
+        search_space.continuous_args = [(name, attr, tuple(value_range))
+                                        for (name, attr, value_range) in description['continuous']]
+        search_space.discrete_args = {(name, attr): values
+                                      for (name, attr, values) in description['discrete']}
+        search_space.set_args = [tuple(x) for x in description['set']]
+        search_space.order_controls = [tuple(x) for x in description['control_order']]
+        return search_space
+
     def generate_description(self):
         return len(self.continuous_args), [len(x) for x in self.discrete_args.values()]
 
@@ -65,6 +94,17 @@ class SearchSpace:
         for (control_name, attr_name, value) in self.set_args:
             result[(control_name, attr_name)] = value
 
-        order_controls = [(type(x).__module__, type(x).__name__) for x in self.controls]
+        return result, self.order_controls
+
+    def pack(self, packed_continuous, packed_discrete):
+        """Concatenate the continuous and discrete parameters of a point into
+        a single vector
+        """
+        return np.concatenate([np.asarray(packed_continuous, dtype='float64'),
+                               np.asarray(packed_discrete, dtype='float64')])
 
-        return result, order_controls
+    def unpack_vector(self, params):
+        """Same as :meth:`unpack` for a vector built by :meth:`pack`"""
+        num_continuous = len(self.continuous_args)
+        return self.unpack(params[:num_continuous],
+                           params[num_continuous:].astype('int64'))
@@ -0,0 +1,96 @@
+"""
+threedb.scheduling.shared_ring
+==============================
+
+A ring of result slots in shared memory, used by the workers running on the
+same machine as the master to hand over their results without sending them
+through the socket.
+"""
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch as ch
+
+# Every channel starts on a cache line
+ALIGNMENT = 64
+
+class SharedRing:
+    """
+    ``num_slots`` slots, each able to hold one result: every channel of the
+    declared outputs, stored with its declared shape and dtype, in the order
+    negotiated with the master.
+
+    The worker creates the ring and writes its results in free slots, it
+    then only sends the slot indices to the master. The master attaches to
+    the ring by name, copies the slots into its result buffer and tells the
+    worker which slots it can reuse.
+    """
+
+    def __init__(self, channels: List[str],
+                       declared_outputs: Dict[str, Tuple[List[int], str]],
+                       num_slots: int,
+                       name: Optional[str] = None) -> None:
+        """
+        Parameters
+        ----------
+        channels : List[str]
+            The channels of a result, in order.
+        declared_outputs : Dict[str, Tuple[List[int], str]]
+            The shape and dtype of each channel.
+        num_slots : int
+            The number of results the ring can hold.
+        name : Optional[str]
+            The name of an existing ring to attach to. If ``None`` a new ring
+            is created.
+        """
+        self.channels = channels
+        self.num_slots = num_slots
+        self.layout: Dict[str, Tuple[int, Tuple[int, ...], np.dtype]] = {}
+        offset = 0
+        for channel in channels:
+            shape, dtype = declared_outputs[channel]
+            dtype = np.dtype(dtype)
+            self.layout[channel] = (offset, tuple(shape), dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            offset += -(-size // ALIGNMENT) * ALIGNMENT
+        self.slot_size = max(offset, ALIGNMENT)
+
+        self.owner = name is None
+        if self.owner:
+            self.memory = SharedMemory(create=True, size=self.slot_size * num_slots)
+        else:
+            self.memory = SharedMemory(name=name)
+            # The worker owns the ring, we do not want the resource tracker
+            # to destroy it when the master exits
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+            assert self.memory.size >= self.slot_size * num_slots, \
+                'Shared ring does not match the declared outputs'
+        self.name = self.memory.name
+
+    def describe(self) -> Dict[str, Any]:
+        """What the master needs to attach to the ring"""
+        return {'name': self.name, 'num_slots': self.num_slots}
+
+    def view(self, slot: int, channel: str) -> np.ndarray:
+        """A numpy view on a channel of the given slot"""
+        offset, shape, dtype = self.layout[channel]
+        return np.ndarray(shape, dtype=dtype, buffer=self.memory.buf,
+                          offset=slot * self.slot_size + offset)
+
+    def write(self, slot: int, result: Dict[str, Any]) -> None:
+        """Copies a result (one value per channel) into a slot"""
+        for channel in self.channels:
+            value = result[channel]
+            if ch.is_tensor(value):
+                value = value.data.cpu().numpy()
+            target = self.view(slot, channel)
+            np.copyto(target, np.asarray(value).reshape(target.shape), casting='unsafe')
+
+    def close(self) -> None:
+        """Detach from the ring, and destroy it if we created it"""
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
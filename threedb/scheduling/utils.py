@@ -4,37 +4,110 @@ Scheduling utils
 """
 
 from threedb.utils import CyclicBuffer
+from threedb.scheduling.protocol import ChannelEncoding
+from threedb.scheduling.shared_ring import SharedRing
+import json
 import zmq
 import numpy as np
-import torch as ch
-from typing import Dict, Any
-
-def recv_array(socket, flags=0, copy=True, track=False):
-    """recv a numpy array"""
-    md = socket.recv_json(flags=flags)
-    msg = socket.recv(flags=flags, copy=copy, track=track)
-    buf = memoryview(msg)
-    A = np.frombuffer(buf, dtype=md['dtype'])
-    A = A.reshape(md['shape'])
-    A = ch.from_numpy(A.copy())
-    return A
-
-def recv_into_buffer(socket: zmq.Socket, 
-            cyclic_buffer: CyclicBuffer) -> Dict[str, Any]:
-    main_message: Dict[str, Any] = socket.recv_json()
-
-    if cyclic_buffer.initialized and ('result_keys' in main_message):
-        result_keys = main_message['result_keys']
-        buf_data = {}
-        for result_key in result_keys:
-            buf_data[result_key] = recv_array(socket)
-
-        # outputs = recv_array(socket)
-        # is_correct = socket.recv_pyobj()
-        assert socket.recv_string() == 'done', 'Did not get done message'
-
-        # ix = cyclic_buffer.allocate(images, outputs, is_correct)
-        idx = cyclic_buffer.allocate(buf_data)
-        main_message['result'] = idx
-
-    return main_message
\ No newline at end of file
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Union
+
+def bind_socket(port: int, ipc_path: Optional[str] = None) -> zmq.Socket:
+    """Open the socket the master talks to the workers on. A ROUTER socket
+    lets us have requests from many workers in flight at once, we reply to
+    each of them using their identity.
+    """
+    context = zmq.Context(io_threads=1)
+    socket = context.socket(zmq.ROUTER)
+    socket.bind("tcp://*:%s" % port)
+    if ipc_path is not None:
+        # Workers on the same machine can skip the network stack
+        socket.bind("ipc://%s" % ipc_path)
+    return socket
+
+def recv_request(socket: zmq.Socket, flags: int = 0) -> Tuple[bytes, Dict[str, Any], List[zmq.Frame]]:
+    """Receive a full request from a ROUTER socket.
+
+    Returns the identity of the peer (to route the reply), the decoded JSON
+    header of the request and the raw frames carrying the result arrays (if
+    any). The arrays are left untouched so that the (expensive) copy into the
+    result buffer can happen separately from answering the request.
+    """
+    frames = socket.recv_multipart(flags=flags, copy=False)
+    identity = frames[0].bytes
+    # frames[1] is the empty delimiter added by REQ sockets
+    main_message: Dict[str, Any] = json.loads(frames[2].bytes)
+    payload = frames[3:]
+    if payload:
+        assert payload[-1].bytes == b'done', 'Did not get done message'
+        payload = payload[:-1]
+    return identity, main_message, payload
+
+def send_reply(socket: zmq.Socket, identity: bytes, reply: Dict[str, Any],
+               frames: Sequence[Any] = ()) -> None:
+    """Send a reply to the peer with the given identity on a ROUTER socket.
+    The reply is sent as JSON, followed by the (optional) raw frames.
+    """
+    socket.send_multipart([identity, b'', json.dumps(reply).encode(), *frames], copy=False)
+
+def split_results(main_message: Dict[str, Any],
+                  payload: List[zmq.Frame],
+                  channels: List[str]) -> List[Union[List[zmq.Frame], int]]:
+    """Split the frames of a push request received with
+    :func:`recv_request` into the frames of each of the results it carries
+    (one per job in ``main_message['jobs']``). Each result is one raw frame
+    per channel, in the order negotiated when the worker declared its
+    outputs.
+
+    Results that the worker wrote in its shared ring are not in the message,
+    for them the index of their slot (from ``main_message['slots']``) is
+    returned instead of frames.
+    """
+    per_result = len(channels)
+    slots = main_message.get('slots', [None] * len(main_message['jobs']))
+    num_results = sum(slot is None for slot in slots)
+    assert len(payload) == per_result * num_results, 'Malformed result message'
+    results: List[Union[List[zmq.Frame], int]] = []
+    for slot in slots:
+        if slot is None:
+            results.append(payload[:per_result])
+            payload = payload[per_result:]
+        else:
+            results.append(slot)
+    return results
+
+def recv_into_buffer(channels: List[str],
+                     payloads: List[List[zmq.Frame]],
+                     cyclic_buffer: CyclicBuffer,
+                     encodings: Optional[Dict[str, ChannelEncoding]] = None) -> List[int]:
+    """Copy the arrays of several results (as split by
+    :func:`split_results`) into the result buffer. The slots for all of
+    them are reserved first and the frames are then copied straight into the
+    shared memory, so each array is copied exactly once. The channels listed
+    in ``encodings`` are decoded on the way.
+
+    Returns the indices of the allocated slots.
+    """
+    if encodings is None:
+        encodings = {}
+    dtypes = [cyclic_buffer.declared_buffers[channel][1] for channel in channels]
+    indices = cyclic_buffer.reserve(len(payloads))
+    for ind, payload in zip(indices, payloads):
+        for channel, dtype, frame in zip(channels, dtypes, payload):
+            if channel in encodings:
+                encodings[channel].decode_into(frame.buffer, cyclic_buffer.view(ind, channel))
+            else:
+                cyclic_buffer.write_array(ind, channel, np.frombuffer(frame.buffer, dtype=dtype))
+    return indices
+
+def recv_from_ring(channels: List[str],
+                   ring: SharedRing,
+                   slots: List[int],
+                   cyclic_buffer: CyclicBuffer) -> List[int]:
+    """Same as :func:`recv_into_buffer` for results a worker wrote in its
+    shared ring. The slots can be reused by the worker once this returns.
+    """
+    indices = cyclic_buffer.reserve(len(slots))
+    for ind, slot in zip(indices, slots):
+        for channel in channels:
+            cyclic_buffer.write_array(ind, channel, ring.view(slot, channel))
+    return indices
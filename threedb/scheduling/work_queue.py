@@ -0,0 +1,306 @@
+"""
+threedb.scheduling.work_queue
+=============================
+
+An index over the jobs that are waiting to be rendered, and the leases of the
+jobs that were handed out to workers.
+"""
+
+import time
+from heapq import heappush, heappop
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+class _Entry:
+    """Book-keeping for a single job"""
+    __slots__ = ('policy', 'job', 'num_scheduled', 'time_added', 'leases', 'queued')
+
+    def __init__(self, policy: Any, job: Any, time_added: float) -> None:
+        self.policy = policy
+        self.job = job
+        self.num_scheduled = 0
+        self.time_added = time_added
+        # worker id -> deadline of the lease (None once it expired)
+        self.leases: Dict[str, Optional[float]] = {}
+        # Whether the job currently sits in one of the pending buckets
+        self.queued = False
+
+
+class WorkQueue:
+    """
+    The jobs pending completion.
+
+    Jobs that are not leased to any worker are bucketed by (environment,
+    model) pair. Each bucket is a heap ordered by (number of times scheduled,
+    time added). The jobs of the environment/model the worker should render
+    (see :class:`threedb.scheduling.placement.PlacementEngine`) are served
+    first, straight from their bucket, so that handing out ``bs`` jobs costs
+    ``O(bs log n)``. Only once that bucket is empty are the other buckets
+    scanned for the least scheduled jobs, then the oldest, and the rest of
+    the batch comes from the bucket picked.
+
+    A job handed to a worker gets a lease whose deadline is based on the
+    observed render time of its (environment, model) pair. A job is only
+    handed out again if the worker holding it is declared dead, or if its
+    lease expired *and* the speculative duplicates issued so far stay within
+    ``waste_budget`` (a fraction of all the jobs handed out).
+    """
+
+    def __init__(self, waste_budget: float = 0.05,
+                       lease_factor: float = 3.0,
+                       initial_lease: float = 120.0,
+                       smoothing: float = 0.1) -> None:
+        """
+        Parameters
+        ----------
+        waste_budget : float
+            Maximum fraction of the dispatched jobs that can be speculative
+            duplicates of jobs whose lease expired.
+        lease_factor : float
+            A lease lasts ``lease_factor`` times the expected render time.
+        initial_lease : float
+            Expected render time (in seconds) of (environment, model) pairs
+            that were never rendered so far.
+        smoothing : float
+            Weight of a new observation in the moving average of render times.
+        """
+        self.waste_budget = waste_budget
+        self.lease_factor = lease_factor
+        self.initial_lease = initial_lease
+        self.smoothing = smoothing
+
+        self.entries: Dict[Any, _Entry] = {}
+        # (environment, model) -> heap of (num_scheduled, time_added, job id)
+        # Heap entries that do not match self.entries anymore are stale and
+        # discarded lazily.
+        self.buckets: Dict[Tuple[str, str], List[Tuple[int, float, Any]]] = {}
+        # Heap of (deadline, job id, worker id) for all the leases handed out
+        self.deadlines: List[Tuple[float, Any, str]] = []
+        # Heap of (expiration time, job id) of the jobs with only expired leases
+        self.stragglers: List[Tuple[float, Any]] = []
+        self.worker_jobs: Dict[str, Set[Any]] = {}
+        # Time at which each worker started the job it is currently rendering
+        self.worker_clock: Dict[str, float] = {}
+        # (environment, model) -> moving average of the render time
+        self.render_times: Dict[Tuple[str, str], float] = {}
+        # worker id -> jobs it holds that were completed by another worker
+        self.cancelled: Dict[str, Set[Any]] = {}
+
+        # Number of jobs waiting in the buckets (not leased to any worker),
+        # in total and for each (environment, model) pair
+        self.num_pending = 0
+        self.pending_counts: Dict[Tuple[str, str], int] = {}
+        self.dispatched = 0
+        self.speculative = 0
+        self.cancellations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, job_id: Any) -> bool:
+        return job_id in self.entries
+
+    def add(self, policy: Any, job: Any) -> None:
+        """Add a job (posted by the given policy) to the queue"""
+        entry = _Entry(policy, job, time.time())
+        self.entries[job.id] = entry
+        self._enqueue(entry)
+
+    def _enqueue(self, entry: _Entry) -> None:
+        key = (entry.job.environment, entry.job.model)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = []
+        entry.queued = True
+        self.num_pending += 1
+        self.pending_counts[key] = self.pending_counts.get(key, 0) + 1
+        heappush(bucket, (entry.num_scheduled, entry.time_added, entry.job.id))
+
+    def _top(self, key: Tuple[str, str]) -> Optional[Tuple[int, float, Any]]:
+        """Return the first valid entry of a bucket, dropping stale ones"""
+        bucket = self.buckets[key]
+        while bucket:
+            num_scheduled, _, job_id = bucket[0]
+            entry = self.entries.get(job_id)
+            if entry is not None and entry.queued and entry.num_scheduled == num_scheduled:
+                return bucket[0]
+            heappop(bucket)
+        del self.buckets[key]
+        return None
+
+    def _unqueue(self, entry: _Entry) -> None:
+        entry.queued = False
+        self.num_pending -= 1
+        key = (entry.job.environment, entry.job.model)
+        self.pending_counts[key] -= 1
+        if self.pending_counts[key] == 0:
+            del self.pending_counts[key]
+
+    def _pop_pending(self, last_env: Optional[str], last_model: Optional[str]) -> Optional[_Entry]:
+        # The bucket of the pair the worker should render comes first,
+        # the others are only looked at once it is empty
+        key = (last_env, last_model)
+        if key in self.buckets:
+            top = self._top(key)
+            if top is not None:
+                heappop(self.buckets[key])
+                entry = self.entries[top[-1]]
+                self._unqueue(entry)
+                return entry
+        best, best_key = None, None
+        for key in list(self.buckets.keys()):
+            top = self._top(key)
+            if top is None:
+                continue
+            num_scheduled, time_added, job_id = top
+            mismatch = int(key[0] != last_env) + int(key[1] != last_model)
+            order = (mismatch, num_scheduled, time_added, job_id)
+            if best is None or order < best:
+                best, best_key = order, key
+        if best is None:
+            return None
+        heappop(self.buckets[best_key])
+        entry = self.entries[best[-1]]
+        self._unqueue(entry)
+        return entry
+
+    def _pop_straggler(self, worker_id: str) -> Optional[_Entry]:
+        skipped, found = [], None
+        while self.stragglers and found is None:
+            expired_at, job_id = heappop(self.stragglers)
+            entry = self.entries.get(job_id)
+            if entry is None or entry.queued or any(d is not None for d in entry.leases.values()):
+                continue  # Completed, or handed out again in the meantime
+            if worker_id in entry.leases:
+                skipped.append((expired_at, job_id))  # No point in asking the same worker
+                continue
+            found = entry
+        for item in skipped:
+            heappush(self.stragglers, item)
+        return found
+
+    def expected_render_time(self, job: Any) -> float:
+        """The current estimate of the time needed to render the given job"""
+        return self.render_times.get((job.environment, job.model), self.initial_lease)
+
+    def can_speculate(self) -> bool:
+        """Whether one more speculative duplicate fits in the waste budget"""
+        return self.speculative + 1 <= self.waste_budget * (self.dispatched + 1)
+
+    def expire(self, now: float) -> None:
+        """Expire the leases whose deadline passed"""
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, job_id, worker_id = heappop(self.deadlines)
+            entry = self.entries.get(job_id)
+            if entry is None or entry.leases.get(worker_id) != deadline:
+                continue  # The job completed or the lease was released
+            entry.leases[worker_id] = None
+            if all(d is None for d in entry.leases.values()):
+                heappush(self.stragglers, (deadline, job_id))
+
+    def pop(self, bs: int, worker_id: str,
+            last_env: Optional[str], last_model: Optional[str]) -> List[Any]:
+        """Select up to ``bs`` jobs for a worker, and lease them to it. The jobs
+        stay in the queue until :meth:`complete` is called.
+
+        Parameters
+        ----------
+        bs : int
+            The number of jobs requested
+        worker_id : str
+            The worker asking for jobs
+        last_env : Optional[str]
+            The environment the worker should render
+        last_model : Optional[str]
+            The model the worker should render
+        """
+        now = time.time()
+        self.expire(now)
+
+        held = self.worker_jobs.setdefault(worker_id, set())
+        if not held:
+            self.worker_clock[worker_id] = now
+
+        to_send = []
+        # The worker first has to go through the jobs it already holds
+        expected_done = now + sum(self.expected_render_time(self.entries[job_id].job)
+                                  for job_id in held if job_id in self.entries)
+        while len(to_send) < bs:
+            entry = self._pop_pending(last_env, last_model)
+            if entry is None and self.can_speculate():
+                entry = self._pop_straggler(worker_id)
+                if entry is not None:
+                    self.speculative += 1
+            if entry is None:
+                break
+
+            job = entry.job
+            # The rest of the batch comes from the same bucket, if it can
+            last_env, last_model = job.environment, job.model
+            expected_done += self.expected_render_time(job)
+            # The worker renders its jobs in order, the later ones in the
+            # batch get a longer lease
+            deadline = now + self.lease_factor * (expected_done - now)
+            entry.num_scheduled += 1
+            entry.leases[worker_id] = deadline
+            heappush(self.deadlines, (deadline, job.id, worker_id))
+            held.add(job.id)
+            self.dispatched += 1
+            to_send.append(job)
+        return to_send
+
+    def complete(self, job_id: Any, worker_id: str) -> Optional[Tuple[Any, Any]]:
+        """Remove a job from the queue. Returns the (policy, job) pair it was
+        added with, or ``None`` if the job had already been completed.
+        """
+        now = time.time()
+        held = self.worker_jobs.get(worker_id)
+        if held is not None and job_id in held:
+            held.discard(job_id)
+            started = self.worker_clock.get(worker_id, now)
+            self.worker_clock[worker_id] = now
+            entry = self.entries.get(job_id)
+            if entry is not None:
+                key = (entry.job.environment, entry.job.model)
+                duration = now - started
+                if key in self.render_times:
+                    duration = (1 - self.smoothing) * self.render_times[key] + self.smoothing * duration
+                self.render_times[key] = duration
+
+        entry = self.entries.pop(job_id, None)
+        if entry is None:
+            return None
+        if entry.queued:
+            self._unqueue(entry)
+        for other in entry.leases:
+            if other != worker_id and other in self.worker_jobs:
+                # This worker is still rendering it for nothing
+                self.worker_jobs[other].discard(job_id)
+                self.cancelled.setdefault(other, set()).add(job_id)
+                self.cancellations += 1
+        return entry.policy, entry.job
+
+    def take_cancelled(self, worker_id: str) -> List[Any]:
+        """The jobs leased to a worker that were completed by another one
+        since the last call; the worker can skip them.
+        """
+        return list(self.cancelled.pop(worker_id, ()))
+
+    def release_worker(self, worker_id: str) -> None:
+        """Release all the leases of a worker (when it is declared dead). Its
+        jobs go back to the pending buckets unless another worker holds
+        them.
+        """
+        self.worker_clock.pop(worker_id, None)
+        self.cancelled.pop(worker_id, None)
+        for job_id in self.worker_jobs.pop(worker_id, set()):
+            entry = self.entries.get(job_id)
+            if entry is None:
+                continue
+            entry.leases.pop(worker_id, None)
+            if entry.queued or any(d is not None for d in entry.leases.values()):
+                continue
+            if entry.leases:
+                # Only stragglers are left working on it
+                heappush(self.stragglers, (time.time(), job_id))
+            else:
+                self._enqueue(entry)
@@ -3,13 +3,20 @@ threedb.utils
 =============
 """
 
+import heapq
 import importlib
+import json
+import os
+import shutil
 import ssl
+import tempfile
+import time
+import weakref
 from copy import deepcopy
-from multiprocessing import Queue
-from queue import Empty
+from multiprocessing import Event, Lock
+from os import listdir, makedirs, path, remove
 from threedb.controls.base_control import BaseControl
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union, cast
 
 import numpy as np
 import torch as ch
@@ -21,112 +28,532 @@ from tqdm import tqdm
 def str_to_dtype(dtype_str: str) -> _dtype:
     return getattr(ch, dtype_str)
 
-class CyclicBuffer:
+def shared_memory_dir() -> str:
+    """Where the result buffers are stored: in memory (``/dev/shm``) when
+    available.
     """
-    A concurrent cyclic buffer with reference counting to store the result
-    and avoid copying them to every sub process.
+    return '/dev/shm' if path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def channel_bytes(shape: List[int], dtype: str) -> int:
+    """The size (in bytes) of one result of a channel"""
+    return int(np.prod(shape)) * ch.empty(0, dtype=str_to_dtype(dtype)).element_size()
 
+def is_scalar(shape: List[int]) -> bool:
+    """Whether a channel holds a single value per result"""
+    return int(np.prod(shape)) == 1
 
+def map_file(fpath: str, shape: List[int], dtype: str, create: bool = True) -> Tensor:
+    """A tensor stored in a file, shared with every process that maps it (or
+    inherits the mapping). With ``create``, the file is created (or emptied)
+    and filled with zeros, otherwise its content is kept.
     """
-    def __init__(self, buffers: Optional[Dict[str, Tuple[List[int], str]]] = None,
-                 size: int = 1001, with_tqdm: bool = True) -> None:
-        self.buffers = {}
-        if buffers is None:
-            buffers = {}
-            self.initialized = False
-        else:
-            self.declare_buffers(buffers)
+    numel = int(np.prod(shape))
+    if create:
+        with open(fpath, 'wb') as handle:
+            handle.truncate(numel * channel_bytes([], dtype))
+    return ch.from_file(fpath, shared=True, size=numel, dtype=str_to_dtype(dtype)).view(*shape)
+
+class ChannelPool:
+    """
+    The slots of one result channel, stored in a file that every process
+    using the buffer maps. The pages of the file are only backed by memory
+    once written to, so that it costs the memory of the slots in use rather
+    than of its ``capacity``.
+
+    Only the first ``limit`` slots are handed out, lowest first so that the
+    slots in use stay packed at the start of the file. :meth:`grow` raises
+    the limit (up to ``capacity``) and :meth:`shrink` lowers it, giving the
+    memory of the slots above back to the system.
+    """
+
+    def __init__(self, fpath: str, shape: List[int], dtype: str,
+                 capacity: int, limit: int, create: bool = True) -> None:
+        self.fpath = fpath
+        self.capacity = capacity
+        self.slot_bytes = channel_bytes(shape, dtype)
+        self.tensor = map_file(fpath, [capacity, *shape], dtype, create)
+        self.limit = max(1, min(limit, capacity))
+        self.free_slots = list(range(self.limit))  # A heap
+        self.in_use = 0
+        self.peak = 0
+
+    def available(self) -> bool:
+        return bool(self.free_slots) or self.limit < self.capacity
+
+    def take(self) -> int:
+        if not self.free_slots:
+            self.grow()
+        slot = heapq.heappop(self.free_slots)
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+        return slot
+
+    def give_back(self, slot: int) -> None:
+        heapq.heappush(self.free_slots, slot)
+        self.in_use -= 1
+
+    def restore(self, used: List[int]) -> None:
+        """Marks the given slots as in use (when recovering a buffer)"""
+        used_set = set(used)
+        self.limit = max([self.limit] + [slot + 1 for slot in used_set])
+        self.free_slots = [slot for slot in range(self.limit) if slot not in used_set]
+        self.in_use = self.peak = len(used_set)
+
+    def grow(self) -> None:
+        """Doubles the number of slots handed out (up to ``capacity``)"""
+        new_limit = min(self.capacity, 2 * self.limit)
+        for slot in range(self.limit, new_limit):
+            heapq.heappush(self.free_slots, slot)
+        self.limit = new_limit
+
+    def shrink(self, target: int) -> None:
+        """Hands out only ``target`` slots (or as few above that as the slots
+        in use allow) and releases the memory of the others.
+        """
+        free = set(self.free_slots)
+        new_limit = self.limit
+        while new_limit > max(1, target) and (new_limit - 1) in free:
+            new_limit -= 1
+        if new_limit == self.limit:
+            return
+        self.free_slots = [slot for slot in self.free_slots if slot < new_limit]
+        heapq.heapify(self.free_slots)
+        self.limit = new_limit
+        # Truncating the file drops the pages of the slots above the limit,
+        # extending it again keeps them mapped (and reading as zeros)
+        os.truncate(self.fpath, new_limit * self.slot_bytes)
+        os.truncate(self.fpath, self.capacity * self.slot_bytes)
 
-        self.used_buffer = np.zeros(size, dtype='uint8')
-        self._free_idx = list(range(size))
-        self.size = size
 
-        self.first = 0
-        self.last = 0
-        self.mask = 0
+class CyclicBuffer:
+    """
+    A concurrent buffer with reference counting to store the results and
+    avoid copying them to every sub process.
+
+    Each channel has its own pool of slots (:class:`ChannelPool`) and a
+    result takes one slot in each of them. The consumers say which channels
+    they read when registering (:meth:`register`): the slot of a channel is
+    freed as soon as the consumers reading it are done, so that the small
+    channels (``is_correct``, ``loss``, ...) can wait for the policy while
+    the images are gone once logged.
+
+    With a ``memory_budget`` (in bytes), the number of slots of each channel
+    is derived from the declared outputs: channels of at most
+    ``small_channel_bytes`` per result get ``small_channel_factor`` times as
+    many slots as the others (up to ``max_results``), and the large ones as
+    many as the rest of the budget allows. Without budget, every channel has
+    ``size`` slots. The memory is only used as the slots are: the pools hand
+    out ``initial_slots`` at first and grow when the consumers lag behind,
+    and shrink back (releasing the memory) once their peak use stayed below
+    half of what they hand out for ``resize_interval`` seconds.
+
+    The number of consumers still holding each channel of each result is
+    kept in shared memory, and :meth:`free` decrements it in the process of
+    the consumer (under a shared lock). The slots it releases are queued in a
+    shared ring that the allocating process drains (:meth:`process_events`)
+    before looking for a free slot, so that they are available as soon as
+    freed and there is no limit on the number of consumers.
+
+    The buffer is stored in memory (``/dev/shm``), unless a ``directory``
+    is given: the files are then kept there (e.g. on a local SSD), so that
+    it can be larger than the memory of the machine (the kernel keeps the
+    slots in use in its page cache, and writes them back as needed). Its
+    content also survives a crash of the process that allocates, and
+    :meth:`recover` finds the results that were not consumed yet.
+
+    When no slot is left, allocating blocks until a consumer frees one
+    (:meth:`free` wakes it up). The time spent blocked is accumulated in
+    ``stall_time``, and a warning is printed every ``stall_warning`` seconds
+    of a stall.
+    """
+    def __init__(self, buffers: Optional[Dict[str, Tuple[List[int], str]]] = None,
+                 size: int = 1001, with_tqdm: bool = True,
+                 stall_warning: float = 30.,
+                 memory_budget: Optional[float] = None,
+                 small_channel_bytes: int = 4096,
+                 small_channel_factor: int = 16,
+                 max_results: int = 2**16,
+                 initial_slots: int = 64,
+                 resize_interval: float = 30.,
+                 directory: Optional[str] = None) -> None:
+        self.size = size
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.small_channel_bytes = small_channel_bytes
+        self.small_channel_factor = small_channel_factor
+        self.max_results = max_results
+        self.initial_slots = initial_slots
+        self.resize_interval = resize_interval
+        self.initialized = False
+        self.pools: Dict[str, ChannelPool] = {}
+        self.root: Optional[str] = None
+
+        # The channels each registered consumer reads (None for all)
+        self.interests: Dict[int, Optional[List[str]]] = {}
+        self.scalar_readers: Set[int] = set()
         self.registration_count = 0
-        self.events = Queue()
+        self.lock = Lock()
+        self.freed = Event()
+        self.stall_time = 0.
+        self.stall_warning = stall_warning
 
         self.progress_bar = None
         if with_tqdm:
             self.progress_bar = tqdm(unit='slots', desc='Buffer left',
                                      total=self.size, smoothing=0)
+        if buffers is not None:
+            self.declare_buffers(buffers)
+
+    def plan_capacities(self, buffers: Dict[str, Tuple[List[int], str]]) -> Tuple[int, Dict[str, int]]:
+        """The number of results the buffer can hold at once, and the number
+        of slots of each channel.
+        """
+        if self.memory_budget is None or not buffers:
+            return self.size, {name: self.size for name in buffers}
+        sizes = {name: channel_bytes(shape, dtype) for (name, (shape, dtype)) in buffers.items()}
+        small = {name for (name, size) in sizes.items() if size <= self.small_channel_bytes}
+        small_bytes = max(1, sum(sizes[name] for name in small))
+        large_bytes = sum(size for (name, size) in sizes.items() if name not in small)
+
+        num_large = int(self.memory_budget // (large_bytes + self.small_channel_factor * small_bytes))
+        num_results = self.max_results
+        if large_bytes:
+            num_results = min(num_results, self.small_channel_factor * num_large)
+            # What the small channels do not use goes to the large ones
+            num_large = int((self.memory_budget - num_results * small_bytes) // large_bytes)
+            num_large = min(num_large, num_results)
+        else:
+            num_results = min(num_results, int(self.memory_budget // small_bytes))
+        assert num_results >= 1 and (num_large >= 1 or not large_bytes), \
+            f'A memory budget of {self.memory_budget / 2**20:.0f}MB cannot hold a single result'
+        return num_results, {name: num_results if name in small else num_large
+                             for name in buffers}
 
     def declare_buffers(self, buffers: Dict[str, Tuple[List[int], str]]) -> bool:
         if self.initialized and (buffers != self.declared_buffers):
             return False
         elif self.initialized:
             return True
-        
+
+        size, capacities = self.plan_capacities(buffers)
+        if self.directory is None:
+            self.root = tempfile.mkdtemp(prefix='threedb-buffer-', dir=shared_memory_dir())
+            self.cleanup = weakref.finalize(self, shutil.rmtree, self.root, True)
+        else:
+            makedirs(self.directory, exist_ok=True)
+            self.root = self.directory
+        with open(path.join(self.root, 'manifest.json'), 'w') as handle:
+            json.dump({'buffers': buffers, 'size': size, 'capacities': capacities}, handle)
+        self._map(buffers, size, capacities, create=True)
+        print(f"==> [Result buffer of {size} results, slots per channel: {capacities}]")
+        return True
+
+    def _map(self, buffers: Dict[str, Tuple[List[int], str]], size: int,
+             capacities: Dict[str, int], create: bool) -> None:
         self.initialized = True
         self.declared_buffers = buffers
-        for buf_name, (buf_size, buf_dtype) in buffers.items():
-            buf = ch.zeros((self.size, *buf_size), dtype=str_to_dtype(buf_dtype)).share_memory_()
-            self.buffers[buf_name] = buf
-        return True
+        self.size = size
+        for index, (buf_name, (buf_size, buf_dtype)) in enumerate(buffers.items()):
+            self.pools[buf_name] = ChannelPool(path.join(self.root, f'{index}.bin'),
+                                               buf_size, buf_dtype, capacities[buf_name],
+                                               self.initial_slots, create)
+        self.pool_list = list(self.pools.values())
+        self.channel_index = {name: index for (index, name) in enumerate(self.pools)}
+
+        # The slot of every result in each channel, how many consumers still
+        # hold it and the job it is the result of (-1 until known)
+        def table(name: str, shape: List[int], dtype: str) -> Tensor:
+            return map_file(path.join(self.root, name), shape, dtype, create)
+        self.slot_table = table('slots.bin', [size, len(buffers)], 'int32')
+        self.slots = self.slot_table.numpy()
+        self.refcount_table = table('refcounts.bin', [size, len(buffers)], 'int32')
+        self.refcounts = self.refcount_table.numpy()
+        self.job_table = table('jobs.bin', [size], 'int64')
+        self.jobs = self.job_table.numpy()
+        # The (result, channel) pairs released since the last call to
+        # process_events (channel -1 once the whole result is), and how many
+        # were written and read. Each pair is only released once until the
+        # result is allocated again, so it cannot overflow
+        self.released_table = table('released.bin', [size * (len(buffers) + 1), 2], 'int32')
+        self.released = self.released_table.numpy()
+        self.released_cursors = table('cursors.bin', [2], 'int64')
+        self.released_cursors[:] = 0
+        self._free_idx = list(range(size))
+        self._update_refcounts()
+        self.last_resize = time.time()
+        if self.progress_bar is not None:
+            self.progress_bar.reset(total=size)
+
+    def recover(self) -> Dict[int, int]:
+        """Maps the buffer left in ``directory`` by a process that died,
+        keeping the results that were not consumed yet. Only the results
+        whose channels were all still held are kept, they are held again by
+        every consumer registered now.
+
+        Returns
+        -------
+        Dict[int, int]
+            The index of each recovered result, by job id (empty if there was
+            no buffer to recover).
+        """
+        assert not self.initialized, 'Cannot recover a buffer already in use'
+        assert self.directory is not None, 'Only a buffer in a directory can be recovered'
+        manifest_path = path.join(self.directory, 'manifest.json')
+        if not path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+        self.root = self.directory
+        self._map(manifest['buffers'], manifest['size'], manifest['capacities'], create=False)
+
+        kept = np.flatnonzero((self.refcounts > 0).all(axis=1) & (self.jobs >= 0))
+        dropped = np.ones(self.size, dtype=bool)
+        dropped[kept] = False
+        self.refcounts[dropped] = 0
+        self.refcounts[kept] = self.initial_refcounts
+        for index, pool in enumerate(self.pool_list):
+            pool.restore(self.slots[kept, index].tolist())
+        self._free_idx = np.flatnonzero(dropped)[::-1].tolist()
+        if self.progress_bar is not None:
+            self.progress_bar.update(len(kept))
+        print(f"==> [Recovered {len(kept)} results from the result buffer in {self.directory}]")
+        return dict(zip(self.jobs[kept].tolist(), kept.tolist()))
+
+    def record_jobs(self, indices: List[int], job_ids: Iterable[int]) -> None:
+        """Records which job each result is the result of, once it was fully
+        written, for :meth:`recover`.
+        """
+        self.jobs[indices] = list(job_ids)
+
+    def channels_of(self, reg_id: int) -> List[str]:
+        """The declared channels the consumer ``reg_id`` reads, as given to
+        :meth:`register`.
+        """
+        channels = self.interests[reg_id]
+        return [name for (name, (shape, _)) in self.declared_buffers.items()
+                if channels is None or name in channels
+                or (reg_id in self.scalar_readers and is_scalar(shape))]
+
+    def _update_refcounts(self) -> None:
+        read = {regid: self.channels_of(regid) for regid in self.interests}
+        readers = {name: [regid for regid in self.interests if name in read[regid]]
+                   for name in self.declared_buffers}
+        for name in self.pools:
+            if not readers[name]:
+                # Nobody reads it, it lives as long as the result
+                readers[name] = list(self.interests.keys())
+        self.initial_refcounts = np.array([len(readers[name]) for name in self.pools],
+                                          dtype='int32')
+        # The channels each consumer holds
+        self.held_channels = {regid: np.array([index for (index, name) in enumerate(self.pools)
+                                               if regid in readers[name]], dtype='int64')
+                              for regid in self.interests}
+        self.held_channels[-1] = np.arange(len(self.pools))
+
+    def _slot(self, ind: int, key: str) -> ch.Tensor:
+        assert key in self.pools, "Unexpected channel " + key
+        return self.pools[key].tensor[int(self.slots[ind, self.channel_index[key]])]
 
     def __getitem__(self, ind: int) -> Dict[str, ch.Tensor]:
         assert self.initialized, 'Buffer has not been initialized'
-        return {k: v[ind] for (k, v) in self.buffers.items()}
+        return {name: pool.tensor[slot]
+                for (name, pool), slot in zip(self.pools.items(), self.slots[ind].tolist())}
 
     def free(self, ind: int, reg_id: int):
+        """Releases the channels of a result held by the consumer ``reg_id``
+        (all of them for -1).
+        """
         assert self.initialized, 'Buffer has not been initialized'
-        self.events.put((ind, reg_id))
-
-    def register(self):
+        channels = self.held_channels[reg_id]
+        with self.lock:
+            counts = self.refcounts[ind]
+            assert (counts[channels] > 0).all() or reg_id == -1, \
+                f'Result {ind} freed twice by consumer {reg_id}'
+            released = channels[counts[channels] > 0]
+            if reg_id == -1:
+                counts[channels] = 0
+            else:
+                counts[channels] -= 1
+            released = released[counts[released] == 0].tolist()
+            if not released:
+                return
+            if not counts.any():
+                released.append(-1)
+            written = int(self.released_cursors[0])
+            for channel in released:
+                self.released[written % len(self.released)] = (ind, channel)
+                written += 1
+            self.released_cursors[0] = written
+        self.freed.set()
+
+    def register(self, channels: Optional[Iterable[str]] = None,
+                 scalars: bool = False) -> int:
+        """Registers a consumer of the results, which has to :meth:`free`
+        each result it gets once done with it.
+
+        Parameters
+        ----------
+        channels : Optional[Iterable[str]]
+            The channels the consumer reads (all of them by default), the
+            other ones can be freed without waiting for it.
+        scalars : bool
+            Whether the consumer also reads every channel holding a single
+            value per result (``is_correct``, ``loss``, ...), whichever
+            they turn out to be.
+        """
         self.registration_count += 1
-        if self.registration_count > 8:
-            raise Exception("Too many registrations")
-        self.mask = 2**self.registration_count - 1
+        self.interests[self.registration_count] = None if channels is None else list(channels)
+        if scalars:
+            self.scalar_readers.add(self.registration_count)
+        if self.initialized:
+            self._update_refcounts()
         return self.registration_count
 
-    def process_events(self):
+    def process_events(self) -> int:
+        """Takes back the slots released by the consumers since the last
+        call, returns how many results and channels were.
+        """
+        assert self.initialized, 'Buffer has not been initialized'
+        with self.lock:
+            written, read = self.released_cursors.tolist()
+        for position in range(read, written):
+            ind, channel = self.released[position % len(self.released)].tolist()
+            if channel == -1:
+                self._free_idx.append(ind)
+                if self.progress_bar is not None:
+                    self.progress_bar.update(-1)
+            else:
+                self.pool_list[channel].give_back(int(self.slots[ind, channel]))
+        self.released_cursors[1] = written
+        self._resize()
+        return written - read
+
+    def _resize(self) -> None:
+        """Shrinks the pools that handed out more than twice their peak use
+        since the last check.
+        """
+        now = time.time()
+        if now - self.last_resize < self.resize_interval:
+            return
+        self.last_resize = now
+        for pool in self.pool_list:
+            if pool.limit > self.initial_slots and 2 * pool.peak < pool.limit:
+                pool.shrink(max(self.initial_slots, 2 * pool.peak))
+            pool.peak = pool.in_use
+
+    def wait_for_events(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a consumer frees a slot (or ``timeout`` seconds
+        passed), then processes the pending events. Returns whether there
+        was any.
+        """
         assert self.initialized, 'Buffer has not been initialized'
-        while True:
-            try:
-                (event, reg_id) = self.events.get(block=False)
-                assert self.used_buffer[event] > 0
-                if reg_id == -1:
-                    self.used_buffer[event] = 0
-                else:
-                    self.used_buffer[event] ^= 1 << (reg_id - 1)
-                if self.used_buffer[event] == 0:
-                    self._free_idx.append(event)
-                    if self.progress_bar is not None:
-                        self.progress_bar.update(-1)
-            except Empty:
-                break
+        # Anything freed after clearing the event sets it again
+        self.freed.clear()
+        if self.process_events():
+            return True
+        if not self.freed.wait(timeout):
+            return False
+        self.process_events()
+        return True
+
+    def num_free(self) -> int:
+        """The number of results that can be allocated without blocking"""
+        self.process_events()
+        return min([len(self._free_idx)] +
+                   [pool.capacity - pool.in_use for pool in self.pool_list])
+
+    def _can_take(self) -> bool:
+        return bool(self._free_idx) and all(pool.available() for pool in self.pool_list)
+
+    def _take_free_index(self) -> int:
+        ind = self._free_idx.pop()
+        if self.progress_bar is not None:
+            self.progress_bar.update(1)
+        assert not self.refcounts[ind].any()
+        self.jobs[ind] = -1
+        self.slots[ind] = [pool.take() for pool in self.pool_list]
+        self.refcounts[ind] = self.initial_refcounts
+        return ind
 
     def next_find_index(self) -> int:
         assert self.initialized, 'Buffer has not been initialized'
-        while True:
-            self.process_events()
-            try:
-                ind = self._free_idx.pop()
-                if self.progress_bar is not None:
-                    self.progress_bar.update(1)
-                assert self.used_buffer[ind] == 0
-                self.used_buffer[ind] = self.mask
-                return ind
-            except IndexError:
-                # Should we add some kind of logging here?
-                np.save('/tmp/used_buffer.npy', self.used_buffer)
+        self.process_events()
+        if not self._can_take():
+            # Every slot is in use, we have to wait for the consumers
+            stalled_since = time.time()
+            while not self._can_take():
+                if not self.wait_for_events(self.stall_warning):
+                    print(f"==> [Result buffer full for {time.time() - stalled_since:.0f}s, "
+                          "waiting for the policies and loggers to free slots]")
+            self.stall_time += time.time() - stalled_since
+        return self._take_free_index()
 
     def allocate(self, data: Dict[str, ch.Tensor]):
         assert self.initialized, 'Buffer has not been initialized'
         next_ind = self.next_find_index()
+        self._write(next_ind, data)
+        return next_ind
 
+    def reserve(self, count: int) -> List[int]:
+        """Allocates ``count`` slots without writing anything in them, the
+        caller is expected to fill them with :meth:`write_array`. The pending
+        free events are only processed once.
+        """
+        assert self.initialized, 'Buffer has not been initialized'
+        self.process_events()
+        indices = []
+        for _ in range(count):
+            if self._can_take():
+                indices.append(self._take_free_index())
+            else:
+                indices.append(self.next_find_index())
+        return indices
+
+    def allocate_batch(self, all_data: List[Dict[str, ch.Tensor]]) -> List[int]:
+        """Allocates a slot for each of the given results, processing the
+        pending free events only once.
+        """
+        indices = self.reserve(len(all_data))
+        for ind, data in zip(indices, all_data):
+            self._write(ind, data)
+        return indices
+
+    def view(self, ind: int, key: str) -> np.ndarray:
+        """A numpy view on the slot of a channel holding the given result,
+        writing to it writes to the shared memory.
+        """
+        return self._slot(ind, key).numpy()
+
+    def write_array(self, ind: int, key: str, array: np.ndarray) -> None:
+        """Copies an array (for example a view on a received message) directly
+        into the given slot of a channel, without any intermediate copy.
+        """
+        target = self.view(ind, key)
+        assert array.dtype == target.dtype, \
+            f"Expected datatype {target.dtype}, got {array.dtype} for key {key}"
+        np.copyto(target, array.reshape(target.shape))
+
+    def _write(self, ind: int, data: Dict[str, ch.Tensor]) -> None:
         for buf_key, buf_data in data.items():
-            assert buf_key in self.buffers, "Unexpected channel " + buf_key
-            assert buf_data.dtype == self.buffers[buf_key].dtype, \
-                f"Expected datatype {self.buffers[buf_key].dtype}, got {buf_data.dtype} for key {buf_key}"
-            self.buffers[buf_key][next_ind] = buf_data
-
-        return next_ind
+            target = self._slot(ind, buf_key)
+            assert buf_data.dtype == target.dtype, \
+                f"Expected datatype {target.dtype}, got {buf_data.dtype} for key {buf_key}"
+            target[...] = buf_data
 
     def close(self):
         if self.progress_bar is not None:
+            if self.initialized:
+                # The last results freed by the consumers are still queued
+                self.process_events()
             self.progress_bar.close()
+        if self.directory is None and self.root is not None:
+            # The processes that mapped the pools keep them until they exit
+            self.cleanup()
+        elif self.root is not None:
+            # Everything was consumed, there is nothing to recover
+            for fname in listdir(self.root):
+                if fname.endswith('.bin') or fname == 'manifest.json':
+                    remove(path.join(self.root, fname))
 
 def overwrite_control(control: BaseControl, data: Dict[str, Union[Tuple[float, float], List[Any]]]):
     for key, val in data.items():